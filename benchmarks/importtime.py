@@ -0,0 +1,81 @@
+#Import time and worker startup benchmark
+#For every module, measures in fresh interpreters the time taken by "import module" and
+#  lists the heavy dependencies it loads. Then measures the time for a pool of spawned
+#  workers to start and import the simulation core, as the workers of simulate do with
+#  the spawn start method.
+#
+#Usage: python benchmarks/importtime.py [--repeat R] [--workers N] [--json]
+#Run from the repository root
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+import timeit
+import multiprocessing as mp
+
+Modules=['evolution', 'population', 'tests', 'interventions', 'inoutfuncs', 'ensemble']
+HeavyModules=['pandas', 'scipy', 'geopandas', 'shapely', 'matplotlib']
+
+Root=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+Probe="""
+import sys, time, json
+Start=time.perf_counter()
+import {module}
+Elapsed=time.perf_counter()-Start
+print(json.dumps({{'seconds': Elapsed, 'heavy': [m for m in {heavy} if m in sys.modules]}}))
+"""
+
+
+#Time of importing Module in a fresh interpreter, and the heavy modules it loaded
+def importTime(Module, Repeat):
+    Times=[]
+    for r in range(Repeat):
+        Output=subprocess.run([sys.executable, '-c', Probe.format(module=Module, heavy=HeavyModules)], \
+                              cwd=Root, capture_output=True, text=True, check=True).stdout
+        Result=json.loads(Output.strip().splitlines()[-1])
+        Times.append(Result['seconds'])
+    return {'module': Module, 'seconds': statistics.median(Times), 'heavy': Result['heavy']}
+
+
+def _ready(k):
+    return os.getpid()
+
+
+#Time until NumWorkers spawned workers that import evolution have all answered
+def workerStartup(NumWorkers, Repeat):
+    Times=[]
+    Context=mp.get_context('spawn')
+    for r in range(Repeat):
+        Start=timeit.default_timer()
+        with Context.Pool(NumWorkers, initializer=__import__, initargs=('evolution',)) as Pool:
+            Pool.map(_ready, range(NumWorkers), chunksize=1)
+        Times.append(timeit.default_timer()-Start)
+    return {'workers': NumWorkers, 'seconds': statistics.median(Times)}
+
+
+def main():
+    Parser=argparse.ArgumentParser(description='Import time and worker startup benchmark')
+    Parser.add_argument('--repeat', type=int, default=5)
+    Parser.add_argument('--workers', type=int, default=8)
+    Parser.add_argument('--json', action='store_true', help='print the results as json')
+    Args=Parser.parse_args()
+
+    sys.path.insert(0, Root)
+    Results={'imports': [importTime(Module, Args.repeat) for Module in Modules], \
+             'startup': workerStartup(Args.workers, Args.repeat)}
+
+    if Args.json:
+        print(json.dumps(Results))
+        return
+    print('{:<16}{:>12}  {}'.format('module', 'import (s)', 'heavy dependencies loaded'))
+    for Result in Results['imports']:
+        print('{:<16}{:>12.3f}  {}'.format(Result['module'], Result['seconds'], ', '.join(Result['heavy']) or '-'))
+    print('Spawned pool of {workers} workers importing evolution: {seconds:.3f}s'.format(**Results['startup']))
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,199 @@
+#Scaling benchmark on synthetic cities
+#Runs simulate's day loop (simulateStream) on a synthetic city (see synthcity.py) for every
+#  number of agents and of workers given, each case in a fresh process so that its peak
+#  memory is its own. Every case covers the initialization of the population, the daily
+#  update, the testing policy and the intervention policy, and reports:
+# - agent_days_per_second: agents x days / time of the days (initialization excluded)
+# - initialize_seconds, pool_seconds: population setup and worker pool startup
+# - phases: total time of every phase of the days (see profiling.py)
+# - counters: totals of the daily counters, e.g. agents updated, exposures and tests
+# - peak_rss_bytes, peak_worker_rss_bytes: peak memory of the main process and of the
+#   largest worker
+#The results are written as json with the version of the code and the machine, so that
+#  runs of two versions can be compared with --compare.
+#
+#Usage: python benchmarks/scaling.py [--agents 10000 100000 ...] [--workers 1 4 8] [--days D]
+#         [--localities L] [--adjacency grid|planar] [--testing none|random|contact]
+#         [--intervention none|evenodd|lockdown|quarantine] [--active] [--output results.json]
+#         [--compare baseline.json] [--json]
+#Run from the repository root
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import subprocess
+import multiprocessing as mp
+
+Root=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#Model parameters of exampleRST-Quarantine.py
+ModelParams={"CovidInfectionRate": 0.1, "CovidRateVector": [1, 1/8], "FluRateVector": [0.02, 1/8], \
+             "NeighborhoodContact": 1, "NeighborhoodContactFixed": 5, "HotspotContact": 2, "HotspotContactFixed": 10}
+
+#Runs one case in this process and sends its results on Connection
+def runCase(Case, Connection):
+    sys.path.insert(0, Root)
+    import numpy as np
+    from functools import partial
+    import evolution
+    from synthcity import syntheticCity
+    from sinks import drain, RunningTotals
+    from profiling import ProfileSummary, GaugeCounters, peakRSS
+    from tests import RandomSymptomaticTesting, ContactTracing
+    from interventions import InterventionNone, InterventionEvenOdd, InterventionLockdown, InterventionQuarantine
+
+    try:
+        #The simulation prints every day; only the results are kept
+        sys.stdout=open(os.devnull, 'w')
+        CD, CarProb = syntheticCity(Case['localities'], Case['hotspots'], Case['adjacency'], randseed=Case['seed'])
+        Counts=(Case['agents']*CD['locality_density'].to_numpy()).astype(np.int64)
+        #One initial case in every other locality, as simulate does, where there are agents
+        InitCovid=np.minimum(np.arange(CD.shape[0])%2, Counts).tolist()
+
+        Budget=max(1, int(Case['agents']*Case['test_fraction']))
+        LocationRepProb=np.ones(CD.shape[0])
+        Testing={'none': lambda CP, TestingHistory, day: None, \
+                 'random': partial(RandomSymptomaticTesting, Budget, 0.0, LocationRepProb), \
+                 'contact': partial(ContactTracing, Budget, 0.0, LocationRepProb)}[Case['testing']]
+        Intervention={'none': InterventionNone, 'evenodd': InterventionEvenOdd, 'lockdown': InterventionLockdown, \
+                      'quarantine': InterventionQuarantine}[Case['intervention']]
+
+        Summary=ProfileSummary()
+        Totals=RunningTotals()
+        drain(evolution.simulateStream(Case['days'], Case['agents'], ModelParams, CD, CarProb, Intervention, Testing, \
+                                       InitCovid, None, Case['workers'], Case['seed'], ActiveSet=Case['active']), \
+              Summary, Totals)
+
+        Agents=len(evolution.CP)
+        DaySeconds=sum(Summary.Phases.values())
+        Worker=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        Result=dict(Case, agents_effective=Agents, \
+                    agent_days_per_second=Agents*Summary.Days/DaySeconds if DaySeconds>0 else None, \
+                    seconds_per_day=DaySeconds/max(Summary.Days, 1), \
+                    initialize_seconds=Summary.Setup.get('initialize', 0.0), pool_seconds=Summary.Setup.get('pool', 0.0), \
+                    phases=Summary.Phases, \
+                    counters={Name: Value for Name, Value in Summary.Counters.items() if Name not in GaugeCounters}, \
+                    peak_cases=Totals.PeakCases, positive_tests=Totals.PositiveTests, tests=Totals.Tests, \
+                    peak_rss_bytes=peakRSS(), \
+                    peak_worker_rss_bytes=Worker if sys.platform=='darwin' else Worker*1024)
+        Connection.send(('ok', Result))
+    except BaseException as e:
+        Connection.send(('error', repr(e)))
+    finally:
+        Connection.close()
+
+
+#Runs Case in a fresh spawned process
+def measure(Case):
+    Context=mp.get_context('spawn')
+    Parent, Child = Context.Pipe(duplex=False)
+    Process=Context.Process(target=runCase, args=(Case, Child))
+    Process.start()
+    Child.close()
+    try:
+        Status, Result = Parent.recv()
+    except EOFError:
+        #Killed without sending, e.g. out of memory
+        Status, Result = 'error', None
+    Process.join()
+    if Result is None:
+        Result='process exited with code '+str(Process.exitcode)
+    if Status!='ok':
+        return dict(Case, error=Result)
+    return Result
+
+
+#Version of the code and machine the results were measured on
+def environment():
+    import numpy as np
+    try:
+        Commit=subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=Root, capture_output=True, text=True).stdout.strip() or None
+        Dirty=bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=Root, \
+                                  capture_output=True, text=True).stdout.strip())
+    except OSError:
+        Commit, Dirty = None, None
+    return {'commit': Commit, 'dirty': Dirty, 'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'), \
+            'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(), \
+            'processor': platform.processor(), 'cpus': os.cpu_count()}
+
+
+#Table of the results, with the ratios to the matching cases of Baseline if given
+def table(Results, Baseline=None):
+    Previous={}
+    for Result in (Baseline or {}).get('results', []):
+        Previous[_key(Result)]=Result
+    Lines=['{:>10}{:>8}{:>12}{:>12}{:>16}{:>12}  {}'.format('agents', 'workers', 'init (s)', 's/day', 'agent-days/s', \
+                                                              'peak (MB)', 'slowest phases')]
+    for Result in Results:
+        if 'error' in Result:
+            Lines.append('{:>10}{:>8}  failed: {}'.format(Result['agents'], Result['workers'], Result['error']))
+            continue
+        Phases=sorted(Result['phases'].items(), key=lambda Item: -Item[1])[:3]
+        Line='{:>10}{:>8}{:>12.2f}{:>12.4f}{:>16.0f}{:>12.0f}  {}'.format(Result['agents_effective'], Result['workers'], \
+                    Result['initialize_seconds'], Result['seconds_per_day'], Result['agent_days_per_second'] or 0, \
+                    Result['peak_rss_bytes']/2**20, ', '.join('{}:{:.3f}s'.format(Name, Seconds) for Name, Seconds in Phases))
+        Old=Previous.get(_key(Result))
+        if Old is not None and 'error' not in Old and Old.get('agent_days_per_second'):
+            Line+='  [x{:.2f} throughput, x{:.2f} memory vs baseline]'.format( \
+                Result['agent_days_per_second']/Old['agent_days_per_second'], Result['peak_rss_bytes']/Old['peak_rss_bytes'])
+        Lines.append(Line)
+    return '\n'.join(Lines)
+
+
+#Cases of two runs with the same key are compared
+def _key(Result):
+    return tuple(Result.get(Name) for Name in ['agents', 'workers', 'days', 'localities', 'hotspots', 'adjacency', \
+                                               'testing', 'intervention', 'active', 'seed'])
+
+
+def main():
+    Parser=argparse.ArgumentParser(description='Scaling benchmark on synthetic cities')
+    Parser.add_argument('--agents', type=int, nargs='+', default=[10000, 100000, 1000000, 10000000])
+    Parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    Parser.add_argument('--days', type=int, default=10)
+    Parser.add_argument('--localities', type=int, default=200)
+    Parser.add_argument('--hotspots', type=int, default=20)
+    Parser.add_argument('--adjacency', choices=['grid', 'planar'], default='planar')
+    Parser.add_argument('--testing', choices=['none', 'random', 'contact'], default='random')
+    Parser.add_argument('--intervention', choices=['none', 'evenodd', 'lockdown', 'quarantine'], default='quarantine')
+    Parser.add_argument('--test-fraction', type=float, default=0.001, help='daily tests per agent')
+    Parser.add_argument('--active', action='store_true', help='use the active set mode of updateState')
+    Parser.add_argument('--seed', type=int, default=0)
+    Parser.add_argument('--output', help='write the results as json to this file')
+    Parser.add_argument('--compare', help='json results of an earlier run to compare with')
+    Parser.add_argument('--json', action='store_true', help='print the results as json')
+    Args=Parser.parse_args()
+
+    sys.path.insert(0, Root)
+    Results=[]
+    for Agents in Args.agents:
+        for Workers in Args.workers:
+            Case={'agents': Agents, 'workers': Workers, 'days': Args.days, 'localities': Args.localities, \
+                  'hotspots': Args.hotspots, 'adjacency': Args.adjacency, 'testing': Args.testing, \
+                  'intervention': Args.intervention, 'test_fraction': Args.test_fraction, 'active': Args.active, \
+                  'seed': Args.seed}
+            Results.append(measure(Case))
+            if not Args.json:
+                print(table(Results[-1:]).splitlines()[-1], flush=True)
+
+    Output={'environment': environment(), 'results': Results}
+    if Args.output:
+        with open(Args.output, 'w') as f:
+            json.dump(Output, f, indent=1)
+    if Args.json:
+        print(json.dumps(Output))
+        return
+    Baseline=None
+    if Args.compare:
+        with open(Args.compare) as f:
+            Baseline=json.load(f)
+    print()
+    print(table(Results, Baseline))
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,218 @@
+#Checkpoints of a running simulation
+#A snapshot holds everything simulateStream (see evolution.py) needs to continue a run
+#  from the end of a day exactly as if it had not stopped:
+# - the mutable columns of CP (CovidState, FluState, Flags, QuarantineDay), the
+#   QuarantineIndex and the seed of the policy streams
+# - TestingHistory and InterventionsHistory
+# - the locality and hotspot counters kept by updateState
+# - the states of the random and np.random generators used by the policies
+#The population (localities, hotspots, contacts) is not stored: it is built again from
+#  the same inputs and popseed, and checked against a fingerprint kept in the snapshot.
+#The random streams of the daily update depend only on (randseed, day, block), see
+#  randomstreams.py, so they need no state.
+#
+#Snapshots are .npz files written by a background thread: at the end of a day the loop
+#  only copies the mutable arrays, and the file is written to a temporary name and
+#  renamed, so that the last complete snapshot survives a crash in the middle of a write.
+#
+#Usage:
+# Checkpoint=Checkpointer('run.ckpt.npz', Every=10)
+# drain(simulateStream(Days, ..., Checkpoint=Checkpoint), ...)
+# after a crash, with the same arguments:
+# drain(resume('run.ckpt.npz', Days, ...), ...)
+
+import os
+import json
+import pickle
+import random
+import threading
+import queue
+import zlib
+import numpy as np
+
+from interventions import QuarantineIndex
+from testinghistory import SparseTestingHistory
+from dailystats import DailyStats
+
+#Bumped whenever the content of the snapshots changes
+SnapshotVersion=1
+
+#Columns of CP that change during a simulation
+MutableArrays=['CovidState', 'FluState', 'Flags', 'QuarantineDay']
+
+
+#Fingerprint of the fixed arrays of CP, to check that a snapshot is resumed on the same population
+def populationFingerprint(CP):
+    Fingerprint=0
+    for Name in ['Locality', 'Visits', 'LocalOffsets', 'LocalIndices', 'VisitsOffsets', 'VisitsIndices']:
+        Fingerprint=zlib.crc32(np.ascontiguousarray(getattr(CP, Name)).view(np.uint8), Fingerprint)
+    return Fingerprint
+
+
+#Snapshot of the state at the end of day, as a dict of numpy arrays
+#Engine: the counters returned by engineState() in evolution.py
+def snapshot(day, CP, TestingHistory, InterventionsHistory, Engine, Fingerprint=None):
+    State={'Version': np.array(SnapshotVersion), 'Day': np.array(day), 'RandSeed': np.array(CP.RandSeed), \
+           'Fingerprint': np.array(populationFingerprint(CP) if Fingerprint is None else Fingerprint, dtype=np.int64)}
+    for Name in MutableArrays:
+        State[Name]=getattr(CP, Name).copy()
+
+    #Quarantine buckets, one array of ids per expiry day
+    Index=CP.QuarantineIndex
+    Expiries=sorted(Index.Expiries) if Index is not None else []
+    Buckets=[np.concatenate(Index.Expiries[d]) for d in Expiries]
+    State['QuarantineDuration']=np.array(Index.Duration if Index is not None else -1)
+    State['QuarantineExpiries']=np.array(Expiries, dtype=np.int64)
+    State['QuarantineOffsets']=_offsets(Buckets)
+    State['QuarantineIds']=np.concatenate([np.zeros(0, dtype=np.int64)]+Buckets)
+
+    #Tests of the days kept by TestingHistory
+    Tested=[TestingHistory.tested(j) for j in TestingHistory.days()]
+    State['TestShape']=np.array([TestingHistory.PopulationEffective, TestingHistory.NumSteps, TestingHistory.First, \
+                                 -1 if TestingHistory.Retention is None else TestingHistory.Retention])
+    State['TestOffsets']=_offsets([ids for ids, results in Tested])
+    State['TestIds']=np.concatenate([np.zeros(0, dtype=np.int32)]+[ids for ids, results in Tested])
+    State['TestResults']=np.concatenate([np.zeros(0, dtype=np.int8)]+[results for ids, results in Tested])
+
+    History=InterventionsHistory
+    State['Interventions']=np.array(json.dumps(list(History)))
+    State['StatsShape']=np.array([History.NumLocalities, History.Capacity, History.LastDay])
+    for Name in ['Positives', 'Tests', 'LocalityPositives', 'LocalityTests']:
+        State['Stats'+Name]=getattr(History, Name).copy()
+    State['LockdownStarts']=np.array(History.LockdownStarts, dtype=np.int64)
+    State['LockdownStops']=np.array(History.LockdownStops, dtype=np.int64)
+
+    for Name, Value in Engine.items():
+        State['Engine'+Name]=np.array(Value, copy=True)
+
+    State['RandomState']=np.frombuffer(pickle.dumps(random.getstate()), dtype=np.uint8)
+    State['NumpyRandomState']=np.frombuffer(pickle.dumps(np.random.get_state()), dtype=np.uint8)
+    return State
+
+
+#Writes snapshot State to Path
+def save(Path, State):
+    Temporary=Path+'.tmp'
+    with open(Temporary, 'wb') as f:
+        np.savez_compressed(f, **State)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(Temporary, Path)
+
+
+#Snapshot saved at Path
+def load(Path):
+    with np.load(Path) as Data:
+        State={Name: Data[Name] for Name in Data.files}
+    if int(State['Version'])!=SnapshotVersion:
+        raise ValueError('Snapshot '+Path+' has version '+str(int(State['Version']))+', expected '+str(SnapshotVersion))
+    return State
+
+
+#Restores snapshot State into CP and returns (TestingHistory, InterventionsHistory, Engine),
+#  Engine being the counters to pass to restoreEngineState() in evolution.py
+#Also restores the states of random and np.random
+def restore(State, CP):
+    if int(State['Fingerprint'])!=populationFingerprint(CP):
+        raise ValueError('Snapshot of day '+str(int(State['Day']))+' was taken on a different population')
+    for Name in MutableArrays:
+        getattr(CP, Name)[:]=State[Name]
+    CP.RandSeed=int(State['RandSeed'])
+
+    CP.QuarantineIndex=None
+    if int(State['QuarantineDuration'])>=0:
+        CP.QuarantineIndex=QuarantineIndex(CP, int(State['QuarantineDuration']))
+        Offsets=State['QuarantineOffsets']
+        for k, d in enumerate(State['QuarantineExpiries']):
+            CP.QuarantineIndex.Expiries[int(d)]=[State['QuarantineIds'][Offsets[k]:Offsets[k+1]]]
+
+    PopulationEffective, NumSteps, First, Retention = (int(x) for x in State['TestShape'])
+    TestingHistory=SparseTestingHistory(PopulationEffective, None, None if Retention<0 else Retention)
+    TestingHistory.First=TestingHistory.NumSteps=First
+    TestingHistory.extend(NumSteps)
+    Offsets=State['TestOffsets']
+    for k in range(len(Offsets)-1):
+        TestingHistory.record(First+k, State['TestIds'][Offsets[k]:Offsets[k+1]], State['TestResults'][Offsets[k]:Offsets[k+1]])
+
+    NumLocalities, Capacity, LastDay = (int(x) for x in State['StatsShape'])
+    InterventionsHistory=DailyStats(NumLocalities, Capacity)
+    list.extend(InterventionsHistory, json.loads(str(State['Interventions'])))
+    for Name in ['Positives', 'Tests', 'LocalityPositives', 'LocalityTests']:
+        getattr(InterventionsHistory, Name)[:]=State['Stats'+Name]
+    InterventionsHistory.LastDay=LastDay
+    InterventionsHistory.LockdownStarts=State['LockdownStarts'].tolist()
+    InterventionsHistory.LockdownStops=State['LockdownStops'].tolist()
+
+    Engine={Name[len('Engine'):]: Value for Name, Value in State.items() if Name.startswith('Engine')}
+
+    random.setstate(pickle.loads(State['RandomState'].tobytes()))
+    np.random.set_state(pickle.loads(State['NumpyRandomState'].tobytes()))
+    return TestingHistory, InterventionsHistory, Engine
+
+
+#Takes a snapshot every Every days and writes it to Path in a background thread
+#At most one snapshot waits for the writer, so a slow disk delays the loop by at most
+#  one write instead of accumulating snapshots in memory
+class Checkpointer:
+
+    def __init__(self, Path, Every=10):
+        self.Path=Path
+        self.Every=Every
+        self.Fingerprint=None
+        self.LastDay=None
+        self.Error=None
+        self.Queue=queue.Queue(maxsize=1)
+        self.Thread=threading.Thread(target=self._write, daemon=True)
+        self.Thread.start()
+
+    #Called by simulateStream at the end of every day
+    def day(self, day, CP, TestingHistory, InterventionsHistory, Engine):
+        if (day+1)%self.Every:
+            return
+        self.save(day, CP, TestingHistory, InterventionsHistory, Engine)
+
+    #Takes a snapshot now and queues it for writing
+    def save(self, day, CP, TestingHistory, InterventionsHistory, Engine):
+        self._raise()
+        if self.Fingerprint is None:
+            #The fixed arrays do not change during a run
+            self.Fingerprint=populationFingerprint(CP)
+        self.Queue.put(snapshot(day, CP, TestingHistory, InterventionsHistory, Engine, self.Fingerprint))
+
+    #Waits until the queued snapshots are written
+    def close(self):
+        if self.Thread.is_alive():
+            self.Queue.put(None)
+            self.Thread.join()
+        self._raise()
+
+    def _write(self):
+        while True:
+            State=self.Queue.get()
+            if State is None:
+                return
+            try:
+                save(self.Path, State)
+                self.LastDay=int(State['Day'])
+            except Exception as e:
+                self.Error=e
+
+    def _raise(self):
+        if self.Error is not None:
+            Error, self.Error = self.Error, None
+            raise RuntimeError('Writing checkpoint '+self.Path+' failed') from Error
+
+
+#Offsets of the concatenation of Parts
+def _offsets(Parts):
+    Offsets=np.zeros(len(Parts)+1, dtype=np.int64)
+    np.cumsum([len(Part) for Part in Parts], out=Offsets[1:])
+    return Offsets
+
+
+#Continues the run checkpointed at Path: takes the arguments of simulateStream, which
+#  must be those of the interrupted run, and yields the records of the days after the
+#  snapshot
+def resume(Path, *Args, **Kwargs):
+    from evolution import simulateStream
+    return simulateStream(*Args, Resume=load(Path), **Kwargs)
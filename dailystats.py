@@ -0,0 +1,105 @@
+#Daily aggregate statistics of a simulation
+#DailyStats is the InterventionsHistory passed to the intervention policies: it is the list
+#  of the interventions applied on each day, and it also keeps
+# - the number of positive tests and of tests conducted on each of the last Capacity days,
+#   in total and per locality, in ring buffers
+# - the days on which LockAll episodes started and stopped
+#simulate records the tests of every day after the testing policy, so that policies can
+#  query the window of days they need without looking at TestingHistory
+
+import numpy as np
+
+
+class DailyStats(list):
+
+    def __init__(self, NumLocalities, Capacity=64):
+        super().__init__()
+        self.NumLocalities=NumLocalities
+        self.Capacity=Capacity
+        self.Positives=np.zeros(Capacity, dtype=np.int64)
+        self.Tests=np.zeros(Capacity, dtype=np.int64)
+        self.LocalityPositives=np.zeros((Capacity, NumLocalities), dtype=np.int64)
+        self.LocalityTests=np.zeros((Capacity, NumLocalities), dtype=np.int64)
+        #Last day recorded, -1 before the first day
+        self.LastDay=-1
+        #Days on which LockAll was first/last applied in each episode
+        self.LockdownStarts=[]
+        self.LockdownStops=[]
+
+    #Appends the interventions of the next day and updates the lockdown episodes
+    def append(self, interventions):
+        day=len(self)
+        Locked='LockAll' in interventions
+        WasLocked=day>0 and 'LockAll' in self[day-1]
+        if Locked and not WasLocked:
+            self.LockdownStarts.append(day)
+        elif WasLocked and not Locked:
+            self.LockdownStops.append(day)
+        super().append(interventions)
+
+    #Records the tests of day from TestingHistory; CP gives the localities of the people tested
+    def recordTests(self, day, TestingHistory, CP):
+        ids, results = TestingHistory.tested(day)
+        self.record(day, CP.Locality[ids], results>0)
+
+    #Records the tests of day, given the locality index (zero-based) of every test
+    #  and whether it was positive
+    def record(self, day, Localities, Positive):
+        self.recordCounts(day, np.bincount(Localities, minlength=self.NumLocalities), \
+                          np.bincount(Localities[Positive], minlength=self.NumLocalities))
+
+    #Records the tests of day, given the number of tests and of positive tests per locality
+    def recordCounts(self, day, LocalityTests, LocalityPositives):
+        #Days skipped since the last record had no tests
+        for d in range(max(self.LastDay+1, day-self.Capacity+1), day+1):
+            self._clear(d)
+        self.LastDay=max(self.LastDay, day)
+        k=day%self.Capacity
+        self.LocalityTests[k]=LocalityTests
+        self.LocalityPositives[k]=LocalityPositives
+        self.Tests[k]=self.LocalityTests[k].sum()
+        self.Positives[k]=self.LocalityPositives[k].sum()
+
+    #Number of positive tests on day, 0 for days not recorded yet
+    def positives(self, day):
+        return int(self.Positives[self._slot(day)]) if day<=self.LastDay else 0
+
+    def tests(self, day):
+        return int(self.Tests[self._slot(day)]) if day<=self.LastDay else 0
+
+    #Per-locality number of positive tests on day
+    def localityPositives(self, day):
+        if day>self.LastDay:
+            return np.zeros(self.NumLocalities, dtype=np.int64)
+        return self.LocalityPositives[self._slot(day)].copy()
+
+    def localityTests(self, day):
+        if day>self.LastDay:
+            return np.zeros(self.NumLocalities, dtype=np.int64)
+        return self.LocalityTests[self._slot(day)].copy()
+
+    #Sum of the positive tests of days first..last
+    def positivesBetween(self, first, last):
+        return sum(self.positives(d) for d in range(first, last+1))
+
+    #Change of the positive tests over changeTime days, summed over a window of days
+    #  ending on day and normalized by window*changeTime
+    def slope(self, day, window, changeTime):
+        return sum([self.positives(day-j)-self.positives(day-changeTime-j) \
+                    for j in range(min(window, day+1-changeTime))])/(window*changeTime)
+
+    #First day of the last LockAll episode, None if there was none
+    def lockdownStart(self):
+        return self.LockdownStarts[-1] if self.LockdownStarts else None
+
+    def _slot(self, day):
+        if day<0 or day<=self.LastDay-self.Capacity:
+            raise IndexError('day '+str(day)+' is not in the last '+str(self.Capacity)+' days recorded')
+        return day%self.Capacity
+
+    def _clear(self, day):
+        k=day%self.Capacity
+        self.Positives[k]=0
+        self.Tests[k]=0
+        self.LocalityPositives[k]=0
+        self.LocalityTests[k]=0
@@ -0,0 +1,596 @@
+#Locality-sharded simulation across processes or hosts
+#The agents are split into shards of whole localities (contiguous rows of CD, balanced by
+#  number of agents). Each shard is a process that builds and owns the agents of its
+#  localities: their states, contacts, quarantines and tests. A shard holds no array over
+#  the whole population, so its memory grows with its own agents (see InitializeArrays);
+#  building its hotspot contacts still draws the visits of the other localities, one at a
+#  time, which takes time proportional to the population. A coordinator runs the
+#  intervention policy and the testing budget, and each day exchanges with the shards
+#  only what the model needs across localities:
+# - the infected agents per locality and per hotspot, summed over the shards, from which
+#   every shard computes CovidPerNeighborhood and the hotspot rates (see updateState)
+# - the exposures along fixed contacts whose target lives on another shard
+# - the people to quarantine on another shard (contacts of positives) under Quarantine
+# - the reported symptomatic people per locality and the tests allotted to each locality
+#Shard messages go through the coordinator, over a pluggable transport: PipeTransport
+#  runs the shards as local processes, SocketTransport accepts shards connecting over
+#  TCP, from this host or from others started with
+#  COVIDSIM_AUTHKEY=<key> python distributed.py shard <host> <port>
+#
+#Every locality draws its daily update and its tests from its own random streams
+#  (wardGenerator, see randomstreams.py), so the results for a given seed do not depend
+#  on the number of shards or on the transport. The population and the initial
+#  infections are those of simulate for the same popseed and randseed, but the daily
+#  draws differ, so the results follow the same distribution as those of simulate
+#  without being equal to them.
+#Differences with simulate:
+# - intervention policies run on the coordinator, which holds no agents: they are called
+#   as policy(None, InterventionsHistory, None, day). InterventionQuarantine is replaced
+#   by ShardedQuarantine, whose Quarantine intervention makes the shards quarantine the
+#   positives of the day before and their contacts
+# - testing is RandomSymptomaticTesting (TestingBudget, FalseNegative, LocationRepProb)
+# - the records carry no TestingHistory, which is split over the shards
+#
+#Usage:
+# Cases, Symptomatic, Localities = simulateSharded(120, 10000000, ModelParams, CD, CarProb,
+#     InterventionLockdown, 1000, 0.0, np.ones(CD.shape[0]), NumShards=8)
+# drain(simulateShardedStream(..., Transport=SocketTransport(('0.0.0.0', 6000), Spawn=False)), DailyPrint())
+
+import os
+import sys
+import pickle
+import argparse
+import traceback
+import multiprocessing as mp
+from multiprocessing.connection import Listener, Client
+import numpy as np
+
+from evolution import InitializeArrays, InfectionStage, HistoryRetention, localityNeighbors, InfectRate
+from interventions import InterventionRule, InterventionQuarantine, quarantine, quarantineIndex
+from population import CityPopulation, localityNames, gatherContacts, StateS, StateE, StateI, StateR, FluStateS, FluStateI, PositiveBit
+from randomstreams import initGenerator, policyGenerator, wardGenerator
+from testinghistory import SparseTestingHistory
+from dailystats import DailyStats
+from tests import TestingStream, symptomaticMask
+from sinks import drain, DailyPrint, SeriesCollector
+from profiling import Profiler as DayProfiler
+
+#Streams of wardGenerator
+UpdateStream, ReportStream = 0, 1
+
+#Environment variable holding the key shards use to connect to a SocketTransport
+AuthkeyVariable='COVIDSIM_AUTHKEY'
+
+
+#Quarantine policy of the coordinator, used in place of InterventionQuarantine
+#The shards quarantine the people who tested positive on day-1 and their contacts
+def ShardedQuarantine(TestingHistory, InterventionsHistory, CP, day):
+    return ['Quarantine']
+
+
+#Coordinator policies replacing the policies that need the agents
+CoordinatorPolicies={InterventionQuarantine: ShardedQuarantine}
+
+
+#Splits the rows of CD into NumShards contiguous ranges with about the same number of agents
+#Output: list of (first, last+1) rows, at most one shard per row
+def partitionRows(CD, Population, NumShards):
+    NumLocalities=CD.shape[0]
+    NumShards=max(1, min(NumShards, NumLocalities))
+    Counts=(Population*CD['locality_density'].to_numpy()).astype(np.int64)
+    Cumulative=np.cumsum(Counts)
+    Cuts=np.searchsorted(Cumulative, Cumulative[-1]*np.arange(1, NumShards)/NumShards)+1
+    #Every shard gets at least one row
+    Cuts=np.maximum(Cuts, np.arange(1, NumShards))
+    Cuts=np.minimum(Cuts, NumLocalities-NumShards+np.arange(1, NumShards))
+    Cuts=np.maximum.accumulate(Cuts)
+    Bounds=np.concatenate(([0], Cuts, [NumLocalities])).tolist()
+    return [(Bounds[k], Bounds[k+1]) for k in range(NumShards)]
+
+
+# ===================================================================================
+#The agents of one shard: rows First..Last-1 of CD, global ids Lo..Hi-1
+#CP holds them with local ids 0..Hi-Lo-1; its contacts are global ids, and its in-contact
+#  arrays are left empty
+class Shard:
+
+    def __init__(self, Shard, Bounds, Rows, NumSteps, Population, ModelParams, CD, CarProb, \
+                 InitialCovid, InitialFlu, TestingHistoryArgs, FalseNegative, LocationRepProb, randseed, popseed):
+        self.Shard=Shard
+        #First global id of every shard, and the end of the last one
+        self.Bounds=np.asarray(Bounds, dtype=np.int64)
+        self.ModelParams=ModelParams
+        self.RandSeed=randseed
+        self.FalseNegative=FalseNegative
+        self.LocationRepProb=np.asarray(LocationRepProb, dtype=float)
+
+        Arrays=InitializeArrays(CD, CarProb, ModelParams, Population, popseed, Rows)
+        self.Lo, self.Hi = Arrays['Lo'], Arrays['Hi']
+        Starts=Arrays['Starts']
+        LocalityNames, NeighborhoodNames = localityNames(CD)
+        Empty=np.zeros(0, dtype=np.int32)
+        n=self.Hi-self.Lo
+        self.CP=CityPopulation(LocalityNames, NeighborhoodNames, \
+                               CovidState=np.zeros(n, dtype=np.int8), FluState=np.zeros(n, dtype=np.int8), \
+                               Locality=(Arrays['LocalityIndex']-1).astype(np.int16), \
+                               Visits=np.asarray(Arrays['Visits'], dtype=np.int16), \
+                               Flags=np.zeros(n, dtype=np.uint8), QuarantineDay=np.full(n, -1, dtype=np.int16), \
+                               LocalOffsets=Arrays['LocalOffsets'], LocalIndices=Arrays['LocalIndices'], \
+                               VisitsOffsets=Arrays['VisitsOffsets'], VisitsIndices=Arrays['VisitsIndices'], \
+                               LocalInOffsets=np.zeros(1, dtype=np.int64), LocalInIndices=Empty, \
+                               VisitsInOffsets=np.zeros(1, dtype=np.int64), VisitsInIndices=Empty)
+        self.CP.RandSeed=randseed
+        self.TestingHistory=SparseTestingHistory(n, *TestingHistoryArgs)
+
+        #Localities of the shard: (locality index, first local id, end local id)
+        LocalityIds=CD['locality_id'].to_numpy(dtype=np.int64)
+        self.Wards=[(int(LocalityIds[r]-1), int(Starts[r]-self.Lo), int(Starts[r+1]-self.Lo)) for r in range(*Rows)]
+
+        #Pool sizes of InfectRate; the hotspot sizes are summed over the shards by setPools
+        self.NumLocalities=CD.shape[0]
+        self.NumHotspots=len(CarProb[0])
+        self.NeighborRows, self.NeighborCols = localityNeighbors(CD)
+        PeoplePerLocality=np.zeros(self.NumLocalities)
+        PeoplePerLocality[LocalityIds-1]=np.diff(Starts)
+        self.PeoplePerNeighborhood=np.bincount(self.NeighborRows, weights=PeoplePerLocality[self.NeighborCols], \
+                                               minlength=self.NumLocalities)
+        self.PeoplePerHotspot=np.bincount(self.CP.Visits, minlength=self.NumHotspots)
+
+        #Initial infections, drawn as in InitInfection
+        for i, lo, hi in self.Wards:
+            if hi-lo<InitialCovid[i] or hi-lo<InitialFlu[i]:
+                raise ValueError('Population in locality '+str(i+1)+' too small for sampling initially infected')
+            rng=initGenerator(randseed, InfectionStage, i)
+            Sample=rng.choice(np.arange(lo, hi), size=max(InitialCovid[i], InitialFlu[i]), replace=False)
+            self.CP.CovidState[Sample[:InitialCovid[i]]]=StateE
+            self.CP.FluState[Sample[:InitialFlu[i]]]=FluStateI
+
+        self.Day=None
+        self.Interventions=[]
+        self.Reported=[]
+
+    #Agents of the shard and their partial counters, see counts
+    def setup(self):
+        return self.Hi-self.Lo, self.PeoplePerHotspot, self.counts()
+
+    #Sets the hotspot sizes summed over the shards
+    def setPools(self, PeoplePerHotspot):
+        self.PeoplePerHotspot=PeoplePerHotspot
+
+    #Starts day: releases the expired quarantines and, under Quarantine, quarantines the
+    #  positives of day-1 and their contacts
+    #CovidPerLocality, CovidPerHotspot: infected agents summed over the shards
+    #Output: the global ids to quarantine, per owner shard
+    def start(self, day, interventions, CovidPerLocality, CovidPerHotspot):
+        self.Day=day
+        self.Interventions=interventions
+        self.CovidPerNeighborhood=np.bincount(self.NeighborRows, weights=CovidPerLocality[self.NeighborCols], \
+                                              minlength=self.NumLocalities)
+        self.CovidPerHotspot=CovidPerHotspot
+        self.TestingHistory.advance(day)
+        quarantineIndex(self.CP).release(day)
+        ids=np.zeros(0, dtype=np.int64)
+        if 'Quarantine' in interventions and day>=1:
+            Positives=self.TestingHistory.positives(day-1)
+            LocalSources, LocalContacts = gatherContacts(self.CP.LocalOffsets, self.CP.LocalIndices, Positives)
+            VisitsSources, VisitsContacts = gatherContacts(self.CP.VisitsOffsets, self.CP.VisitsIndices, Positives)
+            ids=np.concatenate((Positives+self.Lo, LocalContacts, VisitsContacts))
+        return self.route(ids)
+
+    #Quarantines the global ids Quarantined received from all shards, then updates the
+    #  agents of every locality by one day
+    #Output: the exposure targets (global ids) per owner shard, number of agents updated
+    def update(self, Quarantined):
+        if len(Quarantined):
+            quarantine(self.CP, Quarantined-self.Lo, self.Day-1)
+        self.CovidStateNext=self.CP.CovidState.copy()
+        self.FluStateNext=self.CP.FluState.copy()
+        Targets=[np.zeros(0, dtype=np.int64)]
+        for i, lo, hi in self.Wards:
+            Targets.append(self.updateWard(lo, hi, wardGenerator(self.RandSeed, self.Day, i, UpdateStream)))
+        return self.route(np.concatenate(Targets)), self.Hi-self.Lo
+
+    #Updates the agents lo..hi-1 by one day, as updateAgents in evolution.py
+    #The exposures along fixed contacts are drawn for all contacts, whatever their state;
+    #  they are applied by expose to the targets susceptible at the start of the day
+    #Output: global ids of the exposure targets
+    def updateWard(self, lo, hi, rng):
+        CP=self.CP
+        ModelParams=self.ModelParams
+        ids=np.arange(lo, hi)
+        Covid=CP.CovidState[lo:hi]
+        Flu=CP.FluState[lo:hi]
+        Hotspot=CP.Visits[lo:hi]
+
+        localspread, globalspread = InterventionRule(self.Interventions, CP, ids)
+        globalspread &= Hotspot<self.NumHotspots-1
+
+        #One uniform draw per agent for flu, covid progression, neighborhood and hotspot
+        Draws=rng.random((4, hi-lo))
+
+        FluStateOut=Flu.copy()
+        FluStateOut[(Flu==FluStateS) & (Draws[0]<ModelParams["FluRateVector"][0])]=FluStateI
+        FluStateOut[(Flu==FluStateI) & (Draws[0]<ModelParams["FluRateVector"][1])]=FluStateS
+
+        CovidStateOut=Covid.copy()
+        CovidStateOut[(Covid==StateE) & (Draws[1]<ModelParams["CovidRateVector"][0])]=StateI
+        CovidStateOut[(Covid==StateI) & (Draws[1]<ModelParams["CovidRateVector"][1])]=StateR
+
+        Susceptible=Covid==StateS
+        p=ModelParams["CovidInfectionRate"]
+
+        #LocalSpread, all agents of the range are in the same locality
+        NeighborhoodRate=InfectRate(self.PeoplePerNeighborhood, self.CovidPerNeighborhood, ModelParams["NeighborhoodContact"], p)
+        CovidStateOut[Susceptible & localspread & (Draws[2]<NeighborhoodRate[CP.Locality[lo]])]=StateE
+
+        #GlobalSpread
+        HotspotRate=InfectRate(self.PeoplePerHotspot, self.CovidPerHotspot, ModelParams["HotspotContact"], p)
+        CovidStateOut[Susceptible & globalspread & (Draws[3]<HotspotRate[Hotspot])]=StateE
+
+        self.CovidStateNext[lo:hi]=CovidStateOut
+        self.FluStateNext[lo:hi]=FluStateOut
+
+        #Fixed contacts of infected agents, using the states at the start of the day
+        Infected=Covid==StateI
+        TargetParts=[]
+        for Offsets, Indices, Spread in ((CP.LocalOffsets, CP.LocalIndices, localspread), \
+                                         (CP.VisitsOffsets, CP.VisitsIndices, globalspread)):
+            Sources, Targets = gatherContacts(Offsets, Indices, ids[Infected & Spread])
+            TargetParts.append(Targets[rng.random(len(Targets))<p].astype(np.int64))
+        return np.concatenate(TargetParts)
+
+    #Applies the exposures Targets (global ids) received from all shards, ends the update
+    #  of the day and draws the reported symptomatic people of every locality
+    #Output: the partial counters (see counts), the number of reported symptomatic people
+    #  per locality and the number of exposures applied
+    def expose(self, Targets):
+        Targets=Targets-self.Lo
+        Targets=Targets[self.CP.CovidState[Targets]==StateS]
+        self.CovidStateNext[Targets]=StateE
+        self.CP.CovidState[:]=self.CovidStateNext
+        self.CP.FluState[:]=self.FluStateNext
+
+        #Reported symptomatic people, drawn as in reportedSymptomatic with one stream per locality
+        Mask=symptomaticMask(self.CP)
+        Reported=np.zeros(self.NumLocalities, dtype=np.int64)
+        self.Reported=[]
+        for i, lo, hi in self.Wards:
+            rng=wardGenerator(self.RandSeed, self.Day, i, ReportStream)
+            ids=lo+np.flatnonzero(Mask[lo:hi])
+            ids=ids[rng.random(len(ids))<self.LocationRepProb[i]]
+            Reported[i]=len(ids)
+            self.Reported.append((i, ids, rng))
+        return self.counts(), Reported, len(Targets)
+
+    #Tests Quota[i] of the reported symptomatic people of locality i, chosen at random
+    #People testing positive are marked CovidPositive and quarantined
+    #Output: tests and positive tests per locality, agents in quarantine
+    def test(self, Quota):
+        Tests=np.zeros(self.NumLocalities, dtype=np.int64)
+        Positives=np.zeros(self.NumLocalities, dtype=np.int64)
+        Tested=[np.zeros(0, dtype=np.int64)]
+        Results=[np.zeros(0, dtype=np.int8)]
+        for i, ids, rng in self.Reported:
+            if Quota[i]<len(ids):
+                ids=rng.choice(ids, Quota[i], replace=False)
+            Positive=(self.CP.CovidState[ids]==StateI) & (rng.random(len(ids))<(1-self.FalseNegative))
+            Tests[i]=len(ids)
+            Positives[i]=np.count_nonzero(Positive)
+            Tested.append(ids)
+            Results.append(np.where(Positive, 1, -1).astype(np.int8))
+            self.CP.setFlag(PositiveBit, ids[Positive], 1)
+            quarantine(self.CP, ids[Positive], self.Day)
+        self.TestingHistory.record(self.Day, np.concatenate(Tested), np.concatenate(Results))
+        self.Reported=[]
+        return Tests, Positives, int(np.count_nonzero(self.CP.quarantined()))
+
+    #Infected agents per locality and per hotspot and symptomatic agents per locality
+    def counts(self):
+        Infected=self.CP.CovidState==StateI
+        return np.bincount(self.CP.Locality[Infected], minlength=self.NumLocalities), \
+               np.bincount(self.CP.Locality[Infected | (self.CP.FluState==FluStateI)], minlength=self.NumLocalities), \
+               np.bincount(self.CP.Visits[Infected], minlength=self.NumHotspots)
+
+    #Splits the global ids by the shard that owns them
+    def route(self, ids):
+        Owner=np.searchsorted(self.Bounds, ids, side='right')-1
+        Order=np.argsort(Owner, kind='stable')
+        Ends=np.searchsorted(Owner[Order], np.arange(len(self.Bounds)))
+        return [ids[Order[Ends[k]:Ends[k+1]]] for k in range(len(self.Bounds)-1)]
+
+
+#Methods of Shard the coordinator can call
+ShardMethods=['setup', 'setPools', 'start', 'update', 'expose', 'test']
+
+
+#Serves the coordinator at the other end of Connection until it sends stop
+#Messages are pickled tuples (method, arguments); the first one, ('init', arguments),
+#  builds the Shard. Replies are ('ok', result) or ('error', traceback)
+def serveShard(Connection):
+    Instance=None
+    try:
+        while True:
+            Method, Args = pickle.loads(Connection.recv_bytes())
+            if Method=='stop':
+                break
+            try:
+                if Method=='init':
+                    Instance=Shard(*Args)
+                    Reply=('ok', None)
+                elif Method in ShardMethods and Instance is not None:
+                    Reply=('ok', getattr(Instance, Method)(*Args))
+                else:
+                    Reply=('error', 'Unknown shard method '+str(Method))
+            except Exception:
+                Reply=('error', traceback.format_exc())
+            Connection.send_bytes(pickle.dumps(Reply, protocol=pickle.HIGHEST_PROTOCOL))
+    except EOFError:
+        pass
+    finally:
+        Connection.close()
+
+
+#Connects to the coordinator listening at Address and serves it
+def connectShard(Address, Authkey):
+    serveShard(Client(tuple(Address), authkey=Authkey))
+
+
+# ===================================================================================
+#Transports: open(NumShards) returns one connection per shard, with the send_bytes and
+#  recv_bytes methods of multiprocessing connections, and close() releases the shards
+
+#Shards run as local processes, connected by pipes
+class PipeTransport:
+
+    def __init__(self, Context=None):
+        self.Context=mp.get_context(Context)
+        self.Processes=[]
+
+    def open(self, NumShards):
+        Connections=[]
+        for k in range(NumShards):
+            Parent, Child = self.Context.Pipe()
+            Process=self.Context.Process(target=serveShard, args=(Child,), daemon=True)
+            Process.start()
+            Child.close()
+            self.Processes.append(Process)
+            Connections.append(Parent)
+        return Connections
+
+    def close(self):
+        _join(self.Processes)
+        self.Processes=[]
+
+
+#Shards connect over TCP to a listener at Address
+#Spawn: start the shards as local processes (e.g. a loopback test of a multi-host run);
+#  otherwise start one shard per host with
+#  COVIDSIM_AUTHKEY=<Authkey> python distributed.py shard <host> <port>
+#Authkey: key the shards must present, random when Spawn is set, read from COVIDSIM_AUTHKEY
+#  otherwise
+class SocketTransport:
+
+    def __init__(self, Address=('127.0.0.1', 0), Authkey=None, Spawn=True, Context=None):
+        self.Address=Address
+        self.Spawn=Spawn
+        if Authkey is None:
+            Authkey=os.urandom(16).hex() if Spawn else os.environ.get(AuthkeyVariable)
+        if not Authkey:
+            raise ValueError('SocketTransport needs an Authkey or the environment variable '+AuthkeyVariable)
+        self.Authkey=Authkey.encode() if isinstance(Authkey, str) else Authkey
+        self.Context=mp.get_context(Context)
+        self.Processes=[]
+        self.Listener=None
+
+    def open(self, NumShards):
+        self.Listener=Listener(self.Address, authkey=self.Authkey)
+        Host, Port = self.Listener.address
+        if self.Spawn:
+            for k in range(NumShards):
+                Process=self.Context.Process(target=connectShard, args=((Host, Port), self.Authkey), daemon=True)
+                Process.start()
+                self.Processes.append(Process)
+        else:
+            print('Waiting for '+str(NumShards)+' shards: '+AuthkeyVariable+'=<key> python distributed.py shard '+ \
+                  str(Host)+' '+str(Port))
+        return [self.Listener.accept() for k in range(NumShards)]
+
+    def close(self):
+        if self.Listener is not None:
+            self.Listener.close()
+            self.Listener=None
+        _join(self.Processes)
+        self.Processes=[]
+
+
+def _join(Processes):
+    for Process in Processes:
+        Process.join(timeout=30)
+        if Process.is_alive():
+            Process.terminate()
+            Process.join()
+
+
+# ===================================================================================
+#The coordinator's side of the shards: calls a method on all shards at once
+class _Shards:
+
+    def __init__(self, Connections):
+        self.Connections=Connections
+        self.Bytes=0
+
+    #Sends ArgsPerShard[k] to shard k and returns the replies, in shard order
+    def call(self, Method, ArgsPerShard):
+        for Connection, Args in zip(self.Connections, ArgsPerShard):
+            Message=pickle.dumps((Method, Args), protocol=pickle.HIGHEST_PROTOCOL)
+            self.Bytes+=len(Message)
+            Connection.send_bytes(Message)
+        Results=[]
+        Errors=[]
+        for k, Connection in enumerate(self.Connections):
+            Message=Connection.recv_bytes()
+            self.Bytes+=len(Message)
+            Status, Result = pickle.loads(Message)
+            if Status!='ok':
+                Errors.append('Shard '+str(k)+': '+Result)
+            Results.append(Result)
+        if Errors:
+            raise RuntimeError('\n'.join(Errors))
+        return Results
+
+    #Sends the same arguments to all shards
+    def broadcast(self, Method, *Args):
+        return self.call(Method, [Args]*len(self.Connections))
+
+    #Routes the per-destination parts returned by every shard to their destinations
+    def exchange(self, Method, Routed, *Args):
+        Incoming=[np.concatenate([np.zeros(0, dtype=np.int64)]+[Parts[k] for Parts in Routed]) \
+                  for k in range(len(self.Connections))]
+        return self.call(Method, [(ids,)+Args for ids in Incoming])
+
+    def stop(self):
+        for Connection in self.Connections:
+            try:
+                Connection.send_bytes(pickle.dumps(('stop', ())))
+                Connection.close()
+            except OSError:
+                pass
+
+
+#Locality-sharded version of simulate
+#Inputs: as simulate, except
+# TestingBudget, FalseNegative, LocationRepProb: the arguments of RandomSymptomaticTesting
+#   (LocationRepProb is 1 for all localities by default, TestingBudget 0 runs no tests)
+# NumShards: number of shards; the localities are split by partitionRows
+# Transport: a PipeTransport (by default) or SocketTransport
+#Output: CovidCases, Symptomatic (localities x days float arrays), localities
+def simulateSharded(NumSteps, Population, ModelParams, CD, CarProb, interventionPolicy, TestingBudget=0, FalseNegative=0.0, \
+                    LocationRepProb=None, InitCovidCounts=None, InitFluCounts=None, NumShards=2, Transport=None, \
+                    randseed=0, popseed=None, Profiler=None):
+    Series=SeriesCollector(CD.shape[0], NumSteps)
+    drain(simulateShardedStream(NumSteps, Population, ModelParams, CD, CarProb, interventionPolicy, TestingBudget, \
+                                FalseNegative, LocationRepProb, InitCovidCounts, InitFluCounts, NumShards, Transport, \
+                                randseed, popseed, Profiler=Profiler), \
+          Series, DailyPrint())
+    return Series['CovidCases'].astype(float), Series['Symptomatic'].astype(float), CD['locality_name'].to_numpy()
+
+
+#Generator version of simulateSharded, yielding the DailyRecord of every day as
+#  simulateStream (see sinks.py)
+#The phases of a day are start (quarantines and counters), update, expose and testing,
+#  each including the exchange with the shards; the counters are Agents, Exposures,
+#  CrossShardExposures (exposures sent to another shard), Tests, PositiveTests,
+#  Quarantined and BytesExchanged (pickled messages between the coordinator and shards)
+#Retention: days of tests kept by the shards, as for simulateStream
+def simulateShardedStream(NumSteps, Population, ModelParams, CD, CarProb, interventionPolicy, TestingBudget=0, \
+                          FalseNegative=0.0, LocationRepProb=None, InitCovidCounts=None, InitFluCounts=None, NumShards=2, \
+                          Transport=None, randseed=0, popseed=None, Retention=None, Profiler=None):
+    if Profiler is None:
+        Profiler=DayProfiler()
+    if Transport is None:
+        Transport=PipeTransport()
+    if popseed is None:
+        popseed=randseed
+    if LocationRepProb is None:
+        LocationRepProb=np.ones(CD.shape[0])
+    interventionPolicy=CoordinatorPolicies.get(interventionPolicy, interventionPolicy)
+    NumLocalities=CD.shape[0]
+    InitialCovid=list(InitCovidCounts) if InitCovidCounts else [np.mod(i,2) for i in range(NumLocalities)]
+    InitialFlu=list(InitFluCounts) if InitFluCounts else [0 for i in range(NumLocalities)]
+    if NumSteps is None and Retention is None:
+        Retention=HistoryRetention
+
+    Profiler.start(0)
+    Profiler.begin('initialize')
+    Partition=partitionRows(CD, Population, NumShards)
+    Counts=(Population*CD['locality_density'].to_numpy()).astype(np.int64)
+    Starts=np.concatenate(([0], np.cumsum(Counts)))
+    Bounds=[int(Starts[First]) for First, Last in Partition]+[int(Starts[-1])]
+    print('Initializing '+str(Population)+' agents on '+str(len(Partition))+' shards...')
+
+    Shards=_Shards(Transport.open(len(Partition)))
+    try:
+        Shards.call('init', [(k, Bounds, Rows, NumSteps, Population, ModelParams, CD, CarProb, InitialCovid, InitialFlu, \
+                              (NumSteps, Retention), FalseNegative, LocationRepProb, randseed, popseed) \
+                             for k, Rows in enumerate(Partition)])
+        Setup=Shards.broadcast('setup')
+        Shards.broadcast('setPools', sum(PeoplePerHotspot for Agents, PeoplePerHotspot, Counters in Setup))
+        CovidPerLocality, SymptomaticPerLocality, CovidPerHotspot = (sum(Part) for Part in \
+                                                                     zip(*[Counters for Agents, PeoplePerHotspot, Counters in Setup]))
+        InterventionsHistory=DailyStats(len(localityNames(CD)[0]))
+        Profiler.end('initialize')
+        Profiler.count('BytesExchanged', Shards.Bytes)
+        Shards.Bytes=0
+        print("Initialized random infection seed")
+
+        day=0
+        while NumSteps is None or day<NumSteps:
+            with Profiler.phase('start'):
+                interventions=interventionPolicy(None, InterventionsHistory, None, day)
+                InterventionsHistory.append(interventions)
+                Routed=Shards.broadcast('start', day, interventions, CovidPerLocality, CovidPerHotspot)
+
+            with Profiler.phase('update'):
+                Results=Shards.exchange('update', Routed)
+            Routed=[Parts for Parts, Agents in Results]
+            Profiler.count('Agents', sum(Agents for Parts, Agents in Results))
+            CrossShard=sum(len(Parts[j]) for k, Parts in enumerate(Routed) for j in range(len(Parts)) if j!=k)
+
+            with Profiler.phase('expose'):
+                Results=Shards.exchange('expose', Routed)
+            CovidPerLocality, SymptomaticPerLocality, CovidPerHotspot = (sum(Part) for Part in \
+                                                                         zip(*[Counters for Counters, Reported, Exposures in Results]))
+            Reported=sum(Reported for Counters, Reported, Exposures in Results)
+
+            with Profiler.phase('testing'):
+                #The budget is split over the localities as by a random choice among all the reported people
+                if Reported.sum()>TestingBudget:
+                    Quota=policyGenerator(randseed, day, TestingStream).multivariate_hypergeometric(Reported, TestingBudget)
+                else:
+                    Quota=Reported
+                Tested=Shards.broadcast('test', Quota)
+                LocalityTests=sum(Tests for Tests, Positives, Quarantined in Tested)
+                LocalityPositives=sum(Positives for Tests, Positives, Quarantined in Tested)
+                InterventionsHistory.recordCounts(day, LocalityTests, LocalityPositives)
+
+            Profiler.count('Exposures', sum(Exposures for Counters, Reported, Exposures in Results))
+            Profiler.count('CrossShardExposures', CrossShard)
+            Profiler.count('Tests', int(LocalityTests.sum()))
+            Profiler.count('PositiveTests', int(LocalityPositives.sum()))
+            Profiler.count('Quarantined', sum(Quarantined for Tests, Positives, Quarantined in Tested))
+            Profiler.add('BytesExchanged', Shards.Bytes)
+            Shards.Bytes=0
+            Profile=Profiler.finish()
+
+            yield {'Day': day, 'CovidCases': CovidPerLocality.astype(np.int32), \
+                   'Symptomatic': SymptomaticPerLocality.astype(np.int32), \
+                   'PositiveTests': InterventionsHistory.localityPositives(day).astype(np.int32), \
+                   'Tests': InterventionsHistory.localityTests(day).astype(np.int32), \
+                   'Interventions': list(interventions), 'Seconds': Profile['Seconds'], \
+                   'Phases': Profile['Phases'], 'Setup': Profile['Setup'], 'Counters': Profile['Counters']}
+            day+=1
+            Profiler.start(day)
+    finally:
+        Shards.stop()
+        Transport.close()
+        Profiler.close()
+
+
+# ===================================================================================
+#Command line: serves a coordinator as one shard
+# COVIDSIM_AUTHKEY=<key> python distributed.py shard <host> <port>
+def main(Arguments=None):
+    Parser=argparse.ArgumentParser(description='Shard of a locality-sharded simulation (see distributed.py)')
+    Commands=Parser.add_subparsers(dest='Command', required=True)
+    ShardParser=Commands.add_parser('shard', help='connect to the coordinator at host:port and serve it')
+    ShardParser.add_argument('host')
+    ShardParser.add_argument('port', type=int)
+    Args=Parser.parse_args(Arguments)
+    Authkey=os.environ.get(AuthkeyVariable)
+    if not Authkey:
+        sys.exit('Set '+AuthkeyVariable+' to the key of the coordinator')
+    connectShard((Args.host, Args.port), Authkey.encode())
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,397 @@
+#Monte Carlo ensembles of simulations over a grid of parameters
+#An ensemble is described by a spec (a dict, or a json file for the command line):
+# Grid: dict of parameter name -> list of values; every combination is a cell
+# Replicates: number of runs of every cell
+# Seed: base seed; replicate r of a cell runs with a seed derived from (Seed, cell, r)
+# Params, ModelParams: parameters shared by all cells (see Defaults and DefaultModelParams)
+# CityData, CarProb: input files passed to setupcitydata
+# PopulationCache: optional directory of a PopulationCache (see popcache.py), where runs
+#   with the same population (same PopulationSeed) find it already built
+# PopulationCacheBytes: size limit of the cache
+# SaveRuns: if true, the full outputs of every run are also added to the ResultStore
+#   OutputDir/results (see resultstore.py)
+#Parameters are the entries of Defaults and of DefaultModelParams, so that a grid can sweep
+#  e.g. TestingBudget, FalseNegative, Seeding, InterventionPolicy or CovidInfectionRate
+#
+#The summary of every run is appended as one json line to summaries.jsonl in the output
+#  directory, and runs found there are skipped, so that an interrupted ensemble resumes
+#  where it stopped. Runs are spread over a process pool (runEnsemble), or over any number
+#  of processes and machines sharing the output directory through a job queue of files
+#  (enqueue and work)
+#
+#Command line:
+# python ensemble.py run spec.json OutputDir [--processes P]
+# python ensemble.py enqueue spec.json OutputDir
+# python ensemble.py work OutputDir
+# python ensemble.py status OutputDir
+
+import os
+import json
+import hashlib
+import itertools
+import contextlib
+import argparse
+import socket
+import time
+import timeit
+import threading
+import multiprocessing as mp
+from functools import partial
+import numpy as np
+
+import interventions
+import tests
+from evolution import simulate
+from randomstreams import runSeed
+from popcache import PopulationCache
+from resultstore import ResultStore
+
+
+#Parameters of a run and their default values
+Defaults = {\
+    "Days": 100, \
+    "Population": 100000, \
+    #Name of the testing policy in tests.py, called with (TestingBudget, FalseNegative, LocationRepProb)
+    "TestingPolicy": "RandomSymptomaticTesting", \
+    "TestingBudget": 50, \
+    "FalseNegative": 0.0, \
+    #Reporting probability of every locality
+    "LocationRepProb": 1.0, \
+    #Name of the intervention policy in interventions.py
+    "InterventionPolicy": "InterventionQuarantine", \
+    #Initial infections: 'uniform' or 'clustered', as in exampleRST-Quarantine.py
+    "Seeding": "uniform", \
+    "InitFracLocalitiesCovid": 0.1, \
+    "InitFracLocalitiesFlu": 0.1, \
+    "CovidMaxPerLocality": 5, \
+    "FluMaxPerLocality": 20, \
+    "SeedLocalityID": 120, \
+    "InitNumSeedsCovid": 50, \
+    #Seed of the population; None gives every replicate its own population
+    "PopulationSeed": None, \
+    #Workers of simulate; runs in a pool use 1
+    "NumWorkers": 1}
+
+DefaultModelParams = {\
+    "CovidInfectionRate": 0.1, \
+    "CovidRateVector": [1, 1/8], \
+    "FluRateVector": [0.02, 1/8], \
+    "NeighborhoodContact": 1, \
+    "NeighborhoodContactFixed": 5, \
+    "HotspotContact": 2, \
+    "HotspotContactFixed": 10}
+
+SummaryFile='summaries.jsonl'
+QueueDirectory='queue'
+LogDirectory='logs'
+ResultsDirectory='results'
+
+
+#List of the runs of the ensemble Spec
+#Each run is a dict with the run id, the cell parameters, the replicate and its seed
+def ensembleRuns(Spec):
+    Grid=Spec.get('Grid', {})
+    for Name in Grid:
+        if Name not in Defaults and Name not in DefaultModelParams:
+            raise ValueError('Unknown parameter '+Name+' in the grid')
+    Names=sorted(Grid)
+    Runs=[]
+    for Values in itertools.product(*[Grid[Name] for Name in Names]):
+        Cell=dict(zip(Names, Values))
+        CellId=cellId(Cell)
+        for r in range(Spec.get('Replicates', 1)):
+            Runs.append({'Run': CellId+'-'+str(r), 'Cell': Cell, 'Replicate': r, \
+                         'Seed': runSeed(Spec.get('Seed', 0), int(CellId, 16), r)})
+    return Runs
+
+
+#Stable id of a cell: it depends only on its parameters, not on the rest of the grid
+def cellId(Cell):
+    return hashlib.sha1(json.dumps(Cell, sort_keys=True).encode()).hexdigest()[:12]
+
+
+#Runs the ensemble Spec over a pool of Processes processes
+#Runs already in the summaries of OutputDir are skipped
+#Output: list of the summaries of all runs of the ensemble
+def runEnsemble(Spec, OutputDir, Processes=None):
+    os.makedirs(OutputDir, exist_ok=True)
+    Runs=pendingRuns(Spec, OutputDir)
+    print('Ensemble: '+str(len(Runs))+' runs to do in '+OutputDir)
+    if Processes==1 or len(Runs)<=1:
+        for Run in Runs:
+            appendSummary(OutputDir, executeRun(Spec, Run, OutputDir))
+    else:
+        Processes=min(Processes or os.cpu_count(), len(Runs))
+        with mp.Pool(Processes) as Pool:
+            for Summary in Pool.imap_unordered(_executeRun, [(Spec, Run, OutputDir, 1) for Run in Runs]):
+                appendSummary(OutputDir, Summary)
+                print('Ensemble: run '+Summary['Run']+' done in {dt:.1f}s'.format(dt=Summary['TimeTaken']))
+    return readSummaries(OutputDir)
+
+
+#Runs of Spec without a summary in OutputDir
+def pendingRuns(Spec, OutputDir):
+    Done=doneRuns(OutputDir)
+    return [Run for Run in ensembleRuns(Spec) if Run['Run'] not in Done]
+
+
+#Ids of the runs with a summary in OutputDir
+def doneRuns(OutputDir):
+    return set(Summary['Run'] for Summary in readSummaries(OutputDir))
+
+
+def _executeRun(Args):
+    return executeRun(*Args)
+
+
+#Runs one simulation and returns its summary
+#The output of simulate goes to the log file of the run
+def executeRun(Spec, Run, OutputDir, NumWorkers=None):
+    Params=dict(Defaults, **DefaultModelParams)
+    Params.update(Spec.get('Params', {}))
+    Params.update(Spec.get('ModelParams', {}))
+    Params.update(Run['Cell'])
+    ModelParams={Name: Params.pop(Name) for Name in DefaultModelParams}
+    if NumWorkers is not None:
+        Params['NumWorkers']=NumWorkers
+
+    CD, CarProb = cityData(Spec)
+    rng=np.random.default_rng(Run['Seed'])
+    InitCovid, InitFlu = initialInfections(Params, CD.shape[0], rng)
+    LocationRepProb=np.broadcast_to(np.asarray(Params['LocationRepProb'], dtype=float), (CD.shape[0],))
+    if Params['TestingPolicy'] not in ['RandomSymptomaticTesting', 'ContactTracing']:
+        raise ValueError('Unsupported testing policy '+str(Params['TestingPolicy']))
+    testingPolicy=partial(getattr(tests, Params['TestingPolicy']), Params['TestingBudget'], Params['FalseNegative'], LocationRepProb)
+    interventionPolicy=getattr(interventions, Params['InterventionPolicy'])
+
+    os.makedirs(os.path.join(OutputDir, LogDirectory), exist_ok=True)
+    Start=timeit.default_timer()
+    with open(os.path.join(OutputDir, LogDirectory, Run['Run']+'.log'), 'w') as Log, contextlib.redirect_stdout(Log):
+        CovidCases, TestingHistory, Symptomatic, Localities = simulate(Params['Days'], Params['Population'], ModelParams, CD, CarProb, \
+            interventionPolicy, testingPolicy, InitCovidCounts=InitCovid, InitFluCounts=InitFlu, \
+            NumWorkers=Params['NumWorkers'], randseed=Run['Seed'], popseed=Params['PopulationSeed'], \
+            PopulationCache=populationCache(Spec))
+    if Spec.get('SaveRuns'):
+        ResultStore(os.path.join(OutputDir, ResultsDirectory)).append(CovidCases, TestingHistory, Symptomatic, Localities, \
+            Run=Run['Run'], Replicate=Run['Replicate'], Seed=Run['Seed'], **Run['Cell'])
+    Cases=CovidCases.sum(axis=0)
+    return {'Run': Run['Run'], 'Cell': Run['Cell'], 'Replicate': Run['Replicate'], 'Seed': Run['Seed'], \
+            'Days': Params['Days'], 'Population': Params['Population'], \
+            'Cases': Cases.astype(int).tolist(), 'Symptomatic': Symptomatic.sum(axis=0).astype(int).tolist(), \
+            'PositiveTests': [TestingHistory.numPositives(j) for j in range(TestingHistory.shape[1])], \
+            'Tests': [TestingHistory.numTests(j) for j in range(TestingHistory.shape[1])], \
+            'PeakCases': int(Cases.max()), 'PeakDay': int(Cases.argmax()), \
+            'TimeTaken': timeit.default_timer()-Start}
+
+
+#Initial Covid and flu counts per locality, drawn with rng
+def initialInfections(Params, NumLocalities, rng):
+    if Params['Seeding']=='uniform':
+        InitCovid=rng.binomial(Params['CovidMaxPerLocality'], Params['InitFracLocalitiesCovid'], NumLocalities)
+        InitFlu=rng.binomial(Params['FluMaxPerLocality'], Params['InitFracLocalitiesFlu'], NumLocalities)
+    elif Params['Seeding']=='clustered':
+        InitCovid=np.zeros(NumLocalities, dtype=int)
+        InitCovid[Params['SeedLocalityID']-1]=Params['InitNumSeedsCovid']
+        InitFlu=rng.binomial(1, Params['InitFracLocalitiesFlu'], NumLocalities)
+    else:
+        raise ValueError('Unknown seeding '+str(Params['Seeding']))
+    return InitCovid.tolist(), InitFlu.tolist()
+
+
+#City data of Spec, read once per process
+_CityData={}
+def cityData(Spec):
+    Key=(Spec.get('CityData', 'example/InputData/city.geojson'), Spec.get('CarProb', 'example/InputData/car-prob.csv'))
+    if Key not in _CityData:
+        from inoutfuncs import setupcitydata
+        _CityData[Key]=setupcitydata(*Key)
+    return _CityData[Key]
+
+
+#PopulationCache of Spec, None if it has none
+def populationCache(Spec):
+    if Spec.get('PopulationCache') is None:
+        return None
+    return PopulationCache(Spec['PopulationCache'], Spec.get('PopulationCacheBytes', 8<<30))
+
+
+#Summaries of the runs completed in OutputDir, one per run
+#A line cut short by a crash is ignored, and a run written twice is kept once
+def readSummaries(OutputDir):
+    Summaries={}
+    Path=os.path.join(OutputDir, SummaryFile)
+    if os.path.exists(Path):
+        with open(Path) as f:
+            for Line in f:
+                try:
+                    Summary=json.loads(Line)
+                except ValueError:
+                    continue
+                Summaries.setdefault(Summary['Run'], Summary)
+    return list(Summaries.values())
+
+
+#Appends Summary to the summaries of OutputDir
+#The line is written with a single write on a file opened for appending, so that processes
+#  sharing OutputDir do not interleave their lines
+def appendSummary(OutputDir, Summary):
+    Line=(json.dumps(Summary)+'\n').encode()
+    fd=os.open(os.path.join(OutputDir, SummaryFile), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, Line)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+#File-based job queue
+#enqueue writes one file per pending run in queue/pending; a worker claims a run by renaming
+#  its file into queue/running under a name tagged with its host and pid (a rename is
+#  atomic, so every run is claimed once), touches the claim every HeartbeatSeconds while
+#  the run is computed, and removes it once the summary is written. A claim is stale when
+#  its worker is gone: its pid is not running on this host, or, for another host, it was
+#  not touched for StaleClaimSeconds. The next enqueue moves stale claims back to
+#  queue/pending and leaves the others to their workers
+#A run done twice anyway (e.g. by a worker thought stale) has its summary written once
+HeartbeatSeconds=60
+StaleClaimSeconds=600
+
+def enqueue(Spec, OutputDir):
+    Pending=os.path.join(OutputDir, QueueDirectory, 'pending')
+    Running=os.path.join(OutputDir, QueueDirectory, 'running')
+    os.makedirs(Pending, exist_ok=True)
+    os.makedirs(Running, exist_ok=True)
+    with open(os.path.join(OutputDir, QueueDirectory, 'spec.json'), 'w') as f:
+        json.dump(Spec, f)
+    Queued=set()
+    for Name in os.listdir(Running):
+        RunId, Worker = claimOwner(Name)
+        if staleClaim(os.path.join(Running, Name), Worker):
+            with contextlib.suppress(FileNotFoundError):
+                os.rename(os.path.join(Running, Name), os.path.join(Pending, RunId+'.json'))
+        Queued.add(RunId)
+    Queued.update(Name[:-len('.json')] for Name in os.listdir(Pending) if Name.endswith('.json'))
+    Runs=[Run for Run in pendingRuns(Spec, OutputDir) if Run['Run'] not in Queued]
+    for Run in Runs:
+        Path=os.path.join(Pending, Run['Run']+'.json')
+        with open(Path+'.tmp', 'w') as f:
+            json.dump(Run, f)
+        os.replace(Path+'.tmp', Path)
+    print('Ensemble: '+str(len(Runs))+' runs queued in '+OutputDir)
+    return len(Runs)
+
+
+#Run id and worker (host-pid) of the claim file Name in queue/running
+def claimOwner(Name):
+    RunId, Worker = Name[:-len('.json')].split('.', 1)
+    return RunId, Worker
+
+
+#True if the worker of the claim at Path is gone
+def staleClaim(Path, Worker):
+    Host, Pid = Worker.rsplit('-', 1)
+    if Host==socket.gethostname():
+        try:
+            os.kill(int(Pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+    try:
+        return time.time()-os.path.getmtime(Path)>StaleClaimSeconds
+    except FileNotFoundError:
+        return False
+
+
+#Touches the claim at Path every HeartbeatSeconds until Stop is set
+def heartbeat(Path, Stop):
+    while not Stop.wait(HeartbeatSeconds):
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(Path)
+
+
+#Runs jobs from the queue of OutputDir until it is empty
+#Output: number of runs done by this worker
+def work(OutputDir, NumWorkers=None):
+    Queue=os.path.join(OutputDir, QueueDirectory)
+    with open(os.path.join(Queue, 'spec.json')) as f:
+        Spec=json.load(f)
+    Worker=socket.gethostname()+'-'+str(os.getpid())
+    Count=0
+    while True:
+        Claimed=None
+        for Name in sorted(os.listdir(os.path.join(Queue, 'pending'))):
+            if not Name.endswith('.json'):
+                continue
+            Target=os.path.join(Queue, 'running', Name[:-len('.json')]+'.'+Worker+'.json')
+            try:
+                os.rename(os.path.join(Queue, 'pending', Name), Target)
+            except FileNotFoundError:
+                #Claimed by another worker
+                continue
+            Claimed=Target
+            break
+        if Claimed is None:
+            return Count
+        with open(Claimed) as f:
+            Run=json.load(f)
+        if Run['Run'] not in doneRuns(OutputDir):
+            Stop=threading.Event()
+            Beat=threading.Thread(target=heartbeat, args=(Claimed, Stop), daemon=True)
+            Beat.start()
+            try:
+                Summary=executeRun(Spec, Run, OutputDir, NumWorkers)
+            finally:
+                Stop.set()
+                Beat.join()
+            #Written once per run, even if the run was also done by another worker
+            if Run['Run'] not in doneRuns(OutputDir):
+                appendSummary(OutputDir, Summary)
+            Count+=1
+            print('Ensemble: '+Worker+' finished run '+Run['Run'])
+        #The claim may already have been moved back to pending by an enqueue
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(Claimed)
+
+
+#Number of runs done, running and pending in OutputDir
+def status(OutputDir):
+    Queue=os.path.join(OutputDir, QueueDirectory)
+    Count=lambda Name: len(os.listdir(os.path.join(Queue, Name))) if os.path.isdir(os.path.join(Queue, Name)) else 0
+    return {'done': len(doneRuns(OutputDir)), \
+            'running': Count('running'), 'pending': Count('pending')}
+
+
+def main(Arguments=None):
+    Parser=argparse.ArgumentParser(description='Monte Carlo ensembles of simulations over a parameter grid')
+    Commands=Parser.add_subparsers(dest='command', required=True)
+    Run=Commands.add_parser('run', help='run the ensemble over a process pool')
+    Run.add_argument('spec')
+    Run.add_argument('output')
+    Run.add_argument('--processes', type=int, default=None)
+    Enqueue=Commands.add_parser('enqueue', help='queue the runs of the ensemble for workers')
+    Enqueue.add_argument('spec')
+    Enqueue.add_argument('output')
+    Work=Commands.add_parser('work', help='run queued runs until the queue is empty')
+    Work.add_argument('output')
+    Work.add_argument('--workers', type=int, default=None, help='NumWorkers of every simulation')
+    Status=Commands.add_parser('status', help='count the runs done, running and pending')
+    Status.add_argument('output')
+    Args=Parser.parse_args(Arguments)
+
+    if Args.command in ['run', 'enqueue']:
+        with open(Args.spec) as f:
+            Spec=json.load(f)
+    if Args.command=='run':
+        runEnsemble(Spec, Args.output, Args.processes)
+    elif Args.command=='enqueue':
+        enqueue(Spec, Args.output)
+    elif Args.command=='work':
+        work(Args.output, Args.workers)
+    else:
+        print(json.dumps(status(Args.output)))
+
+
+if __name__=='__main__':
+    main()
@@ -1,108 +1,187 @@
-import pandas as pd
 import random
 import numpy as np
-from scipy.special import comb
-import timeit
 import multiprocessing as mp
 import sys
-from functools import partial
-from interventions import InterventionRule 
+from interventions import InterventionRule, quarantineIndex
+from population import CityPopulation, localityNames, gatherContacts, StateS, StateE, StateI, StateR, FluStateS, FluStateI
+from workers import SharedArrays, agentRanges
+from randomstreams import BlockSize, agentGenerator, initGenerator
+from testinghistory import SparseTestingHistory
+from dailystats import DailyStats
+from sinks import drain, DailyPrint, SeriesCollector
+from checkpoint import restore
+from profiling import Profiler as DayProfiler, payloadBytes
 
 
 #File containing functions for COVID simulation
 #This code maintains two globally shared variables: CP and TestingHistory
-#CP: the state of the city's population stored as a pandas frame
-#TestingHistory: a numpy array storing the history of tests
+#CP: the state of the city's population stored as a CityPopulation (see population.py),
+#  which can be read and written like a pandas frame
+#TestingHistory: a SparseTestingHistory (see testinghistory.py) storing the history of tests
 #  of all people on all days:+1 indicates a positive test, -1 negative, 0 not tested
 
 #Function to initialize the population matrix
 #Inputs
 # CD: city data in pandas
 # CarProb: array of lists  
+#The population is built by InitializeArrays and returned as a CityPopulation
 
 def Initialize(CD, CarProb, ModelParams, Population, randseed=0):
-    random.seed(randseed)
-    np.random.seed(randseed)
-        
-    column_names = ["id", "localityIndex", "locality", "CovidState", "FluState",\
-                    "Visits", "neighborhood", "LocalContacts","VisitsContacts",\
-                    "quarantine","quarantineDay","CovidPositive"]
-    CP=pd.DataFrame(columns = column_names)
-
-    localities=[CD.loc[i, 'locality_name'] for i in range(CD.shape[0]) \
-                for j in range(int(Population*CD.loc[i,'locality_density']))]
+    Arrays=InitializeArrays(CD, CarProb, ModelParams, Population, randseed)
+    LocalityNames, NeighborhoodNames = localityNames(CD)
+    CP=CityPopulation.create(LocalityNames, NeighborhoodNames, Arrays['LocalityIndex']-1, Arrays['Visits'], \
+                             Arrays['LocalOffsets'], Arrays['LocalIndices'], Arrays['VisitsOffsets'], Arrays['VisitsIndices'])
+    CP.RandSeed=randseed
+    return CP
 
-    localitiesIndex=[CD.loc[i, 'locality_id']  for i in range(CD.shape[0]) \
-                     for j in range(int(Population*CD.loc[i, 'locality_density']))]
 
+#Stages of the initialization, each has one random stream per locality
+VisitsStage, LocalStage, HotspotStage, InfectionStage = 0, 1, 2, 3
+
+
+#Builds the population as arrays
+#Agents are stored locality by locality (in the row order of CD), so the agents of
+#  row r of CD are Starts[r]..Starts[r+1]-1
+#Each locality draws from its own random streams, so the assignments of a locality
+#  do not depend on the order in which localities are processed
+#Output: dictionary with
+# Starts: first agent of each row of CD
+# Row: row of CD of each agent, LocalityIndex: locality_id of each agent
+# Visits: hotspot visited by each agent (len(CarProb[0])-1 for none)
+# LocalOffsets/LocalIndices, VisitsOffsets/VisitsIndices: fixed contacts in CSR form
+#Rows: (first, last+1) rows of CD whose agents are built, all rows by default. The agents
+#  of these rows are ids Lo..Hi-1 (Lo, Hi are in the output); Row, LocalityIndex, Visits
+#  and the CSR rows cover only them, and the contacts are global ids. The arrays are the
+#  corresponding parts of those built for all rows (used by distributed.py). Apart from
+#  per-locality and per-hotspot tables, memory grows with the agents of these rows and of
+#  the largest locality, not with Population
+
+def InitializeArrays(CD, CarProb, ModelParams, Population, randseed=0, Rows=None):
+    random.seed(randseed)
+    np.random.seed(randseed)
 
+    NumLocalities=CD.shape[0]
+    NumHotspots=len(CarProb[0])
+    NumHotspotFixed = ModelParams["HotspotContactFixed"]
+    NumLocalFixed = ModelParams["NeighborhoodContactFixed"]
 
-    PopulationEffective= len(localities)
+    Counts=(Population*CD['locality_density'].to_numpy()).astype(np.int64)
+    Starts=np.zeros(NumLocalities+1, dtype=np.int64)
+    np.cumsum(Counts, out=Starts[1:])
+    LocalityIds=CD['locality_id'].to_numpy(dtype=np.int64)
+    First, Last = Rows if Rows is not None else (0, NumLocalities)
+    Lo, Hi = int(Starts[First]), int(Starts[Last])
+    Row=np.repeat(np.arange(First, Last, dtype=np.int32), Counts[First:Last])
+
+    # Setup The Place Each person visits: one multinomial per locality
+    #VisitCounts[r, h]: agents of row r visiting hotspot h
+    VisitCounts=np.array([initGenerator(randseed, VisitsStage, r).multinomial(Counts[r], CarProb[r]) for r in range(NumLocalities)])
+    Visits=np.empty(Hi-Lo, dtype=np.int16)
+    for r in range(First, Last):
+        Visits[Starts[r]-Lo:Starts[r+1]-Lo]=localityVisits(randseed, r, Counts[r], CarProb[r])
 
-    idVector=[i for i in range(PopulationEffective)]
+    #Set up contact list for each person
+    #Local contacts are drawn from the agents of the neighboring localities, whose
+    #  agents are the concatenation of ranges of Starts
+    NeighborRows, NeighborCols = localityNeighbors(CD)
+    RowOfId=np.zeros(LocalityIds.max()+1, dtype=np.int64)
+    RowOfId[LocalityIds]=np.arange(NumLocalities)
+    NeighborRows=RowOfId[NeighborRows+1]
+    NeighborCols=RowOfId[NeighborCols+1]
+
+    LocalDegree=np.zeros(Hi-Lo, dtype=np.int64)
+    LocalParts=[]
+    for r in range(First, Last):
+        Neighbors=NeighborCols[NeighborRows==r]
+        PoolCumulative=np.cumsum(Counts[Neighbors])
+        if Counts[r]==0 or len(Neighbors)==0 or PoolCumulative[-1]==0:
+            continue
+        rng=initGenerator(randseed, LocalStage, r)
+        Draws=rng.integers(0, PoolCumulative[-1], size=Counts[r]*NumLocalFixed)
+        Which=np.searchsorted(PoolCumulative, Draws, side='right')
+        LocalParts.append((Starts[Neighbors]-PoolCumulative+Counts[Neighbors])[Which]+Draws)
+        LocalDegree[Starts[r]-Lo:Starts[r+1]-Lo]=NumLocalFixed
+
+    #Hotspot contacts are drawn from the agents visiting the same hotspot: the k-th member
+    #  of a hotspot, in the order of the agent ids
+    HotspotSizes=VisitCounts.sum(axis=0)
+    HotspotStarts=np.concatenate(([0], np.cumsum(HotspotSizes)))
+    VisitsDegree=np.where(Visits<NumHotspots-1, NumHotspotFixed, 0).astype(np.int64)
+    VisitsParts=[]
+    for r in range(First, Last):
+        Hotspot=Visits[Starts[r]-Lo:Starts[r+1]-Lo]
+        Hotspot=Hotspot[Hotspot<NumHotspots-1]
+        rng=initGenerator(randseed, HotspotStage, r)
+        Draws=(rng.random((len(Hotspot), NumHotspotFixed))*HotspotSizes[Hotspot][:, None]).astype(np.int64)
+        VisitsParts.append((HotspotStarts[Hotspot][:, None]+Draws).ravel())
+    Positions=np.concatenate([np.zeros(0, dtype=np.int64)]+VisitsParts)
+
+    #Members of the hotspots, found row by row of CD so that only the visits of one row
+    #  outside Rows are held at a time: Segments are the agents of row r visiting hotspot h,
+    #  for h and then r in increasing order, which is the order of the positions
+    Segments=np.concatenate(([0], np.cumsum(VisitCounts.T.ravel())))
+    Segment=np.searchsorted(Segments, Positions, side='right')-1
+    MemberRow=Segment%NumLocalities
+    Members=np.empty(len(Positions), dtype=np.int64)
+    Order=np.argsort(MemberRow, kind='stable')
+    Bounds=np.searchsorted(MemberRow[Order], np.arange(NumLocalities+1))
+    for r in np.flatnonzero(np.diff(Bounds)):
+        Which=Order[Bounds[r]:Bounds[r+1]]
+        if First<=r<Last:
+            RowVisits=Visits[Starts[r]-Lo:Starts[r+1]-Lo]
+        else:
+            RowVisits=localityVisits(randseed, r, Counts[r], CarProb[r])
+        RowMembers=np.argsort(RowVisits, kind='stable')
+        RowStarts=np.concatenate(([0], np.cumsum(VisitCounts[r])))
+        Members[Which]=Starts[r]+RowMembers[RowStarts[Segment[Which]//NumLocalities]+Positions[Which]-Segments[Segment[Which]]]
 
-    InitialStateCovid=['S' for i in range(PopulationEffective)]
-    InitialStateFlu=['S' for i in range(PopulationEffective)]
-    
-    # Setup The Place Each person visits
-    Visits=[np.argmax(np.random.multinomial(1,CarProb[i])) for i in range(CD.shape[0]) \
-            for j in range(int(Population*CD.loc[i,'locality_density']))]
-    
-    CP['id']=idVector
-    CP['locality']=localities
-    CP['localityIndex']=localitiesIndex
-    CP['CovidState']=InitialStateCovid
-    CP['FluState']=InitialStateFlu
-    CP['Visits']=Visits
-    CP['quarantine']=[0 for i in range(PopulationEffective)]
-    CP['CovidPositive']= [0 for i in range(PopulationEffective)]
-    CP['neighborhood']=[list(CD.loc[CD['locality_name']==CP.loc[i, 'locality']].locality_neighbors)[0] \
-                           for i in range(PopulationEffective)]
+    LocalOffsets=np.zeros(Hi-Lo+1, dtype=np.int64)
+    np.cumsum(LocalDegree, out=LocalOffsets[1:])
+    VisitsOffsets=np.zeros(Hi-Lo+1, dtype=np.int64)
+    np.cumsum(VisitsDegree, out=VisitsOffsets[1:])
 
-    #Set up contact list for each person
-    contactsLocal=[CP['id'].loc[CP['locality'].isin(CD.loc[i, 'locality_neighbors'].split(", "))].values \
-              for i in range(CD.shape[0])]
-    contactsHotspot=[CP['id'].loc[CP['Visits'] == i].values \
-              for i in range(len(CarProb[0])-1)] 
+    random.seed(randseed+1)
+    print("City Population Data setup complete")
 
+    return {'Starts': Starts, 'Lo': Lo, 'Hi': Hi, 'Row': Row, 'LocalityIndex': LocalityIds[Row], 'Visits': Visits, \
+            'LocalOffsets': LocalOffsets, 'LocalIndices': np.concatenate([np.zeros(0, dtype=np.int32)]+LocalParts).astype(np.int32), \
+            'VisitsOffsets': VisitsOffsets, 'VisitsIndices': Members.astype(np.int32)}
 
-    NumHotspotFixed = ModelParams["HotspotContactFixed"]
-    NumLocalFixed = ModelParams["NeighborhoodContactFixed"]
-    
-    contactListLocal=[np.random.choice(contactsLocal[i], size=NumLocalFixed).tolist() for i in range(CD.shape[0])\
-                 for j in range(int(Population*CD.loc[i, 'locality_density']))]
 
-    random.seed(randseed+1)
-    contactListHotspot = [[] for i in range(CP.shape[0])]
-    for i in range(CP.shape[0]):
-            hotspot = CP.loc[i, 'Visits']
-            if hotspot<len(CarProb[0])-1:
-                contactListHotspot[i]=np.random.choice(contactsHotspot[hotspot], size=NumHotspotFixed).tolist()
-                
-    CP['LocalContacts']=contactListLocal
-    CP['VisitsContacts']=contactListHotspot
+#Hotspots visited by the agents of row r of CD, drawn from the row's own stream
+def localityVisits(randseed, r, Count, Probabilities):
+    rng=initGenerator(randseed, VisitsStage, r)
+    Choices=np.repeat(np.arange(len(Probabilities), dtype=np.int16), rng.multinomial(Count, Probabilities))
+    rng.shuffle(Choices)
+    return Choices
 
-    print("City Population Data setup complete")
-    
-    return CP
 
 #Function to Initialize infections to a prespecified value
 #Inputs
 # InfectionCountsCovid (list int): Location-wise number of people with COVID
 # InfectionCountsFlu (list int): Location-wise number of people with flu
+#The Covid and flu seeds of a locality are prefixes of one random sample of its agents
 
 def InitInfection(InfectionCountsCovid, InfectionCountsFlu, CP, randseed=0):
-    
+    LocalityIndex=CP['localityIndex'].to_numpy()
+    Order=np.argsort(LocalityIndex, kind='stable')
+    Bounds=np.searchsorted(LocalityIndex[Order], np.arange(1, len(InfectionCountsCovid)+2))
+
+    CovidIds=[]
+    FluIds=[]
     for i in range(len(InfectionCountsCovid)):
-        if (CP.loc[CP['localityIndex']==i+1].shape[0]>=InfectionCountsCovid[i]) and\
-           (CP.loc[CP['localityIndex']==i+1].shape[0]>=InfectionCountsFlu[i]):
-            sampleIdsCovid=CP.loc[CP['localityIndex']==i+1].sample(n=InfectionCountsCovid[i], random_state=randseed).index.values
-            sampleIdsFlu=CP.loc[CP['localityIndex']==i+1].sample(n=InfectionCountsFlu[i], random_state=randseed).index.values
-            CP.loc[sampleIdsCovid, 'CovidState']='E'
-            CP.loc[sampleIdsFlu, 'FluState']='I'
+        Agents=Order[Bounds[i]:Bounds[i+1]]
+        if (len(Agents)>=InfectionCountsCovid[i]) and (len(Agents)>=InfectionCountsFlu[i]):
+            rng=initGenerator(randseed, InfectionStage, i)
+            Sample=rng.choice(Agents, size=max(InfectionCountsCovid[i], InfectionCountsFlu[i]), replace=False)
+            CovidIds.append(Sample[:InfectionCountsCovid[i]])
+            FluIds.append(Sample[:InfectionCountsFlu[i]])
         else:
             print('Error: Population in locality ' +str(i+1)+' too small for sampling initially infected. Terminating simulation.')
             sys.exit(1)
+
+    CP.loc[np.concatenate([np.zeros(0, dtype=np.int64)]+CovidIds), 'CovidState']='E'
+    CP.loc[np.concatenate([np.zeros(0, dtype=np.int64)]+FluIds), 'FluState']='I'
             
 
 #The main simulate function
@@ -114,16 +193,63 @@ def InitInfection(InfectionCountsCovid, InfectionCountsFlu, CP, randseed=0):
 # testingPolicy: name of the testingPolicy function
 # CD: city data in pandas; see the function Initialize() to see what columns are needed
 # CarProb: list of car probabilities
-
-def simulate(NumSteps, Population, ModelParamsInput, CD, CarProbInput, interventionPolicy, testingPolicy, InitCovidCounts=None, InitFluCounts=None):
-
-    global ModelParams, TestingHistory, CP, CarProb, CovidPerHotspot, PeoplePerHotspot, CovidPerNeighborhood, PeoplePerNeighborhood
+# NumWorkers: number of worker processes for the state update (1 runs it in this process)
+# randseed: seed of the simulation; results for a given seed do not depend on NumWorkers
+# popseed: seed of the population (localities, hotspots and contacts), randseed if None;
+#   replicates sharing popseed run on the same population
+# PopulationCache: a PopulationCache (see popcache.py) used to get the population, None to build it
+# Profiler: a Profiler (see profiling.py) whose hooks get the phase times and counters of every day
+# ActiveSet: update only the agents that can change state each day (see updateActiveAgents)
+#   instead of the whole population; the results follow the same distribution but are
+#   drawn differently, so they differ from those of the default mode for a given seed
+
+def simulate(NumSteps, Population, ModelParamsInput, CD, CarProbInput, interventionPolicy, testingPolicy, InitCovidCounts=None, InitFluCounts=None,\
+             NumWorkers=8, randseed=0, popseed=None, PopulationCache=None, Profiler=None, ActiveSet=False):
+
+    Series=SeriesCollector(CD.shape[0], NumSteps)
+    drain(simulateStream(NumSteps, Population, ModelParamsInput, CD, CarProbInput, interventionPolicy, testingPolicy, \
+                         InitCovidCounts, InitFluCounts, NumWorkers, randseed, popseed, PopulationCache, Profiler=Profiler, \
+                         ActiveSet=ActiveSet), \
+          Series, DailyPrint())
+
+    return Series['CovidCases'].astype(float), TestingHistory,  Series['Symptomatic'].astype(float), CP['locality']
+
+
+#Days of TestingHistory kept by simulateStream for runs of unbounded length
+HistoryRetention=64
+
+#Generator version of simulate: yields the DailyRecord of every day as soon as the day is
+#  simulated (see sinks.py), instead of returning the whole run at the end
+#With NumSteps None the simulation runs until the consumer stops iterating; the worker pool
+#  is released when the generator is closed
+#TestingHistory keeps the last Retention days (all days by default when NumSteps is given,
+#  HistoryRetention days otherwise), so that memory does not grow with the number of days
+#Profiler: a Profiler (see profiling.py) timing the phases of every day; its phases and
+#  counters are also part of the records
+#Checkpoint: a Checkpointer (see checkpoint.py) given the state at the end of every day
+#Resume: a snapshot loaded by checkpoint.load; the run continues from the day after it
+#  (the other arguments must be those of the run that was checkpointed)
+def simulateStream(NumSteps, Population, ModelParamsInput, CD, CarProbInput, interventionPolicy, testingPolicy, InitCovidCounts=None, InitFluCounts=None,\
+                   NumWorkers=8, randseed=0, popseed=None, PopulationCache=None, Retention=None, Checkpoint=None, Resume=None, \
+                   Profiler=None, ActiveSet=False):
+
+    global ModelParams, TestingHistory, CP, CarProb
     ModelParams=ModelParamsInput
     CarProb=CarProbInput
+    if Profiler is None:
+        Profiler=DayProfiler()
+    StartDay=0 if Resume is None else int(Resume['Day'])+1
+    Profiler.start(StartDay)
+    Profiler.begin('initialize')
     
-    #Calling Initialize without randseed
     print('Initializing '+str(Population)+' agents...')
-    CP=Initialize(CD, CarProb, ModelParams, Population)
+    if popseed is None:
+        popseed=randseed
+    if PopulationCache is None:
+        CP=Initialize(CD, CarProb, ModelParams, Population, popseed)
+    else:
+        CP=PopulationCache.initialize(CD, CarProb, ModelParams, Population, popseed)
+    CP.RandSeed=randseed
     PopulationEffective = CP.shape[0]
     
     
@@ -140,160 +266,524 @@ def simulate(NumSteps, Population, ModelParamsInput, CD, CarProbInput, intervent
     else:
         InitialFlu = InitFluCounts
 
-    InitInfection(InitialCovid, InitialFlu, CP)
-
-    
     #Setting up variables to record simulation data
-    CovidCases = np.zeros((CD.shape[0], NumSteps))
-    TestingHistory=np.zeros((PopulationEffective, NumSteps))
-    Symptomatic =np.zeros((CD.shape[0], NumSteps))
+    if NumSteps is None and Retention is None:
+        Retention=HistoryRetention
+    if Resume is None:
+        InitInfection(InitialCovid, InitialFlu, CP, randseed)
+        TestingHistory=SparseTestingHistory(PopulationEffective, NumSteps, Retention)
+        #Interventions applied so far and daily test counts, see dailystats.py
+        InterventionsHistory=DailyStats(len(CP.LocalityNames))
+    else:
+        TestingHistory, InterventionsHistory, Engine = restore(Resume, CP)
+        print('Resuming from the end of day '+str(StartDay-1))
+
+    setupEngine(CP, CD, CarProb, randseed, ActiveSet)
+    if Resume is not None:
+        restoreEngineState(Engine)
+    Profiler.end('initialize')
+
+    #Long-lived worker pool attached to the population arrays in shared memory
+    #Each worker updates a contiguous range of agents
+    #Infections along fixed contacts are written by the workers into per-range exposure buffers
+    #Ranges are made of whole random stream blocks
+    Pool=None
+    with Profiler.phase('pool'):
+        Ranges=agentRanges(PopulationEffective, max(NumWorkers, 1), BlockSize)
+        setupExposureBuffers(Ranges)
+        if NumWorkers>1:
+            Shared=shareEngine()
+            Setup=(Shared.spec(), engineStatic())
+            Pool=mp.Pool(NumWorkers, initializer=attachEngine, initargs=Setup)
+            Profiler.add('BytesToWorkers', NumWorkers*payloadBytes(Setup))
+
+    print("Initialized random infection seed")
+
+    try:
+        j=StartDay
+        while NumSteps is None or j<NumSteps:
+
+            #Intervention policy function can use TestingHistory as observation
+            day=j
+            with Profiler.phase('release'):
+                TestingHistory.advance(day)
+                quarantineIndex(CP).release(day)
+            with Profiler.phase('intervention'):
+                interventions=interventionPolicy(TestingHistory, InterventionsHistory, CP, day)
+                InterventionsHistory.append(interventions)
+
+            with Profiler.phase('counts'):
+                updateCounts()
+
+            ##### MAIN UPDATE ######
+            Sources, Targets = updateState(interventions, day, Pool, Ranges, Profiler)
+            ########################
+                
+            #Testing policy updates TestingHistory and can interact with the intervention policy
+            with Profiler.phase('testing'):
+                testingPolicy(CP, TestingHistory, day)  
+            with Profiler.phase('stats'):
+                InterventionsHistory.recordTests(day, TestingHistory, CP)
+            if Checkpoint is not None:
+                with Profiler.phase('checkpoint'):
+                    Checkpoint.day(day, CP, TestingHistory, InterventionsHistory, engineState())
+
+            Profiler.count('Exposures', len(Targets))
+            Profiler.count('Tests', InterventionsHistory.tests(day))
+            Profiler.count('PositiveTests', InterventionsHistory.positives(day))
+            Profiler.count('Quarantined', int(np.count_nonzero(CP.quarantined())))
+            Profile=Profiler.finish()
+
+            #Ward-wise symptomatic and CovidCases from the counters kept by updateState
+            yield {'Day': day, 'CovidCases': CovidPerLocality.astype(np.int32), \
+                   'Symptomatic': SymptomaticPerLocality.astype(np.int32), \
+                   'PositiveTests': InterventionsHistory.localityPositives(day).astype(np.int32), \
+                   'Tests': InterventionsHistory.localityTests(day).astype(np.int32), \
+                   'Interventions': list(interventions), 'Seconds': Profile['Seconds'], \
+                   'Phases': Profile['Phases'], 'Setup': Profile['Setup'], 'Counters': Profile['Counters']}
+            j+=1
+            Profiler.start(j)
+    finally:
+        if Pool is not None:
+            Pool.close()
+            Pool.join()
+            unshareEngine(Shared)
+        if Checkpoint is not None:
+            Checkpoint.close()
+        Profiler.close()
+
+
+#Adjacency of the localities of CD, built from the locality_neighbors column
+#Locality k is the one with locality_id k+1
+#Output: arrays NeighborRows, NeighborCols; locality NeighborRows[k] has neighbor NeighborCols[k]
+def localityNeighbors(CD):
+    Ids=np.asarray(CD['locality_id'], dtype=np.int64)
+    WardOf=dict(zip(CD['locality_name'], (Ids-1).tolist()))
+    Rows=[]
+    Cols=[]
+    for i, Neighbors in zip((Ids-1).tolist(), CD['locality_neighbors']):
+        for name in Neighbors.split(", "):
+            if name in WardOf:
+                Rows.append(i)
+                Cols.append(WardOf[name])
+    return np.array(Rows, dtype=np.int64), np.array(Cols, dtype=np.int64)
+
+
+#Sets up the update engine for the population CP
+#Global variables set here:
+# CovidStateNext, FluStateNext: states at the end of the day being updated
+# NeighborRows/NeighborCols: ward adjacency, ward NeighborRows[k] has neighbor NeighborCols[k]
+# PeoplePerNeighborhood, PeoplePerHotspot: pool sizes for InfectRate
+# RandSeed: seed of the random streams of updateState
+
+def setupEngine(CP, CD, CarProb, randseed=0, ActiveSetMode=False):
+    global RandSeed, CovidStateNext, FluStateNext, \
+           NeighborRows, NeighborCols, PeoplePerNeighborhood, PeoplePerHotspot, NumHotspots, \
+           ActiveSet, BlockLocalityOffsets, BlockLocalities
+
+    RandSeed=randseed
+    ActiveSet=ActiveSetMode
+    CovidStateNext=CP.CovidState.copy()
+    FluStateNext=CP.FluState.copy()
+
+    NumLocalities=CD.shape[0]
+    NeighborRows, NeighborCols = localityNeighbors(CD)
+
+    PeoplePerLocality=np.bincount(CP.Locality, minlength=NumLocalities)
+    PeoplePerNeighborhood=np.bincount(NeighborRows, weights=PeoplePerLocality[NeighborCols], minlength=NumLocalities)
+
+    NumHotspots=len(CarProb[0])
+    PeoplePerHotspot=np.bincount(CP.Visits, minlength=NumHotspots)
+
+    #Localities of the agents of every random stream block, for the active set mode
+    Blocks=np.arange(len(CP))//BlockSize
+    Pairs=np.unique(Blocks.astype(np.int64)*NumLocalities+CP.Locality)
+    BlockLocalities=(Pairs%NumLocalities).astype(np.int64)
+    BlockLocalityOffsets=np.searchsorted(Pairs//NumLocalities, np.arange(Blocks[-1]+2 if len(Blocks) else 1))
+
+    setupCounters()
+
+
+#Counts the infected (Covid I) and symptomatic (Covid I or flu I) agents per locality
+#  and the infected agents per hotspot
+#updateState keeps these counters up to date from the day's state changes; this
+#  function only needs to be called again if the states of CP are changed by other code
+#It also builds ActiveE and ActiveI, the sorted ids of the agents in Covid states E and I,
+#  that the active set mode updates instead of the whole population
+#Global variables set here: CovidPerLocality, SymptomaticPerLocality, CovidPerHotspot, ActiveE, ActiveI
+
+def setupCounters():
+    global CovidPerLocality, SymptomaticPerLocality, CovidPerHotspot, ActiveE, ActiveI
+    ActiveE=np.flatnonzero(CP.CovidState==StateE)
+    ActiveI=np.flatnonzero(CP.CovidState==StateI)
+    Infected = CP.CovidState==StateI
+    CovidPerLocality=np.bincount(CP.Locality[Infected], minlength=len(PeoplePerNeighborhood))
+    SymptomaticPerLocality=np.bincount(CP.Locality[Infected | (CP.FluState==FluStateI)], minlength=len(PeoplePerNeighborhood))
+    CovidPerHotspot=np.bincount(CP.Visits[Infected], minlength=NumHotspots)
+
+
+#Counters kept by updateState, for checkpoints
+def engineState():
+    return {'CovidPerLocality': CovidPerLocality, 'SymptomaticPerLocality': SymptomaticPerLocality, \
+            'CovidPerHotspot': CovidPerHotspot}
+
+
+#Restores the counters saved by engineState
+def restoreEngineState(State):
+    global CovidPerLocality, SymptomaticPerLocality, CovidPerHotspot
+    CovidPerLocality=np.array(State['CovidPerLocality'])
+    SymptomaticPerLocality=np.array(State['SymptomaticPerLocality'])
+    CovidPerHotspot=np.array(State['CovidPerHotspot'])
+
+
+#This function updates the Covid Positive Counts for neighborhoods from the locality counters
+#Its cost depends only on the number of localities and their adjacencies
+def updateCounts():
+    global CovidPerNeighborhood
+    CovidPerNeighborhood=np.bincount(NeighborRows, weights=CovidPerLocality[NeighborCols], minlength=len(PeoplePerNeighborhood))
+
+
+#Maximum number of exposure events buffered per range of agents;
+#  events beyond this are returned to the main process with the task result
+ExposureBufferSize=1<<22
+
+
+#Sets up the exposure buffers: range k writes its (source, target) events into
+#  ExposureSources/ExposureTargets[ExposureStarts[k]:ExposureStarts[k+1]]
+#A range never emits more events than it has contacts, which bounds its capacity
+
+def setupExposureBuffers(Ranges):
+    global ExposureSources, ExposureTargets, ExposureStarts
+    Capacity=[min(CP.LocalOffsets[hi]-CP.LocalOffsets[lo]+CP.VisitsOffsets[hi]-CP.VisitsOffsets[lo], ExposureBufferSize) \
+              for lo, hi in Ranges]
+    ExposureStarts=np.zeros(len(Ranges)+1, dtype=np.int64)
+    np.cumsum(Capacity, out=ExposureStarts[1:])
+    ExposureSources=np.zeros(ExposureStarts[-1], dtype=np.int32)
+    ExposureTargets=np.zeros(ExposureStarts[-1], dtype=np.int32)
 
-    initial_time=timeit.default_timer()
 
-    PeoplePerNeighborhood=[CP.loc[CP['locality'].isin(CD.loc[CD['locality_id']==i+1].locality_neighbors.values[0].split(", "))].shape[0] \
-                            for i in range(CD.shape[0])]
-    CovidPerNeighborhood=[0 for i in range(CD.shape[0])]
+#Engine arrays placed in shared memory, with the arrays of CP, when simulate runs with a worker pool
+EngineArrays=['CovidStateNext', 'FluStateNext', 'ExposureSources', 'ExposureTargets']
 
-    PeoplePerHotspot=[CP.loc[CP['Visits']==i].shape[0] for i in range(len(CarProb[0]))]
-    CovidPerHotspot=[0 for i in range(len(CarProb[0]))]
 
+#Moves the population and engine arrays into shared memory and returns the SharedArrays holding them
+def shareEngine():
+    Shared=SharedArrays()
+    for Name in CityPopulation.Arrays:
+        setattr(CP, Name, Shared.share(Name, getattr(CP, Name)))
+    for Name in EngineArrays:
+        globals()[Name]=Shared.share(Name, globals()[Name])
+    return Shared
 
-    InterventionsHistory=[]
-    print("Initialized random infection seed")
-    
-    for j in range(NumSteps):
-
-        #Intervention policy function can use TestingHistory as observation
-        day=j
-        interventions=interventionPolicy(TestingHistory, InterventionsHistory, CP, day)
-        InterventionsHistory.append(interventions)
-
-        
-        updateState_partial = partial(updateState, interventions,  day)
-        updateCountNeighborhood_partial = partial(updateCountNeighborhood, CD)
-
-        #SerialImplementation
-        #for i in range(PopulationEffective):
-        #    StateOut=updateState_partial(i)
-        #    CP.loc[i, 'CovidState']=StateOut[0]
-        #    CP.loc[i, 'FluState']=StateOut[1]
-
-        
-        #Parallel Implementation
-        #Set pool
-        pool = mp.Pool(8) # 8 state update "threads" for consistency across machines
-
-        
-        CovidPerNeighborhood= pool.map(updateCountNeighborhood_partial, [i for i in range(CD.shape[0])])
-        CovidPerHotspot=pool.map(updateCountHotspot, [i for i in range(len(CarProb[0]))])
-        
-        ##### MAIN UPDATE ######
-        StateOut=pool.map(updateState_partial, [i for i in range(PopulationEffective)])
-        ########################
-        
-        
-        #Close pool
-        pool.close()
-        pool.join()
-
-        #Update states computed from the parallel pool
-        df=pd.DataFrame(StateOut)
-        CP['CovidState']=df[0]
-        CP['FluState']=df[1]
-                
-        #Testing policy updates TestingHistory and can interact with the intervention policy
-        testingPolicy(CP, TestingHistory, day)  
 
-       #Update Ward-wise symptomatic and CovidCases
-        for i in range(CD.shape[0]):
-            Symptomatic[i][j]=CP.loc[((CP['CovidState']=='I') | (CP['FluState']=='I'))& (CP['localityIndex']==i+1)].shape[0]
-            CovidCases[i][j]=CP.loc[(CP['CovidState']=='I') & (CP['localityIndex']==i+1)].shape[0]
+#Moves the population and engine arrays back to private memory and releases the shared blocks
+def unshareEngine(Shared):
+    for Name in CityPopulation.Arrays:
+        if Name in Shared.Blocks:
+            setattr(CP, Name, getattr(CP, Name).copy())
+    for Name in EngineArrays:
+        globals()[Name]=globals()[Name].copy()
+    Shared.close(unlink=True)
 
-        current_time=timeit.default_timer()
-        print("Day:"+str(j)+" Cases:"+str(int(np.sum( CovidCases[:,j] )))+ \
-              " PositiveTests:"+str(int(np.sum(  TestingHistory[ TestingHistory[:,j] >0  ,j]   )))+ \
-              " TestsConducted:"+str(TestingHistory[ TestingHistory[:,j] !=0  ,j].shape[0] )+ \
-              " Symptomatic:"+str(int(np.sum(Symptomatic[:,j]))) + \
-              " Interventions:"+str(interventions)+ \
-              " TimeTaken:{dt:.3f}s".format(dt=current_time-initial_time))   
-        initial_time=current_time
-        
-    return CovidCases, TestingHistory,  Symptomatic, CP['locality']
 
+#Small read-only engine data sent once to each worker
+def engineStatic():
+    return {'ModelParams': ModelParams, 'PeoplePerNeighborhood': PeoplePerNeighborhood, \
+            'PeoplePerHotspot': PeoplePerHotspot, 'NumHotspots': NumHotspots, 'ExposureStarts': ExposureStarts, \
+            'RandSeed': RandSeed, 'LocalityNames': CP.LocalityNames, 'NeighborhoodNames': CP.NeighborhoodNames, \
+            'ActiveSet': ActiveSet, 'BlockLocalityOffsets': BlockLocalityOffsets, 'BlockLocalities': BlockLocalities}
+
+
+#Pool initializer: attaches a worker to the shared population and engine arrays
+def attachEngine(Spec, Static):
+    global WorkerShared, CP
+    WorkerShared=SharedArrays.attach(Spec)
+    CP=CityPopulation(Static.pop('LocalityNames'), Static.pop('NeighborhoodNames'), \
+                      **{Name: WorkerShared.Arrays[Name] for Name in CityPopulation.Arrays})
+    globals().update({Name: WorkerShared.Arrays[Name] for Name in EngineArrays})
+    globals().update(Static)
 
 
 #Main function to update state
-#Global Variables ModelParams and CP used
+#Updates the whole population by one day: each range of agents is updated by
+#  updateBlock, on the worker pool if there is one. The exposure events emitted by the
+#  ranges are then merged in range order and applied once, so the result does not
+#  depend on which worker ran which range
+#The ranges also return the changes of the locality and hotspot counters (see setupCounters)
+#Global Variables ModelParams and the engine arrays set by setupEngine are used
+#On return CP holds the states at the end of the day
+#Output: (Sources, Targets) arrays of the day's exposures along fixed contacts
+
+def updateState(interventions, day, Pool=None, Ranges=None, Profiler=None):
+    global CovidPerLocality, SymptomaticPerLocality, CovidPerHotspot, ActiveE, ActiveI
+    if Ranges is None:
+        Ranges=[(0, len(CP))]
+    if Profiler is None:
+        Profiler=DayProfiler()
+    Tasks=[(interventions, day, lo, hi, k, CovidPerNeighborhood, CovidPerHotspot, activeAgents(lo, hi)) \
+           for k, (lo, hi) in enumerate(Ranges)]
+    with Profiler.phase('update'):
+        if Pool is None:
+            Results=[updateBlock(*Task) for Task in Tasks]
+        else:
+            Results=Pool.starmap(updateBlock, Tasks)
+    if Pool is not None:
+        Profiler.add('BytesToWorkers', payloadBytes(Tasks))
+        Profiler.add('BytesFromWorkers', payloadBytes(Results))
+
+    Profiler.begin('merge')
+    #Merge the per-range exposure buffers
+    SourceParts=[]
+    TargetParts=[]
+    ChangedParts=[]
+    Touched=0
+    for k, (Count, Overflow, Changes, Changed, Agents) in enumerate(Results):
+        CovidPerLocality=CovidPerLocality+Changes[0]
+        SymptomaticPerLocality=SymptomaticPerLocality+Changes[1]
+        CovidPerHotspot=CovidPerHotspot+Changes[2]
+        SourceParts.append(ExposureSources[ExposureStarts[k]:ExposureStarts[k]+Count])
+        TargetParts.append(ExposureTargets[ExposureStarts[k]:ExposureStarts[k]+Count])
+        if Overflow is not None:
+            SourceParts.append(Overflow[0])
+            TargetParts.append(Overflow[1])
+        ChangedParts.append(Changed)
+        Touched+=Agents
+    Sources=np.concatenate(SourceParts)
+    Targets=np.concatenate(TargetParts)
+    CovidStateNext[Targets]=StateE
+
+    if ActiveSet:
+        #Only the agents that changed state are copied, and the E and I sets are updated
+        Changed=np.unique(np.concatenate(ChangedParts+[Targets]))
+        CP.CovidState[Changed]=CovidStateNext[Changed]
+        CP.FluState[Changed]=FluStateNext[Changed]
+        State=CovidStateNext[Changed]
+        ActiveE=np.union1d(np.setdiff1d(ActiveE, Changed, assume_unique=True), Changed[State==StateE])
+        ActiveI=np.union1d(np.setdiff1d(ActiveI, Changed, assume_unique=True), Changed[State==StateI])
+    else:
+        CP.CovidState[:]=CovidStateNext
+        CP.FluState[:]=FluStateNext
+    Profiler.end('merge')
+    Profiler.count('Agents', Touched)
+
+    return Sources, Targets
+
+
+#Agents in Covid states E and I among agents lo..hi-1, None if the active set mode is off
+def activeAgents(lo, hi):
+    if not ActiveSet:
+        return None
+    return ActiveE[np.searchsorted(ActiveE, lo):np.searchsorted(ActiveE, hi)], \
+           ActiveI[np.searchsorted(ActiveI, lo):np.searchsorted(ActiveI, hi)]
+
+
+#Updates agents lo..hi-1 by one day, writing CovidStateNext and FluStateNext
+#Infected agents of the range expose their susceptible fixed contacts; these
+#  (source, target) events are written to exposure buffer Slot and applied by updateState
+#The range is processed in blocks of BlockSize agents, each with its own random stream
+#Active: (E ids, I ids) of the range in the active set mode, None otherwise
+#Output: (number of events in the buffer, (Sources, Targets) that did not fit or None,
+#  changes of (CovidPerLocality, SymptomaticPerLocality, CovidPerHotspot),
+#  ids of the agents whose state changed in the active set mode (None otherwise),
+#  number of agents updated)
+
+def updateBlock(interventions, day, lo, hi, Slot, CovidPerNeighborhood, CovidPerHotspot, Active=None):
+    SourceParts=[]
+    TargetParts=[]
+    ChangedParts=[]
+    Changes=[0, 0, 0]
+    Agents=0
+    for BlockStart in range(lo, hi, BlockSize):
+        BlockEnd=min(BlockStart+BlockSize, hi)
+        rng=agentGenerator(RandSeed, day, BlockStart//BlockSize)
+        if Active is None:
+            Sources, Targets, BlockChanges = updateAgents(interventions, BlockStart, BlockEnd, \
+                                                          CovidPerNeighborhood, CovidPerHotspot, rng)
+            Agents+=BlockEnd-BlockStart
+        else:
+            E, I = (ids[np.searchsorted(ids, BlockStart):np.searchsorted(ids, BlockEnd)] for ids in Active)
+            Sources, Targets, BlockChanges, Changed, Touched = updateActiveAgents(interventions, BlockStart, BlockEnd, \
+                                                                                 CovidPerNeighborhood, CovidPerHotspot, rng, E, I)
+            ChangedParts.append(Changed)
+            Agents+=Touched
+        SourceParts.append(Sources)
+        TargetParts.append(Targets)
+        Changes=[Changes[k]+BlockChanges[k] for k in range(3)]
+    Sources=np.concatenate(SourceParts)
+    Targets=np.concatenate(TargetParts)
+
+    Start=ExposureStarts[Slot]
+    Count=min(len(Targets), ExposureStarts[Slot+1]-Start)
+    ExposureSources[Start:Start+Count]=Sources[:Count]
+    ExposureTargets[Start:Start+Count]=Targets[:Count]
+    Overflow=None
+    if Count<len(Targets):
+        Overflow=(Sources[Count:], Targets[Count:])
+
+    Changed=np.concatenate(ChangedParts) if Active is not None else None
+    return Count, Overflow, Changes, Changed, Agents
+
+
+#Updates agents lo..hi-1 by one day drawing from the Generator rng
 #Accesses functions InterventionRule from the file interventions and InfectRate
+#Output: (Sources, Targets) of the exposures along fixed contacts and
+#  the changes of the counters, computed from the agents whose state changed
 
-def updateState(interventions, day, i):
-    global CP, CarProb, ModelParams, CovidPerHotspot, PeoplePerHotspot, CovidPerNeighborhood, PeoplePerNeighborhood
-    
-    CovidState=CP.loc[i,'CovidState']
-    FluState=CP.loc[i,'FluState']
-    CovidStateOut=CovidState
-    FluStateOut=FluState
-    
-    localspread, globalspread = InterventionRule(interventions, CP, i)
-    
+def updateAgents(interventions, lo, hi, CovidPerNeighborhood, CovidPerHotspot, rng):
+    ids=np.arange(lo, hi)
+    Covid=CP.CovidState[lo:hi]
+    Flu=CP.FluState[lo:hi]
+    Loc=CP.Locality[lo:hi]
+    Hotspot=CP.Visits[lo:hi]
 
-    if FluState=="S":
-        if random.random()<ModelParams["FluRateVector"][0]:
-            FluStateOut="I"
-    else:
-        if random.random()<ModelParams["FluRateVector"][1]:
-            FluStateOut="S"
-    
-    if CovidState=="E":
-        if random.random()<ModelParams["CovidRateVector"][0]:
-            CovidStateOut="I"
-    elif CovidState=="I":
-        if random.random()<ModelParams["CovidRateVector"][1]:
-            CovidStateOut="R"
-        
+    localspread, globalspread = InterventionRule(interventions, CP, ids)
+    globalspread &= Hotspot<NumHotspots-1
 
-            
-    #LocalSpread
-    if localspread:
-         N= PeoplePerNeighborhood[CP.loc[i, 'localityIndex']-1]
-         NI=CovidPerNeighborhood[CP.loc[i, 'localityIndex']-1]
-         M=ModelParams["NeighborhoodContact"]
-         p=ModelParams["CovidInfectionRate"]
-
-         NeighborhoodRate=InfectRate(N, NI,M,p)
-         if CovidState=="S":
-             if random.random()<NeighborhoodRate:
-                 CovidStateOut="E"
-        
-         for contactId in CP.loc[i,'LocalContacts']:
-              if (CovidState=="I") and (CP.loc[contactId, 'CovidState'] =='S'):
-                  if random.random()<ModelParams['CovidInfectionRate']:
-                      CP.loc[contactId, 'CovidState'] ='E'
+    #One uniform draw per agent for flu, covid progression, neighborhood and hotspot
+    Draws=rng.random((4, hi-lo))
+
+    FluStateOut=Flu.copy()
+    FluStateOut[(Flu==FluStateS) & (Draws[0]<ModelParams["FluRateVector"][0])]=FluStateI
+    FluStateOut[(Flu==FluStateI) & (Draws[0]<ModelParams["FluRateVector"][1])]=FluStateS
+
+    CovidStateOut=Covid.copy()
+    CovidStateOut[(Covid==StateE) & (Draws[1]<ModelParams["CovidRateVector"][0])]=StateI
+    CovidStateOut[(Covid==StateI) & (Draws[1]<ModelParams["CovidRateVector"][1])]=StateR
 
+    Susceptible=Covid==StateS
+    p=ModelParams["CovidInfectionRate"]
+
+    #LocalSpread
+    NeighborhoodRate=InfectRate(PeoplePerNeighborhood, CovidPerNeighborhood, ModelParams["NeighborhoodContact"], p)
+    CovidStateOut[Susceptible & localspread & (Draws[2]<NeighborhoodRate[Loc])]=StateE
 
     #GlobalSpread
-    if globalspread:
-         hotspot=CP.loc[i, 'Visits']             
-    
-         if hotspot<len(CarProb[0])-1:
-             N=PeoplePerHotspot[hotspot]
-             NI=CovidPerHotspot[hotspot]
-             M=ModelParams["HotspotContact"]
-             p=ModelParams["CovidInfectionRate"]
-         
-
-             HotspotRate=InfectRate(N,NI,M,p)
-             if CovidState=="S":
-                 if random.random()<HotspotRate:
-                      CovidStateOut="E"
-
-             for contactId in CP.loc[i,'VisitsContacts']:
-                 if (CovidState=="I") and (CP.loc[contactId, 'CovidState'] =='S'):
-                     if random.random()<ModelParams['CovidInfectionRate']:
-                         CP.loc[contactId, 'CovidState'] ='E'
-                         
-                         
-    return [CovidStateOut, FluStateOut]
+    HotspotRate=InfectRate(PeoplePerHotspot, CovidPerHotspot, ModelParams["HotspotContact"], p)
+    CovidStateOut[Susceptible & globalspread & (Draws[3]<HotspotRate[Hotspot])]=StateE
+
+    CovidStateNext[lo:hi]=CovidStateOut
+    FluStateNext[lo:hi]=FluStateOut
+
+    #Exposures (S to E) do not change the counters, so only the transitions above are counted
+    Changed=np.flatnonzero((CovidStateOut!=Covid) | (FluStateOut!=Flu))
+    InfectedBefore=Covid[Changed]==StateI
+    InfectedAfter=CovidStateOut[Changed]==StateI
+    InfectedChange=InfectedAfter.astype(np.int64)-InfectedBefore
+    SymptomaticChange=(InfectedAfter | (FluStateOut[Changed]==FluStateI)).astype(np.int64)-(InfectedBefore | (Flu[Changed]==FluStateI))
+    NumLocalities=len(PeoplePerNeighborhood)
+    Changes=(np.bincount(Loc[Changed], weights=InfectedChange, minlength=NumLocalities).astype(np.int64), \
+             np.bincount(Loc[Changed], weights=SymptomaticChange, minlength=NumLocalities).astype(np.int64), \
+             np.bincount(Hotspot[Changed], weights=InfectedChange, minlength=NumHotspots).astype(np.int64))
+
+    #Fixed contacts of infected agents, using the states at the start of the day
+    Infected=Covid==StateI
+    SourceParts=[]
+    TargetParts=[]
+    for Offsets, Indices, Spread in ((CP.LocalOffsets, CP.LocalIndices, localspread), \
+                                     (CP.VisitsOffsets, CP.VisitsIndices, globalspread)):
+        Sources, Targets = gatherContacts(Offsets, Indices, ids[Infected & Spread])
+        Hit=(CP.CovidState[Targets]==StateS) & (rng.random(len(Targets))<p)
+        SourceParts.append(Sources[Hit])
+        TargetParts.append(Targets[Hit])
+
+    return np.concatenate(SourceParts), np.concatenate(TargetParts), Changes
+
+
+#Active set version of updateAgents: updates agents lo..hi-1 by one day touching only
+#  the agents that can change state
+# - Covid E and I agents (E, I: their sorted ids) progress with one draw each
+# - Flu transitions and the neighborhood and hotspot infections are drawn in aggregate:
+#   the candidates of a transition of rate q are the successes of hi-lo Bernoulli(q)
+#   trials, found by geometric skips (see bernoulliPositions), and the transition is
+#   applied to the candidates in the required state. For infections q is the largest
+#   rate among the localities of the block (or the hotspots), rates being clipped to 1,
+#   and a candidate is kept with probability (its rate)/q, so every agent is infected
+#   with its own rate
+#Every agent follows the same transition probabilities as in updateAgents
+#Output: as updateAgents, plus the ids of the agents whose state changed and the number
+#  of agents drawn
+
+def updateActiveAgents(interventions, lo, hi, CovidPerNeighborhood, CovidPerHotspot, rng, E, I):
+    n=hi-lo
+    p=ModelParams["CovidInfectionRate"]
+
+    FluOn=lo+bernoulliPositions(n, ModelParams["FluRateVector"][0], rng)
+    FluOn=FluOn[CP.FluState[FluOn]==FluStateS]
+    FluOff=lo+bernoulliPositions(n, ModelParams["FluRateVector"][1], rng)
+    FluOff=FluOff[CP.FluState[FluOff]==FluStateI]
+
+    ToI=E[rng.random(len(E))<ModelParams["CovidRateVector"][0]]
+    ToR=I[rng.random(len(I))<ModelParams["CovidRateVector"][1]]
+
+    #LocalSpread, among the localities of the block; rates above 1 infect with probability 1
+    #  as in updateAgents, so they are clipped before thinning by the largest rate
+    NeighborhoodRate=np.minimum(InfectRate(PeoplePerNeighborhood, CovidPerNeighborhood, ModelParams["NeighborhoodContact"], p), 1)
+    Block=lo//BlockSize
+    MaxRate=NeighborhoodRate[BlockLocalities[BlockLocalityOffsets[Block]:BlockLocalityOffsets[Block+1]]].max(initial=0)
+    Local=lo+bernoulliPositions(n, MaxRate, rng)
+    Local=Local[rng.random(len(Local))*MaxRate<NeighborhoodRate[CP.Locality[Local]]]
+    Local=Local[(CP.CovidState[Local]==StateS) & InterventionRule(interventions, CP, Local)[0]]
+
+    #GlobalSpread, the last hotspot standing for no hotspot
+    HotspotRate=np.minimum(InfectRate(PeoplePerHotspot, CovidPerHotspot, ModelParams["HotspotContact"], p), 1)
+    HotspotRate[NumHotspots-1:]=0
+    MaxRate=HotspotRate.max(initial=0)
+    Global=lo+bernoulliPositions(n, MaxRate, rng)
+    Global=Global[rng.random(len(Global))*MaxRate<HotspotRate[CP.Visits[Global]]]
+    Global=Global[(CP.CovidState[Global]==StateS) & InterventionRule(interventions, CP, Global)[1]]
+
+    FluStateNext[FluOn]=FluStateI
+    FluStateNext[FluOff]=FluStateS
+    CovidStateNext[ToI]=StateI
+    CovidStateNext[ToR]=StateR
+    CovidStateNext[Local]=StateE
+    CovidStateNext[Global]=StateE
+
+    #Counters, as in updateAgents
+    Changed=np.unique(np.concatenate((FluOn, FluOff, ToI, ToR, Local, Global)))
+    Loc=CP.Locality[Changed]
+    Hotspot=CP.Visits[Changed]
+    InfectedBefore=CP.CovidState[Changed]==StateI
+    InfectedAfter=CovidStateNext[Changed]==StateI
+    InfectedChange=InfectedAfter.astype(np.int64)-InfectedBefore
+    SymptomaticChange=(InfectedAfter | (FluStateNext[Changed]==FluStateI)).astype(np.int64)-(InfectedBefore | (CP.FluState[Changed]==FluStateI))
+    NumLocalities=len(PeoplePerNeighborhood)
+    Changes=(np.bincount(Loc, weights=InfectedChange, minlength=NumLocalities).astype(np.int64), \
+             np.bincount(Loc, weights=SymptomaticChange, minlength=NumLocalities).astype(np.int64), \
+             np.bincount(Hotspot, weights=InfectedChange, minlength=NumHotspots).astype(np.int64))
+
+    #Fixed contacts of infected agents, using the states at the start of the day
+    localspread, globalspread = InterventionRule(interventions, CP, I)
+    globalspread &= CP.Visits[I]<NumHotspots-1
+    SourceParts=[]
+    TargetParts=[]
+    for Offsets, Indices, Spread in ((CP.LocalOffsets, CP.LocalIndices, localspread), \
+                                     (CP.VisitsOffsets, CP.VisitsIndices, globalspread)):
+        Sources, Targets = gatherContacts(Offsets, Indices, I[Spread])
+        Hit=(CP.CovidState[Targets]==StateS) & (rng.random(len(Targets))<p)
+        SourceParts.append(Sources[Hit])
+        TargetParts.append(Targets[Hit])
+
+    Touched=len(FluOn)+len(FluOff)+len(E)+len(I)+len(Local)+len(Global)
+    return np.concatenate(SourceParts), np.concatenate(TargetParts), Changes, Changed, Touched
+
+
+#Positions of the successes among n Bernoulli(q) trials, in increasing order
+#The gaps between successes are geometric, so the cost is proportional to the number of successes
+def bernoulliPositions(n, q, rng):
+    if q<=0 or n==0:
+        return np.zeros(0, dtype=np.int64)
+    if q>=1:
+        return np.arange(n)
+    Parts=[]
+    Last=-1
+    while True:
+        Positions=Last+np.cumsum(rng.geometric(q, int(n*q+4*np.sqrt(n*q))+16))
+        if Positions[-1]>=n:
+            Parts.append(Positions[Positions<n])
+            return np.concatenate(Parts)
+        Parts.append(Positions)
+        Last=Positions[-1]
 
 
 #This function computes random infection rate for a pool
@@ -302,17 +792,6 @@ def updateState(interventions, day, i):
 # NI: number of infected
 # M: random contacts number
 # p: probability of infection on meeting
+#N, NI can be arrays over pools; pools with no people have rate 0
 def InfectRate(N,NI, M, p):
-    return NI*M*p/N
-
-
-#This function updates the Covid Positive Counts for neighborhoods
-def updateCountNeighborhood(CD, i):
-    return CP.loc[(CP['locality'].isin(CD.loc[CD['locality_id']==i+1].locality_neighbors.values[0].split(", "))) & \
-                                 (CP['CovidState']=='I') ].shape[0] 
-        
-#This function updates the Covid Positive Counts for hotspots
-def updateCountHotspot(i):
-        return CP.loc[(CP['Visits']==i) & (CP['CovidState']=='I')].shape[0]
-
-
+    return np.divide(NI*M*p, N, out=np.zeros(np.shape(N)), where=np.asarray(N)>0)
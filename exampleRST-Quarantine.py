@@ -1,14 +1,11 @@
 #This example runs the simulation using testing policy RST and intervention policy Quarantine
-#The output is stored in example/SimulationResults/outputData
-#Note that the output data is uncompressed and the size can be significantly reduced
-# by compressing using, for instnace, gzip
+#The output of every iteration is added to the compressed result store
+# example/SimulationResults/OutputData (see resultstore.py)
 
 
 #Dependencies
 import numpy as np
-import matplotlib.pyplot as plt
 from functools import partial
-import pickle
 import random as random
 import os
 
@@ -17,6 +14,7 @@ from evolution import simulate
 from interventions import InterventionQuarantine
 from tests import RandomSymptomaticTesting
 from inoutfuncs import setupcitydata
+from resultstore import ResultStore
 
 #Read Bangalore data using function setupcitydata available in inoutfuncs
 CD, CarProb=setupcitydata('example/InputData/city.geojson', 'example/InputData/car-prob.csv')
@@ -105,12 +103,15 @@ elif seed == 'clustered':
     initflucts = np.random.binomial(1, InitFracLocalitiesFlu, CD.shape[0]).tolist()
 
 ###Call to the simulate function in evolution.py
-OutputFileNamePrefix=ParentDirectory+OutputDirectory+"RandomSymptomaticTesting_UniformSeed_InterventionQuarantine_TestingBudget50_FalseNegative0" 
+Store=ResultStore(ParentDirectory+OutputDirectory)
 for i in range(Iterations):
     CovidCases, TestingHistory,  Symptomatic, Localities = simulate(Days, Population, ModelParams, CD, CarProb, interventionPolicy, testingPolicy,\
-                                                                    InitCovidCounts=initcovidcts, InitFluCounts=initflucts)    
+                                                                    InitCovidCounts=initcovidcts, InitFluCounts=initflucts, randseed=i)    
     print("Iteration number:"+str(i))
-    FileName = OutputFileNamePrefix + "_Iter_" + str(i) + ".pickle"
-    with open(FileName, "wb") as f:
-        pickle.dump((CovidCases, TestingHistory, Symptomatic, Localities), f)
-        print("Results saved in " + FileName)
+    Run = Store.append(CovidCases, TestingHistory, Symptomatic, Localities, Iteration=i, \
+                       TestingPolicy="RandomSymptomaticTesting", InterventionPolicy="InterventionQuarantine", \
+                       Seeding=seed, TestingBudget=TestingBudget, FalseNegative=FalseNegative)
+    print("Results saved as run " + Run + " in " + Store.Directory)
+
+#Stack the series of all runs for the plotting notebook
+Store.consolidate()
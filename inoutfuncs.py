@@ -1,37 +1,112 @@
-import geopandas as gpd
 import pandas
-import matplotlib.pyplot as plt
 import csv
+import os
+import hashlib
 import numpy as np
 
-#Read Bangalore data
-def setupcitydata(citygeojson, trafficcsv):
-    city=gpd.read_file(citygeojson)
+#Version of the compiled city files, bumped when their content changes
+CityCacheVersion=1
 
-    #Add Neigbors
-    for index, row in city.iterrows():  
-        neighbors = city[city.geometry.touches(row['geometry'])].wardName.tolist() 
-        city.at[index, "locality_neighbors"] = ", ".join(neighbors)
+#Read Bangalore data
+#The processed city is compiled once into an .npz file in CacheDirectory (by default the
+#  directory .citycache next to citygeojson), named by the hash of the two input files.
+#  Later calls load it without reading the geometries, so geopandas is not imported.
+#  Use CacheDirectory=None to always process the input files.
+#Output
+# CD: pandas frame with one row per locality, sorted by locality_id, with the columns
+#     locality_density, locality_neighbors, locality_name and locality_id
+# CarProb: array of the probabilities of visiting each hotspot, one row per locality
+def setupcitydata(citygeojson, trafficcsv, CacheDirectory=''):
+    if CacheDirectory=='':
+        CacheDirectory=os.path.join(os.path.dirname(os.path.abspath(citygeojson)), '.citycache')
+    CacheFile=None
+    if CacheDirectory is not None:
+        CacheFile=os.path.join(CacheDirectory, cityKey(citygeojson, trafficcsv)+'.npz')
+        if os.path.exists(CacheFile):
+            CD, CarProb = loadcity(CacheFile)
+            print("City Data setup complete")
+            return CD, CarProb
+
+    City=compilecity(citygeojson, trafficcsv)
+    if CacheFile is not None:
+        try:
+            os.makedirs(CacheDirectory, exist_ok=True)
+            Temporary=CacheFile+'.'+str(os.getpid())+'.tmp.npz'
+            np.savez(Temporary, **City)
+            os.replace(Temporary, CacheFile)
+        except OSError:
+            #The cache is optional, e.g. for read-only input directories
+            pass
+    CD, CarProb = cityframe(City)
+    print("City Data setup complete")
+    return CD, CarProb
 
-    density = city['POP_TOTAL']/sum(city['POP_TOTAL'])
-    city['locality_density']=density
 
-    CD = city[['locality_density', 'geometry', 'locality_neighbors']]
-    CD = CD.assign(locality_name=city['wardName'])
-    CD = CD.assign(locality_id=city['wardNo'].astype(int))
+#Hash of the input files of setupcitydata
+def cityKey(citygeojson, trafficcsv):
+    h=hashlib.sha256(('CovidSim city '+str(CityCacheVersion)).encode())
+    for Path in [citygeojson, trafficcsv]:
+        with open(Path, 'rb') as f:
+            for Chunk in iter(lambda: f.read(1<<20), b''):
+                h.update(Chunk)
+        h.update(b'\x00')
+    return h.hexdigest()
+
+
+#Reads the input files and computes the adjacency of the localities
+#Output: dictionary of arrays, rows sorted by locality_id
+# Ids, Names: locality_id and wardName of every locality
+# Density: fraction of the population (POP_TOTAL) living in every locality
+# NeighborOffsets, NeighborIndices: the neighbors of row r are the rows
+#     NeighborIndices[NeighborOffsets[r]:NeighborOffsets[r+1]], in the order of the input file
+# CarProb: probabilities read from trafficcsv
+def compilecity(citygeojson, trafficcsv):
+    import geopandas as gpd
+    from shapely import STRtree
 
-    CD=CD.sort_values(by=['locality_id'], ignore_index=True)
+    city=gpd.read_file(citygeojson)
 
-    CarProb=[]
+    #Add Neigbors: pairs of touching geometries found through a spatial index
+    Geometries=city.geometry.values
+    Pairs=STRtree(Geometries).query(Geometries, predicate='touches')
+    Pairs=Pairs[:, np.lexsort((Pairs[1], Pairs[0]))]
+
+    Ids=city['wardNo'].astype(int).to_numpy()
+    Order=np.argsort(Ids, kind='stable')
+    RowOf=np.empty(len(Order), dtype=np.int64)
+    RowOf[Order]=np.arange(len(Order))
+    Degree=np.bincount(RowOf[Pairs[0]], minlength=len(Order))
+    NeighborOffsets=np.zeros(len(Order)+1, dtype=np.int64)
+    np.cumsum(Degree, out=NeighborOffsets[1:])
+    #Stable sort by row keeps the neighbors of each row in file order
+    NeighborIndices=RowOf[Pairs[1][np.argsort(RowOf[Pairs[0]], kind='stable')]]
 
     with open(trafficcsv, 'r') as file:
         data =list(csv.reader(file, delimiter=','))
 
-        CarProb = np.array(data[0:], dtype=np.float)
+        CarProb = np.array(data[0:], dtype=float)
 
-    print("City Data setup complete")
+    return {'Ids': Ids[Order], 'Names': city['wardName'].to_numpy(dtype=str)[Order], \
+            'Density': (city['POP_TOTAL']/sum(city['POP_TOTAL'])).to_numpy(dtype=np.float64)[Order], \
+            'NeighborOffsets': NeighborOffsets, 'NeighborIndices': NeighborIndices, 'CarProb': CarProb}
 
-    return CD, CarProb
+
+#Reads a city compiled by setupcitydata
+def loadcity(CacheFile):
+    with np.load(CacheFile) as Data:
+        return cityframe({Name: Data[Name] for Name in Data.files})
+
+
+#CD and CarProb of a compiled city
+def cityframe(City):
+    Names=City['Names']
+    Offsets=City['NeighborOffsets']
+    Neighbors=[", ".join(Names[City['NeighborIndices'][Offsets[r]:Offsets[r+1]]]) for r in range(len(Names))]
+    CD=pandas.DataFrame({'locality_density': City['Density'], \
+                         'locality_neighbors': Neighbors, \
+                         'locality_name': Names.astype(object), \
+                         'locality_id': City['Ids'].astype(int)})
+    return CD, City['CarProb']
 
 
 
@@ -43,6 +118,8 @@ def setupcitydata(citygeojson, trafficcsv):
 # TestingHistory: Day-wise testing history with
 #                 +1 for positive and -1 for negative, 0 for not tested
 def plotresults(CovidCases, TestingHistory):
+    import matplotlib.pyplot as plt
+
     NumSteps=TestingHistory.shape[1]
     evolutionCases = [sum(CovidCases.values())[j] for j in range(NumSteps)]
     evolutionTests = [np.sum(  TestingHistory[TestingHistory[:,j] > 0, j]  )    for j in range(NumSteps)]
@@ -2,23 +2,35 @@
 #Interventions allowed: None, LockAll, LockCommute
 
 import numpy as np
+from population import QuarantineBit, gatherContacts
+
+#Number of days an agent stays in quarantine
+QuarantineDuration=10
+
+#Intervention policies are called as policy(TestingHistory, InterventionsHistory, CP, day)
+#InterventionsHistory is the DailyStats of the simulation (see dailystats.py): the list of
+#  past interventions, with the daily counts of tests and the lockdown episodes
 
 #Interpretting the interventions for the updateState function
 #Should be elaborating for every new intervention
+#Inputs
+# CP: the population (a CityPopulation)
+# ids: array of agent ids
+#Outputs boolean arrays localspread, globalspread over ids
 
-def InterventionRule(interventions, CP, i):
-    localspread=True
-    globalspread=True
-    QuarantineDuration=10
+def InterventionRule(interventions, CP, ids):
+    localspread=np.ones(len(ids), dtype=bool)
+    globalspread=np.ones(len(ids), dtype=bool)
     if 'LockAll' in interventions:
-        localspread=False
-        globalspread=False
+        localspread[:]=False
+        globalspread[:]=False
     elif 'LockCommute' in interventions:
-        globalspread=False   
-    elif ('Quarantine' in interventions) and (CP.loc[i,'quarantine']==1):
-        if i<CP.loc[i,'quarantineDay']+QuarantineDuration:
-            localspread=False
-            globalspread=False
+        globalspread[:]=False   
+    elif 'Quarantine' in interventions:
+        #Expired quarantines are released by the QuarantineIndex at the start of the day
+        isolated=CP.quarantined(ids)
+        localspread[isolated]=False
+        globalspread[isolated]=False
 
     return localspread, globalspread
 
@@ -36,9 +48,7 @@ def InterventionLockdown(TestingHistory, InterventionsHistory, CP, day):
     threshold = 0.5 #Slope 1/2
     changeTime=10
     window=8
-    normalizedChange= sum([np.sum(TestingHistory[TestingHistory[:,day-j]>0, day-j]) \
-                           -  np.sum(TestingHistory[TestingHistory[:,day-changeTime-j]>0, day-changeTime-j]) \
-             for j in range(min(window, day+1-changeTime))])/(window*changeTime)
+    normalizedChange=InterventionsHistory.slope(day, window, changeTime)
     print('Slope='+str(normalizedChange))
 
     if day>=1:
@@ -56,23 +66,16 @@ def InterventionLockdownFixed(TestingHistory, InterventionsHistory, CP, day):
     changeTime=10
     window=8
     duration=14
-    normalizedChange= sum([np.sum(TestingHistory[TestingHistory[:,day-j]>0, day-j]) \
-                           -  np.sum(TestingHistory[TestingHistory[:,day-changeTime-j]>0, day-changeTime-j]) \
-             for j in range(min(window, day+1-changeTime))])/(window*changeTime)
+    normalizedChange=InterventionsHistory.slope(day, window, changeTime)
     print('Slope='+str(normalizedChange))
 
     flag=0
     startDate=100
     
-    for i in range(day):
-        if flag==0 and ('LockAll' in InterventionsHistory[i]):
-          flag=1
-
-    if flag==1:
-        i=1
-        while not (('LockAll' in InterventionsHistory[day-i]) and (not('LockAll' in InterventionsHistory[day-i-1]))):
-            i=i+1
-        startDate=day-i+1    
+    #The duration is counted from the day after the start of the last LockAll episode
+    if InterventionsHistory.lockdownStart() is not None:
+        flag=1
+        startDate=InterventionsHistory.lockdownStart()+1
           
     if day>=1:
         if normalizedChange>threshold or ((day<=startDate+duration) and (flag==1)):
@@ -87,14 +90,71 @@ def InterventionLockdownFixed(TestingHistory, InterventionsHistory, CP, day):
 def InterventionNone(TestingHistory, InterventionsHistory, CP, day):
     return []
     
+#Quarantine the people who tested positive in the last round of tests and their contacts
+#Tests run after the intervention policy, so the last round is the one of day-1
 def InterventionQuarantine(TestingHistory, InterventionsHistory, CP, day):
-        
-    for i in range(TestingHistory.shape[0]):
-        if TestingHistory[i,day]==1:
-            QuarantineList= CP.loc[i,'LocalContacts']+CP.loc[i,'VisitsContacts']+[i]
-            for j in QuarantineList:
-                CP.loc[j, 'quarantine']=1
-                CP.loc[j, 'quarantineDay']=day
+    if day>=1:
+        Positives=TestingHistory.positives(day-1)
+        LocalSources, LocalContacts = gatherContacts(CP.LocalOffsets, CP.LocalIndices, Positives)
+        VisitsSources, VisitsContacts = gatherContacts(CP.VisitsOffsets, CP.VisitsIndices, Positives)
+        quarantine(CP, np.concatenate((Positives, LocalContacts, VisitsContacts)), day-1)
             
     return ['Quarantine']
 
+
+#Quarantines the agents ids from day on, for QuarantineDuration days
+def quarantine(CP, ids, day):
+    quarantineIndex(CP).add(ids, day)
+
+
+#The QuarantineIndex of CP, created on first use
+def quarantineIndex(CP):
+    if CP.QuarantineIndex is None:
+        CP.QuarantineIndex=QuarantineIndex(CP)
+    return CP.QuarantineIndex
+
+
+#Expiry-ordered index of the quarantined agents of CP
+#Agents are kept in buckets by the day their quarantine expires, so that releasing
+#  the quarantines expiring on a day only touches those agents
+#An agent quarantined again before expiry is left in its old bucket and skipped
+#  when that bucket is released
+class QuarantineIndex:
+
+    def __init__(self, CP, Duration=QuarantineDuration):
+        self.CP=CP
+        self.Duration=Duration
+        self.Expiries={}
+
+    #Sets the quarantine flag and day of the agents ids
+    def add(self, ids, day):
+        ids=np.unique(np.asarray(ids, dtype=np.int64))
+        if len(ids)==0:
+            return
+        self.CP.setFlag(QuarantineBit, ids, 1)
+        self.CP.QuarantineDay[ids]=day
+        self.Expiries.setdefault(day+self.Duration, []).append(ids)
+
+    #Adds the agents ids, already flagged, with the expiry of their QuarantineDay
+    def track(self, ids):
+        ids=np.unique(np.asarray(ids, dtype=np.int64))
+        Expiry=self.CP.QuarantineDay[ids].astype(np.int64)+self.Duration
+        for d in np.unique(Expiry):
+            self.Expiries.setdefault(int(d), []).append(ids[Expiry==d])
+
+    #Clears the quarantine flag of the agents whose quarantine has expired by day
+    #Output: the ids released
+    def release(self, day):
+        Released=[]
+        for Expiry in sorted(d for d in self.Expiries if d<=day):
+            for ids in self.Expiries.pop(Expiry):
+                Released.append(ids[self.CP.quarantined(ids) & (self.CP.QuarantineDay[ids]+self.Duration<=day)])
+        ids=np.unique(np.concatenate(Released)) if Released else np.zeros(0, dtype=np.int64)
+        self.CP.setFlag(QuarantineBit, ids, 0)
+        return ids
+
+    def copy(self, CP):
+        Index=QuarantineIndex(CP, self.Duration)
+        Index.Expiries={d: list(Buckets) for d, Buckets in self.Expiries.items()}
+        return Index
+
@@ -0,0 +1,147 @@
+#Content-addressed cache of initialized populations
+#Building the population (localities, hotspots and fixed contacts, see InitializeArrays in
+#  evolution.py) depends only on the city data, the fixed contact parameters, the number
+#  of people and the seed, and can take longer than the epidemic itself. PopulationCache
+#  stores the arrays it produces in a directory named by the sha256 of these inputs, one
+#  .npy file per array.
+#Cached arrays are memory-mapped read-only, so replicates on the same node share one copy
+#  of the contact graph through the page cache (the workers of simulate map the same files,
+#  see workers.py); only the mutable state columns are allocated per population.
+#The cache is kept under MaxBytes by removing the least recently used entries.
+#
+#Usage:
+# Cache=PopulationCache('cache/populations', MaxBytes=8<<30)
+# simulate(..., PopulationCache=Cache)
+
+import os
+import shutil
+import hashlib
+import random
+import uuid
+import numpy as np
+
+from population import CityPopulation, localityNames, transposeContacts
+
+#Bumped whenever InitializeArrays draws the population differently or the cached arrays change
+CacheVersion=2
+
+#Arrays stored in the cache; the other arrays of CityPopulation change during a simulation
+CachedArrays=['Locality', 'Visits', 'LocalOffsets', 'LocalIndices', 'VisitsOffsets', 'VisitsIndices', \
+              'LocalInOffsets', 'LocalInIndices', 'VisitsInOffsets', 'VisitsInIndices']
+
+#Marks an entry completely written
+CompleteFile='complete'
+
+
+#Cache key of the population built from these inputs
+def populationKey(CD, CarProb, ModelParams, Population, randseed=0):
+    h=hashlib.sha256()
+    h.update(('CovidSim population '+str(CacheVersion)).encode())
+    h.update(np.ascontiguousarray(CD['locality_id'].to_numpy(dtype=np.int64)).tobytes())
+    h.update(np.ascontiguousarray(CD['locality_density'].to_numpy(dtype=np.float64)).tobytes())
+    for Name in ['locality_name', 'locality_neighbors']:
+        h.update('\x00'.join(str(Value) for Value in CD[Name]).encode())
+    CarProb=np.ascontiguousarray(np.asarray(CarProb, dtype=np.float64))
+    h.update(str(CarProb.shape).encode())
+    h.update(CarProb.tobytes())
+    h.update(repr((int(Population), int(ModelParams['NeighborhoodContactFixed']), \
+                   int(ModelParams['HotspotContactFixed']), int(randseed))).encode())
+    return h.hexdigest()
+
+
+class PopulationCache:
+
+    def __init__(self, Directory, MaxBytes=8<<30):
+        self.Directory=Directory
+        self.MaxBytes=MaxBytes
+        os.makedirs(Directory, exist_ok=True)
+
+    #Population for these inputs, from the cache or built and added to it
+    #Output: a CityPopulation whose contact and locality arrays are read-only memory maps
+    def initialize(self, CD, CarProb, ModelParams, Population, randseed=0):
+        Key=populationKey(CD, CarProb, ModelParams, Population, randseed)
+        Arrays=self.load(Key)
+        if Arrays is None:
+            from evolution import InitializeArrays
+            self.store(Key, InitializeArrays(CD, CarProb, ModelParams, Population, randseed))
+            Arrays=self.load(Key)
+        else:
+            #Same state of the global generators as after InitializeArrays
+            random.seed(randseed+1)
+            np.random.seed(randseed)
+            print("City Population Data loaded from cache "+Key[:12])
+        LocalityNames, NeighborhoodNames = localityNames(CD)
+        PopulationEffective=len(Arrays['Visits'])
+        CP=CityPopulation(LocalityNames, NeighborhoodNames, \
+                          CovidState=np.zeros(PopulationEffective, dtype=np.int8), \
+                          FluState=np.zeros(PopulationEffective, dtype=np.int8), \
+                          Locality=Arrays['Locality'], Visits=Arrays['Visits'], \
+                          Flags=np.zeros(PopulationEffective, dtype=np.uint8), \
+                          QuarantineDay=np.full(PopulationEffective, -1, dtype=np.int16), \
+                          LocalOffsets=Arrays['LocalOffsets'], LocalIndices=Arrays['LocalIndices'], \
+                          VisitsOffsets=Arrays['VisitsOffsets'], VisitsIndices=Arrays['VisitsIndices'], \
+                          LocalInOffsets=Arrays['LocalInOffsets'], LocalInIndices=Arrays['LocalInIndices'], \
+                          VisitsInOffsets=Arrays['VisitsInOffsets'], VisitsInIndices=Arrays['VisitsInIndices'])
+        CP.RandSeed=randseed
+        return CP
+
+    #Arrays of entry Key as read-only memory maps, None if it is not cached
+    def load(self, Key):
+        Path=os.path.join(self.Directory, Key)
+        if not os.path.exists(os.path.join(Path, CompleteFile)):
+            return None
+        #The modification time of the marker orders the entries by last use
+        os.utime(os.path.join(Path, CompleteFile))
+        return {Name: np.load(os.path.join(Path, Name+'.npy'), mmap_mode='r') for Name in CachedArrays}
+
+    #Writes the arrays returned by InitializeArrays as entry Key
+    #The entry is written to a temporary directory and renamed, so that readers never see
+    #  a partial entry; if another process stored the same entry first, this copy is dropped
+    def store(self, Key, Arrays):
+        Path=os.path.join(self.Directory, Key)
+        Temporary=os.path.join(self.Directory, '.'+Key+'.'+uuid.uuid4().hex)
+        Arrays=dict(Arrays, Locality=(Arrays['LocalityIndex']-1).astype(np.int16))
+        Arrays['LocalInOffsets'], Arrays['LocalInIndices'] = transposeContacts(Arrays['LocalOffsets'], Arrays['LocalIndices'])
+        Arrays['VisitsInOffsets'], Arrays['VisitsInIndices'] = transposeContacts(Arrays['VisitsOffsets'], Arrays['VisitsIndices'])
+        os.makedirs(Temporary)
+        try:
+            for Name in CachedArrays:
+                np.save(os.path.join(Temporary, Name+'.npy'), Arrays[Name])
+            open(os.path.join(Temporary, CompleteFile), 'w').close()
+            os.rename(Temporary, Path)
+        except OSError:
+            if not os.path.exists(os.path.join(Path, CompleteFile)):
+                raise
+        finally:
+            shutil.rmtree(Temporary, ignore_errors=True)
+        self.evict(Keep=Key)
+
+    #Removes the least recently used entries until the cache holds at most MaxBytes
+    #Entry Keep is never removed
+    def evict(self, Keep=None):
+        Entries=self.entries()
+        Total=sum(Size for Key, Size, Used in Entries)
+        for Key, Size, Used in sorted(Entries, key=lambda Entry: Entry[2]):
+            if Total<=self.MaxBytes:
+                break
+            if Key==Keep:
+                continue
+            #Processes that have the files mapped keep them until they unmap them
+            shutil.rmtree(os.path.join(self.Directory, Key), ignore_errors=True)
+            Total-=Size
+
+    #List of (key, bytes, last use time) of the complete entries
+    def entries(self):
+        Entries=[]
+        for Key in os.listdir(self.Directory):
+            Path=os.path.join(self.Directory, Key)
+            if Key.startswith('.') or not os.path.exists(os.path.join(Path, CompleteFile)):
+                continue
+            Size=sum(os.path.getsize(os.path.join(Path, Name)) for Name in os.listdir(Path))
+            Entries.append((Key, Size, os.path.getmtime(os.path.join(Path, CompleteFile))))
+        return Entries
+
+    #Removes all entries
+    def clear(self):
+        for Key, Size, Used in self.entries():
+            shutil.rmtree(os.path.join(self.Directory, Key), ignore_errors=True)
@@ -0,0 +1,381 @@
+#Compact columnar store for the city population CP
+#CityPopulation keeps one typed numpy array per attribute of the agents:
+# CovidState, FluState: int8 state codes (see CovidStateNames and FluStateNames)
+# Locality: int16 locality index, zero-based (localityIndex-1)
+# Visits: int16 index of the hotspot visited (the last index means none)
+# Flags: uint8 bit field holding the quarantine and CovidPositive flags
+# QuarantineDay: int16 day on which the agent was last quarantined, -1 if never
+#The quarantine flag marks the agents currently in quarantine; the QuarantineIndex of
+#  interventions.py (kept in CP.QuarantineIndex) clears it when the quarantine expires,
+#  also for quarantines written through the quarantine and quarantineDay columns
+# LocalOffsets/LocalIndices, VisitsOffsets/VisitsIndices: fixed contacts in CSR form
+#Locality and neighborhood names are stored once per locality
+#
+#It can be used in place of the pandas frame CP of earlier versions: columns are read as
+#  pandas Series with CP['CovidState'], single values with CP.loc[i, 'CovidState'] and rows
+#  with CP.loc[rows] (returned as a pandas frame). The columns CovidState, FluState, Visits,
+#  quarantine, quarantineDay and CovidPositive can be written the same way.
+
+import importlib
+import numpy as np
+
+
+#Module imported on first use of one of its attributes
+#pandas is only needed by the frame interface, so that the simulation core imports numpy only
+class _LazyModule:
+
+    def __init__(self, Name):
+        self.Name=Name
+
+    def __getattr__(self, Attr):
+        return getattr(importlib.import_module(self.Name), Attr)
+
+pd=_LazyModule('pandas')
+
+
+#State codes
+#CovidState: S=0, E=1, I=2, R=3 and FluState: S=0, I=1
+CovidStateNames=np.array(['S', 'E', 'I', 'R'])
+FluStateNames=np.array(['S', 'I'])
+StateS, StateE, StateI, StateR = 0, 1, 2, 3
+FluStateS, FluStateI = 0, 1
+#The vectorized updates (see replicates.py) move an agent to the next Covid state by adding 1
+assert (StateE, StateI, StateR)==(StateS+1, StateS+2, StateS+3)
+
+#Bits of CityPopulation.Flags
+QuarantineBit=1
+PositiveBit=2
+
+#Columns of the frame view, in the order of the original CP
+Columns=["id", "localityIndex", "locality", "CovidState", "FluState",\
+         "Visits", "neighborhood", "LocalContacts","VisitsContacts",\
+         "quarantine","quarantineDay","CovidPositive"]
+
+
+class CityPopulation:
+
+    #Names of the per-agent arrays
+    #The In arrays are the transposes of the contact lists: agent j's in-contacts are the
+    #  agents that have j among their contacts
+    Arrays=['CovidState', 'FluState', 'Locality', 'Visits', 'Flags', 'QuarantineDay', \
+            'LocalOffsets', 'LocalIndices', 'VisitsOffsets', 'VisitsIndices', \
+            'LocalInOffsets', 'LocalInIndices', 'VisitsInOffsets', 'VisitsInIndices']
+
+    #LocalityNames, NeighborhoodNames: names indexed by locality index
+    #Arrays: one numpy array for every entry of CityPopulation.Arrays
+    def __init__(self, LocalityNames, NeighborhoodNames, **Arrays):
+        for Name in self.Arrays:
+            setattr(self, Name, Arrays[Name])
+        self.LocalityNames=np.asarray(LocalityNames, dtype=object)
+        self.NeighborhoodNames=np.asarray(NeighborhoodNames, dtype=object)
+        self.QuarantineIndex=None
+        #Seed of the random streams of the policies (see randomstreams.py)
+        self.RandSeed=0
+        self.loc=_LocIndexer(self)
+
+    #New population of susceptible agents
+    #Locality: zero-based locality index of each agent, Visits: hotspot of each agent
+    @classmethod
+    def create(cls, LocalityNames, NeighborhoodNames, Locality, Visits, \
+               LocalOffsets, LocalIndices, VisitsOffsets, VisitsIndices):
+        PopulationEffective=len(Locality)
+        LocalInOffsets, LocalInIndices = transposeContacts(LocalOffsets, LocalIndices)
+        VisitsInOffsets, VisitsInIndices = transposeContacts(VisitsOffsets, VisitsIndices)
+        return cls(LocalityNames, NeighborhoodNames, \
+                   CovidState=np.zeros(PopulationEffective, dtype=np.int8), \
+                   FluState=np.zeros(PopulationEffective, dtype=np.int8), \
+                   Locality=np.asarray(Locality, dtype=np.int16), \
+                   Visits=np.asarray(Visits, dtype=np.int16), \
+                   Flags=np.zeros(PopulationEffective, dtype=np.uint8), \
+                   QuarantineDay=np.full(PopulationEffective, -1, dtype=np.int16), \
+                   LocalOffsets=LocalOffsets, LocalIndices=LocalIndices, \
+                   VisitsOffsets=VisitsOffsets, VisitsIndices=VisitsIndices, \
+                   LocalInOffsets=LocalInOffsets, LocalInIndices=LocalInIndices, \
+                   VisitsInOffsets=VisitsInOffsets, VisitsInIndices=VisitsInIndices)
+
+    #Converts a pandas frame with the columns of the original CP
+    #CD is used for the names of localities and neighborhoods
+    @classmethod
+    def fromFrame(cls, Frame, CD):
+        LocalityNames, NeighborhoodNames = localityNames(CD)
+        LocalOffsets, LocalIndices = contactsToCSR(Frame['LocalContacts'])
+        VisitsOffsets, VisitsIndices = contactsToCSR(Frame['VisitsContacts'])
+        CP=cls.create(LocalityNames, NeighborhoodNames, Frame['localityIndex'].to_numpy()-1, \
+                      Frame['Visits'].to_numpy(), LocalOffsets, LocalIndices, VisitsOffsets, VisitsIndices)
+        for Name in ['CovidState', 'FluState', 'quarantine', 'quarantineDay', 'CovidPositive']:
+            if Name in Frame:
+                CP.setColumn(Name, slice(None), Frame[Name].to_numpy())
+        return CP
+
+    def arrays(self):
+        return {Name: getattr(self, Name) for Name in self.Arrays}
+
+    #Number of bytes held by the per-agent arrays
+    def nbytes(self):
+        return sum(Array.nbytes for Array in self.arrays().values())
+
+    def copy(self):
+        CP=CityPopulation(self.LocalityNames, self.NeighborhoodNames, \
+                          **{Name: Array.copy() for Name, Array in self.arrays().items()})
+        if self.QuarantineIndex is not None:
+            CP.QuarantineIndex=self.QuarantineIndex.copy(CP)
+        CP.RandSeed=self.RandSeed
+        return CP
+
+    #Frame interface
+    @property
+    def shape(self):
+        return (len(self.CovidState), len(Columns))
+
+    @property
+    def index(self):
+        return pd.RangeIndex(len(self.CovidState))
+
+    @property
+    def columns(self):
+        return pd.Index(Columns)
+
+    def __len__(self):
+        return len(self.CovidState)
+
+    def __contains__(self, Name):
+        return Name in Columns
+
+    def __getitem__(self, Name):
+        return pd.Series(self.column(Name), index=self.index, name=Name)
+
+    def __setitem__(self, Name, Values):
+        self.setColumn(Name, slice(None), Values)
+
+    #Materializes the rows Rows (all agents by default) as a pandas frame
+    def to_frame(self, Rows=slice(None)):
+        Index=self.index[Rows]
+        return pd.DataFrame({Name: self.column(Name, Rows) for Name in Columns}, index=Index)
+
+    #Values of column Name for the agents Rows (a slice or an array of ids)
+    def column(self, Name, Rows=slice(None)):
+        if Name=='id':
+            return np.arange(len(self))[Rows]
+        if Name=='localityIndex':
+            return self.Locality[Rows].astype(np.int64)+1
+        if Name=='locality':
+            return _categorical(self.LocalityNames, self.Locality[Rows])
+        if Name=='neighborhood':
+            return _categorical(self.NeighborhoodNames, self.Locality[Rows])
+        if Name=='CovidState':
+            return pd.Categorical.from_codes(self.CovidState[Rows], CovidStateNames)
+        if Name=='FluState':
+            return pd.Categorical.from_codes(self.FluState[Rows], FluStateNames)
+        if Name=='Visits':
+            return self.Visits[Rows].astype(np.int64)
+        if Name=='LocalContacts':
+            return contactLists(*_rowsCSR(self.LocalOffsets, self.LocalIndices, Rows))
+        if Name=='VisitsContacts':
+            return contactLists(*_rowsCSR(self.VisitsOffsets, self.VisitsIndices, Rows))
+        if Name=='quarantine':
+            return ((self.Flags[Rows] & QuarantineBit)>0).astype(np.int64)
+        if Name=='quarantineDay':
+            Day=self.QuarantineDay[Rows].astype(np.float64)
+            Day[Day<0]=np.nan
+            return Day
+        if Name=='CovidPositive':
+            return ((self.Flags[Rows] & PositiveBit)>0).astype(np.int64)
+        raise KeyError(Name)
+
+    #Writes column Name for the agents Rows
+    def setColumn(self, Name, Rows, Values):
+        if Name=='CovidState':
+            self.CovidState[Rows]=_codes(Values, CovidStateNames)
+        elif Name=='FluState':
+            self.FluState[Rows]=_codes(Values, FluStateNames)
+        elif Name=='Visits':
+            self.Visits[Rows]=Values
+        elif Name=='quarantine':
+            self.setFlag(QuarantineBit, Rows, Values)
+            self.trackQuarantines(Rows)
+        elif Name=='CovidPositive':
+            self.setFlag(PositiveBit, Rows, Values)
+        elif Name=='quarantineDay':
+            Day=np.asarray(Values, dtype=np.float64)
+            self.QuarantineDay[Rows]=np.where(np.isnan(Day), -1, Day)
+            self.trackQuarantines(Rows)
+        elif Name in Columns:
+            raise ValueError('Column '+Name+' of the population cannot be written')
+        else:
+            raise KeyError(Name)
+
+    #Adds the quarantined agents among Rows that have a quarantine day to the QuarantineIndex,
+    #  so that they are released as those of interventions.quarantine; the quarantine and
+    #  quarantineDay columns can be written in either order
+    def trackQuarantines(self, Rows):
+        from interventions import quarantineIndex
+        ids=np.atleast_1d(np.arange(len(self))[Rows])
+        ids=ids[self.quarantined(ids) & (self.QuarantineDay[ids]>=0)]
+        if len(ids)>0:
+            quarantineIndex(self).track(ids)
+
+    def setFlag(self, Bit, Rows, Values):
+        On=np.asarray(Values)!=0
+        self.Flags[Rows]=np.where(On, self.Flags[Rows] | Bit, self.Flags[Rows] & ~np.uint8(Bit))
+
+    #Boolean arrays of the flags of agents ids
+    def quarantined(self, ids=slice(None)):
+        return (self.Flags[ids] & QuarantineBit)>0
+
+    def positive(self, ids=slice(None)):
+        return (self.Flags[ids] & PositiveBit)>0
+
+    #Contact queries for batches of agents, in O(contacts of the batch)
+    #Output: sorted unique ids
+    #Agents in the contact lists (local and hotspot) of ids
+    def outContacts(self, ids):
+        ids=np.asarray(ids, dtype=np.int64)
+        return np.union1d(gatherContacts(self.LocalOffsets, self.LocalIndices, ids)[1], \
+                          gatherContacts(self.VisitsOffsets, self.VisitsIndices, ids)[1])
+
+    #Agents that have one of ids in their contact lists
+    def inContacts(self, ids):
+        ids=np.asarray(ids, dtype=np.int64)
+        return np.union1d(gatherContacts(self.LocalInOffsets, self.LocalInIndices, ids)[1], \
+                          gatherContacts(self.VisitsInOffsets, self.VisitsInIndices, ids)[1])
+
+    #Agents reached from ids in 1..Depth steps along the contacts, out-contacts only or
+    #  in both directions if Backward
+    #Output: list of Depth arrays, the agents first reached at each step (ids excluded)
+    def contactHops(self, ids, Depth=1, Backward=False):
+        Frontier=np.unique(np.asarray(ids, dtype=np.int64))
+        Seen=Frontier
+        Hops=[]
+        for k in range(Depth):
+            Reached=self.outContacts(Frontier)
+            if Backward:
+                Reached=np.union1d(Reached, self.inContacts(Frontier))
+            Frontier=np.setdiff1d(Reached, Seen, assume_unique=True)
+            Seen=np.union1d(Seen, Frontier)
+            Hops.append(Frontier)
+        return Hops
+
+
+#Access by label, as with pandas: CP.loc[rows], CP.loc[rows, column], CP.loc[i, column]=value
+class _LocIndexer:
+
+    def __init__(self, CP):
+        self.CP=CP
+
+    def __getitem__(self, Key):
+        Rows, Name = Key if isinstance(Key, tuple) else (Key, None)
+        Rows=_rows(Rows, len(self.CP))
+        Scalar=np.ndim(Rows)==0 and not isinstance(Rows, slice)
+        if Name is None:
+            if Scalar:
+                return pd.Series({c: self.CP.column(c, [Rows])[0] for c in Columns}, name=Rows)
+            return self.CP.to_frame(Rows)
+        if isinstance(Name, list):
+            return self.CP.to_frame(Rows if not Scalar else [Rows])[Name]
+        if Scalar:
+            Value=self.CP.column(Name, [Rows])[0]
+            return Value.item() if isinstance(Value, np.generic) else Value
+        return pd.Series(self.CP.column(Name, Rows), index=self.CP.index[Rows], name=Name)
+
+    def __setitem__(self, Key, Value):
+        Rows, Name = Key
+        self.CP.setColumn(Name, _rows(Rows, len(self.CP)), Value)
+
+
+#Converts a row selector (label, list, boolean mask, Series, Index or slice) into
+#  an int, an array of ids or a slice
+def _rows(Rows, PopulationEffective):
+    if isinstance(Rows, slice):
+        return Rows
+    if hasattr(Rows, 'to_numpy'):
+        #pandas Series or Index
+        Rows=Rows.to_numpy()
+    if np.ndim(Rows)==0:
+        return int(Rows)
+    Rows=np.asarray(Rows)
+    if Rows.dtype==bool:
+        return np.flatnonzero(Rows)
+    return Rows.astype(np.int64)
+
+
+def _categorical(PerLocality, Locality):
+    Codes, Names = pd.factorize(PerLocality)
+    return pd.Categorical.from_codes(Codes[Locality], Names)
+
+
+def _codes(Values, Names):
+    if isinstance(Values, str):
+        return np.flatnonzero(Names==Values)[0]
+    Values=np.asarray(Values)
+    if Values.dtype.kind in 'iu':
+        return Values
+    Codes=pd.Categorical(Values, categories=Names).codes
+    if np.any(Codes<0):
+        raise ValueError('Unknown state in '+str(np.unique(Values[Codes<0])))
+    return Codes
+
+
+#CSR rows Rows of (Offsets, Indices), as a new (Offsets, Indices) pair
+def _rowsCSR(Offsets, Indices, Rows):
+    if isinstance(Rows, slice):
+        Rows=np.arange(len(Offsets)-1)[Rows]
+    Rows=np.asarray(Rows)
+    Counts=Offsets[Rows+1]-Offsets[Rows]
+    NewOffsets=np.zeros(len(Rows)+1, dtype=np.int64)
+    np.cumsum(Counts, out=NewOffsets[1:])
+    Sources, Targets = gatherContacts(Offsets, Indices, Rows)
+    return NewOffsets, Targets
+
+
+#Names of the localities and neighborhoods of CD, indexed by locality_id-1
+def localityNames(CD):
+    Ids=CD['locality_id'].to_numpy(dtype=np.int64)
+    LocalityNames=np.array(['locality '+str(k+1) for k in range(Ids.max())], dtype=object)
+    NeighborhoodNames=np.full(Ids.max(), '', dtype=object)
+    LocalityNames[Ids-1]=CD['locality_name'].to_numpy()
+    NeighborhoodNames[Ids-1]=CD['locality_neighbors'].to_numpy()
+    return LocalityNames, NeighborhoodNames
+
+
+#Converts a column of per-agent contact lists into CSR form
+#Output
+# Offsets: contacts of agent i are Indices[Offsets[i]:Offsets[i+1]]
+# Indices: int32 array of contact ids
+def contactsToCSR(ContactLists):
+    Lengths=np.fromiter((len(c) for c in ContactLists), dtype=np.int64, count=len(ContactLists))
+    Offsets=np.zeros(len(Lengths)+1, dtype=np.int64)
+    np.cumsum(Lengths, out=Offsets[1:])
+    Indices=np.fromiter((j for c in ContactLists for j in c), dtype=np.int32, count=Offsets[-1])
+    return Offsets, Indices
+
+
+#Converts CSR contacts into an object array of per-agent python lists
+#Rows of equal length are converted together
+def contactLists(Offsets, Indices):
+    Degree=np.diff(Offsets)
+    Lists=np.empty(len(Degree), dtype=object)
+    for d in np.unique(Degree):
+        Rows=np.flatnonzero(Degree==d)
+        Block=Indices[Offsets[Rows][:, None]+np.arange(d)].tolist()
+        for k, r in enumerate(Rows.tolist()):
+            Lists[r]=Block[k]
+    return Lists
+
+
+#Transpose of the CSR contact lists (Offsets, Indices): row j of the output lists, in
+#  increasing order, the agents whose row contains j
+def transposeContacts(Offsets, Indices):
+    NumAgents=len(Offsets)-1
+    InOffsets=np.zeros(NumAgents+1, dtype=Offsets.dtype)
+    np.cumsum(np.bincount(Indices, minlength=NumAgents), out=InOffsets[1:])
+    Sources=np.repeat(np.arange(NumAgents, dtype=Indices.dtype), np.diff(Offsets))
+    return InOffsets, Sources[np.argsort(Indices, kind='stable')]
+
+
+#Expands the CSR rows of the agents in Sources into (source, target) pairs
+def gatherContacts(Offsets, Indices, Sources):
+    Starts=Offsets[Sources]
+    Counts=Offsets[Sources+1]-Starts
+    Ends=np.cumsum(Counts)
+    Positions=np.repeat(Starts-Ends+Counts, Counts)+np.arange(Ends[-1] if len(Ends) else 0)
+    return np.repeat(Sources, Counts), Indices[Positions]
@@ -0,0 +1,194 @@
+#Per-phase timing and counters of the day loop
+#simulateStream (see evolution.py) times every phase of a day with a Profiler and adds to
+#  each DailyRecord (see sinks.py):
+# Phases: dict phase -> seconds, in the order the phases ran. A day runs
+#   release (quarantine releases), intervention, counts (neighborhood counters),
+#   update (updateState: the blocks on the workers, then merge of the exposures),
+#   testing, stats (daily test statistics), checkpoint
+# Setup: dict phase -> seconds of the SetupPhases run before the first day, initialize
+#   (population and initial infections) and pool (worker pool startup); they are given
+#   with the first day simulated and are not part of its Phases or Seconds, so that
+#   Seconds is the time of the day alone on every day
+# Counters: dict name -> value
+#   Agents: agents updated, Exposures: exposures along fixed contacts,
+#   Tests, PositiveTests: tests of the day, Quarantined: agents in quarantine,
+#   BytesToWorkers, BytesFromWorkers: size of the tasks sent to and the results received
+#     from the worker pool (0 without a pool), estimated by payloadBytes without pickling
+#     them a second time,
+#   PeakRSS: peak resident memory of the main process in bytes
+#Hooks given to the Profiler are called with the profile of every day, a dict with the
+#  keys Day, Phases, Setup, Counters and Seconds (the sum of the phases). The consumers below
+#  take either a profile or a DailyRecord, so they can be used as hooks or as sinks.
+#
+#Usage:
+# Summary=ProfileSummary()
+# simulate(..., Profiler=Profiler(ProfileWriter('profile.jsonl'), Summary))
+# print(Summary.table())
+
+import sys
+import json
+import timeit
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    #Not available on Windows
+    resource=None
+
+
+#Peak resident memory of this process in bytes, 0 if unknown
+def peakRSS():
+    if resource is None:
+        return 0
+    Peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Kilobytes on Linux, bytes on macOS
+    return Peak if sys.platform=='darwin' else Peak*1024
+
+
+#Approximate size of Payload once pickled: the bytes of the numpy arrays and strings it
+#  holds, in nested tuples, lists and dicts, and 8 bytes for any other value
+def payloadBytes(Payload):
+    if hasattr(Payload, 'nbytes'):
+        return int(Payload.nbytes)
+    if isinstance(Payload, (str, bytes)):
+        return len(Payload)
+    if isinstance(Payload, dict):
+        return sum(payloadBytes(Key)+payloadBytes(Value) for Key, Value in Payload.items())
+    if isinstance(Payload, (tuple, list)):
+        return sum(payloadBytes(Item) for Item in Payload)
+    return 8
+
+
+#Phases that run once before the first day
+SetupPhases=['initialize', 'pool']
+
+
+class Profiler:
+
+    def __init__(self, *Hooks):
+        self.Hooks=list(Hooks)
+        self.Day=None
+        self.Phases={}
+        self.Setup={}
+        self.Counters={}
+        self.Started={}
+
+    #Starts the profile of day
+    def start(self, day):
+        self.Day=day
+        self.Phases={}
+        self.Counters={}
+        self.Started={}
+
+    #Context manager timing phase Name; the time of a phase run twice is added
+    @contextlib.contextmanager
+    def phase(self, Name):
+        self.begin(Name)
+        try:
+            yield
+        finally:
+            self.end(Name)
+
+    #Starts and ends phase Name, for phases that do not fit in a with block
+    def begin(self, Name):
+        self.Started[Name]=timeit.default_timer()
+
+    def end(self, Name):
+        Phases=self.Setup if Name in SetupPhases else self.Phases
+        Phases[Name]=Phases.get(Name, 0.0)+timeit.default_timer()-self.Started.pop(Name)
+
+    #Sets counter Name
+    def count(self, Name, Value):
+        self.Counters[Name]=Value
+
+    #Adds Value to counter Name
+    def add(self, Name, Value):
+        self.Counters[Name]=self.Counters.get(Name, 0)+Value
+
+    #Ends the day: calls the hooks and returns the profile
+    def finish(self):
+        self.count('PeakRSS', peakRSS())
+        Profile={'Day': self.Day, 'Phases': self.Phases, 'Setup': self.Setup, 'Counters': self.Counters, \
+                 'Seconds': sum(self.Phases.values())}
+        self.Setup={}
+        for hook in self.Hooks:
+            hook(Profile)
+        return Profile
+
+    def close(self):
+        for hook in self.Hooks:
+            if hasattr(hook, 'close'):
+                hook.close()
+
+
+#Prints the phases and counters of every day on one line
+class ProfilePrint:
+
+    def __init__(self, File=None):
+        self.File=File
+
+    def __call__(self, Profile):
+        print('Day:'+str(Profile['Day'])+' '+ \
+              ' '.join('{p}:{t:.3f}s'.format(p=Name, t=Seconds) for Name, Seconds in Profile['Phases'].items())+' '+ \
+              ''.join('setup-{p}:{t:.3f}s '.format(p=Name, t=Seconds) for Name, Seconds in Profile.get('Setup', {}).items())+ \
+              ' '.join(Name+':'+str(Value) for Name, Value in Profile['Counters'].items()), file=self.File or sys.stdout)
+
+
+#Appends the phases and counters of every day as one line of json to Path
+class ProfileWriter:
+
+    def __init__(self, Path, Append=False):
+        self.File=open(Path, 'a' if Append else 'w')
+
+    def __call__(self, Profile):
+        self.File.write(json.dumps({'Day': Profile['Day'], 'Seconds': Profile['Seconds'], 'Phases': Profile['Phases'], \
+                                    'Setup': Profile.get('Setup', {}), 'Counters': Profile['Counters']})+'\n')
+        self.File.flush()
+
+    def close(self):
+        self.File.close()
+
+
+#Counters that are levels rather than daily amounts; their total is not shown
+GaugeCounters=['Quarantined', 'PeakRSS']
+
+
+#Totals of the phases and counters over the days, in constant memory; Setup holds the
+#  setup phases of the run
+class ProfileSummary:
+
+    def __init__(self):
+        self.Days=0
+        self.Phases={}
+        self.MaxPhases={}
+        self.Setup={}
+        self.Counters={}
+        self.MaxCounters={}
+
+    def __call__(self, Profile):
+        self.Days+=1
+        for Name, Seconds in Profile['Phases'].items():
+            self.Phases[Name]=self.Phases.get(Name, 0.0)+Seconds
+            self.MaxPhases[Name]=max(self.MaxPhases.get(Name, 0.0), Seconds)
+        for Name, Seconds in Profile.get('Setup', {}).items():
+            self.Setup[Name]=self.Setup.get(Name, 0.0)+Seconds
+        for Name, Value in Profile['Counters'].items():
+            self.Counters[Name]=self.Counters.get(Name, 0)+Value
+            self.MaxCounters[Name]=max(self.MaxCounters.get(Name, Value), Value)
+
+    #Table of the total, mean and maximum time of each phase and of the counters
+    def table(self):
+        Total=sum(self.Phases.values()) or 1.0
+        Lines=['{:<14}{:>11}{:>8}{:>11}{:>11}'.format('phase', 'total (s)', '%', 'mean (s)', 'max (s)')]
+        for Name, Seconds in sorted(self.Phases.items(), key=lambda Item: -Item[1]):
+            Lines.append('{:<14}{:>11.3f}{:>8.1f}{:>11.4f}{:>11.4f}'.format(Name, Seconds, 100*Seconds/Total, \
+                                                                         Seconds/self.Days, self.MaxPhases[Name]))
+        for Name, Seconds in self.Setup.items():
+            Lines.append('{:<14}{:>11.3f}  (setup)'.format(Name, Seconds))
+        Lines.append('')
+        Lines.append('{:<18}{:>16}{:>16}{:>16}'.format('counter', 'total', 'mean', 'max'))
+        for Name, Value in self.Counters.items():
+            Lines.append('{:<18}{:>16}{:>16.1f}{:>16}'.format(Name, '-' if Name in GaugeCounters else Value, \
+                                                              Value/self.Days, self.MaxCounters[Name]))
+        return '\n'.join(Lines)
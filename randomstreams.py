@@ -0,0 +1,44 @@
+#Random number streams for the simulation
+#Every stream is a numpy Generator derived from the simulation seed through
+#  SeedSequence spawn keys. A stream depends only on (seed, key), not on the
+#  process that draws from it, so results do not change with the number of workers
+
+import numpy as np
+
+#Number of agents sharing one random stream in updateState
+#Worker ranges are made of whole blocks
+BlockSize=1<<15
+
+#Kinds of streams (first entry of the spawn key)
+AgentStream=0
+PolicyStream=1
+InitStream=2
+EnsembleStream=3
+WardStream=4
+
+
+#Generator for the agents of block number block on day day
+def agentGenerator(randseed, day, block):
+    return np.random.default_rng(np.random.SeedSequence(randseed, spawn_key=(AgentStream, day, block)))
+
+
+#Generator for policy number stream (testing, interventions, ...) on day day
+def policyGenerator(randseed, day, stream=0):
+    return np.random.default_rng(np.random.SeedSequence(randseed, spawn_key=(PolicyStream, day, stream)))
+
+
+#Generator used by stage stage of the initialization for locality or hotspot index
+def initGenerator(randseed, stage, index):
+    return np.random.default_rng(np.random.SeedSequence(randseed, spawn_key=(InitStream, stage, index)))
+
+
+#Generator for stream stream (update, reports, ...) of locality index ward on day day
+#Used by the locality-sharded runner (see distributed.py), where the agents of a locality
+#  are updated by the shard that owns it
+def wardGenerator(randseed, day, ward, stream=0):
+    return np.random.default_rng(np.random.SeedSequence(randseed, spawn_key=(WardStream, day, ward, stream)))
+
+
+#Seed of replicate replicate of cell number cell of an ensemble (see ensemble.py)
+def runSeed(randseed, cell, replicate):
+    return int(np.random.SeedSequence(randseed, spawn_key=(EnsembleStream, cell, replicate)).generate_state(1)[0])
@@ -0,0 +1,43 @@
+#The active set mode of updateState must infect agents at the rates of the default mode,
+#  including when the neighborhood infection rates are above 1
+#Run from the repository root: python -m pytest regression
+
+import os
+import sys
+import io
+import contextlib
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import evolution
+from synthcity import syntheticCity
+from interventions import InterventionNone
+from population import StateS
+
+#Contact rates high enough that the neighborhood infection rates reach 2 once half the
+#  agents of a locality are infected (they are exposed on day 0 and infected on day 1);
+#  with localities seeded from 0 to 50%, a block has rates both below and above 1
+ModelParams={"CovidInfectionRate": 0.1, "CovidRateVector": [1, 1/8], "FluRateVector": [0.02, 1/8], \
+             "NeighborhoodContact": 40, "NeighborhoodContactFixed": 5, "HotspotContact": 1, "HotspotContactFixed": 10}
+Population=5000
+
+
+#Agents no longer susceptible after two days, for every seed
+def infectedCounts(ActiveSet, Seeds):
+    CD, CarProb = syntheticCity(16, 5, randseed=0)
+    InitCovid=(np.linspace(0, 0.5, CD.shape[0])*Population*CD['locality_density'].to_numpy()).astype(np.int64).tolist()
+    Counts=[]
+    for Seed in Seeds:
+        with contextlib.redirect_stdout(io.StringIO()):
+            evolution.simulate(2, Population, ModelParams, CD, CarProb, InterventionNone, lambda CP, TestingHistory, day: None, \
+                               InitCovid, None, NumWorkers=1, randseed=Seed, popseed=0, ActiveSet=ActiveSet)
+        Counts.append(np.count_nonzero(evolution.CP.CovidState!=StateS))
+    return np.array(Counts, dtype=float)
+
+
+def test_high_contact_rates():
+    Dense=infectedCounts(False, range(4))
+    Active=infectedCounts(True, range(4))
+    #Standard error of the difference of the means, with a floor for nearly saturated runs
+    Error=np.sqrt(Dense.var(ddof=1)/len(Dense)+Active.var(ddof=1)/len(Active))+0.002*Dense.mean()
+    assert abs(Active.mean()-Dense.mean())<5*Error, (Dense, Active)
@@ -0,0 +1,58 @@
+#A run stopped after a checkpoint and resumed from it must give the same records and
+#  TestingHistory as the run that was not stopped (see checkpoint.py)
+#Run from the repository root: python -m pytest regression
+
+import os
+import sys
+import io
+import itertools
+import contextlib
+from functools import partial
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import evolution
+from synthcity import syntheticCity
+from interventions import InterventionQuarantine
+from tests import ContactTracing
+from checkpoint import Checkpointer, resume
+
+ModelParams={"CovidInfectionRate": 0.1, "CovidRateVector": [1, 1/8], "FluRateVector": [0.02, 1/8], \
+             "NeighborhoodContact": 1, "NeighborhoodContactFixed": 5, "HotspotContact": 2, "HotspotContactFixed": 10}
+Days=14
+#Records compared, the others being timings
+Series=['Day', 'CovidCases', 'Symptomatic', 'PositiveTests', 'Tests', 'Interventions']
+
+
+def arguments():
+    CD, CarProb = syntheticCity(16, 5, randseed=0)
+    testingPolicy=partial(ContactTracing, 100, 0.1, np.ones(CD.shape[0]))
+    return (Days, 30000, ModelParams, CD, CarProb, InterventionQuarantine, testingPolicy, [10]*CD.shape[0], None), \
+           {'NumWorkers': 1, 'randseed': 7}
+
+
+def test_resume_matches_straight_run(tmp_path):
+    Args, Kwargs = arguments()
+    with contextlib.redirect_stdout(io.StringIO()):
+        Straight=[{Name: Record[Name] for Name in Series} for Record in evolution.simulateStream(*Args, **Kwargs)]
+        StraightHistory=evolution.TestingHistory.toDense()
+
+        #Stopped on day 7, after the snapshot of day 4
+        Path=str(tmp_path/'run.ckpt.npz')
+        Checkpoint=Checkpointer(Path, Every=5)
+        Stream=evolution.simulateStream(*Args, Checkpoint=Checkpoint, **Kwargs)
+        for Record in itertools.islice(Stream, 8):
+            pass
+        Stream.close()
+        Checkpoint.close()
+        assert Checkpoint.LastDay==4
+
+        Resumed=[{Name: Record[Name] for Name in Series} for Record in resume(Path, *Args, **Kwargs)]
+        ResumedHistory=evolution.TestingHistory.toDense()
+
+    assert [Record['Day'] for Record in Resumed]==list(range(5, Days))
+    for Expected, Actual in zip(Straight[5:], Resumed):
+        for Name in Series:
+            assert np.array_equal(np.asarray(Expected[Name]), np.asarray(Actual[Name])), (Actual['Day'], Name)
+    assert np.array_equal(StraightHistory, ResumedHistory)
+    assert np.abs(StraightHistory).sum()>0 and any(Record['Interventions'] for Record in Straight)
@@ -0,0 +1,61 @@
+#A sharded run must give the same results for any number of shards and any transport,
+#  and follow the distribution of simulate (see distributed.py)
+#Run from the repository root: python -m pytest regression
+
+import os
+import sys
+import io
+import contextlib
+from functools import partial
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import evolution
+import distributed
+from synthcity import syntheticCity
+from interventions import InterventionQuarantine
+from tests import RandomSymptomaticTesting
+from sinks import drain, SeriesCollector
+
+ModelParams={"CovidInfectionRate": 0.1, "CovidRateVector": [1, 1/8], "FluRateVector": [0.02, 1/8], \
+             "NeighborhoodContact": 1, "NeighborhoodContactFixed": 5, "HotspotContact": 2, "HotspotContactFixed": 10}
+Days=15
+Population=20000
+TestingBudget=100
+CD, CarProb = syntheticCity(16, 5, randseed=0)
+InitCovid=[10]*CD.shape[0]
+
+
+def sharded(NumShards, Transport=None, randseed=3):
+    Series=SeriesCollector(CD.shape[0], Days)
+    with contextlib.redirect_stdout(io.StringIO()):
+        drain(distributed.simulateShardedStream(Days, Population, ModelParams, CD, CarProb, InterventionQuarantine, \
+                                                TestingBudget, 0.0, None, InitCovid, None, NumShards, Transport, randseed), Series)
+    return {Name: Series[Name] for Name in ['CovidCases', 'Symptomatic', 'PositiveTests', 'Tests']}
+
+
+def test_any_number_of_shards_and_transport():
+    Reference=sharded(1)
+    assert Reference['CovidCases'].sum()>0 and Reference['PositiveTests'].sum()>0
+    for NumShards, Transport in [(3, None), (5, None), (3, distributed.SocketTransport())]:
+        Result=sharded(NumShards, Transport)
+        for Name in Reference:
+            assert np.array_equal(Reference[Name], Result[Name]), (NumShards, Transport, Name)
+
+
+def test_same_distribution_as_simulate():
+    testingPolicy=partial(RandomSymptomaticTesting, TestingBudget, 0.0, np.ones(CD.shape[0]))
+    Simulated=[]
+    Sharded=[]
+    for Seed in range(6):
+        with contextlib.redirect_stdout(io.StringIO()):
+            CovidCases=evolution.simulate(Days, Population, ModelParams, CD, CarProb, InterventionQuarantine, testingPolicy, \
+                                          InitCovid, None, NumWorkers=1, randseed=Seed)[0]
+        Simulated.append(CovidCases.sum(axis=0))
+        Sharded.append(sharded(2, randseed=Seed)['CovidCases'].sum(axis=0))
+    Simulated=np.array(Simulated)
+    Sharded=np.array(Sharded)
+    #Cases of the last days, whose means must agree within a few standard errors
+    Error=np.sqrt(Simulated.var(axis=0, ddof=1)/len(Simulated)+Sharded.var(axis=0, ddof=1)/len(Sharded))
+    assert np.all(np.abs(Simulated.mean(axis=0)-Sharded.mean(axis=0))[-5:]<4*Error[-5:]+1), \
+        (Simulated.mean(axis=0), Sharded.mean(axis=0))
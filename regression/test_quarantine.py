@@ -0,0 +1,47 @@
+#Quarantines written through the quarantine and quarantineDay columns of CP (the idiom of
+#  the pandas frame of earlier versions) must expire after QuarantineDuration days, as
+#  those set by interventions.quarantine
+#Run from the repository root: python -m pytest regression
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from population import CityPopulation
+from interventions import quarantine, quarantineIndex, QuarantineDuration
+
+
+def population(n):
+    Empty=np.zeros(n+1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return CityPopulation.create(['A'], ['A'], np.zeros(n), np.zeros(n), *Empty, *Empty)
+
+
+def test_column_writes_expire():
+    CP=population(10)
+    CP.loc[3, 'quarantine']=1
+    CP.loc[3, 'quarantineDay']=5
+    #Day written first
+    CP.loc[4, 'quarantineDay']=5
+    CP.loc[4, 'quarantine']=1
+    #Several rows at once, as a mask
+    Rows=np.arange(10)>=8
+    CP.loc[Rows, 'quarantine']=1
+    CP.loc[Rows, 'quarantineDay']=5
+    quarantine(CP, [6], 5)
+
+    Quarantined=[3, 4, 6, 8, 9]
+    assert len(quarantineIndex(CP).release(5+QuarantineDuration-1))==0
+    assert CP['quarantine'].to_numpy()[Quarantined].all()
+    assert list(quarantineIndex(CP).release(5+QuarantineDuration))==Quarantined
+    assert not CP['quarantine'].to_numpy().any()
+
+
+def test_requarantine_by_column():
+    CP=population(4)
+    CP.loc[1, 'quarantine']=1
+    CP.loc[1, 'quarantineDay']=0
+    #Quarantined again before expiry: released with the later day only
+    CP.loc[1, 'quarantineDay']=3
+    assert len(quarantineIndex(CP).release(QuarantineDuration))==0
+    assert list(quarantineIndex(CP).release(3+QuarantineDuration))==[1]
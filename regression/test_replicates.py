@@ -0,0 +1,45 @@
+#Replicate r of simulateReplicates must give the same results as simulate with
+#  randseed=Seeds[r] and the same popseed (see replicates.py)
+#Run from the repository root: python -m pytest regression
+
+import os
+import sys
+import io
+import contextlib
+from functools import partial
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import evolution
+import replicates
+from synthcity import syntheticCity
+from interventions import InterventionQuarantine, InterventionLockdown
+from tests import ContactTracing
+
+ModelParams={"CovidInfectionRate": 0.1, "CovidRateVector": [1, 1/8], "FluRateVector": [0.02, 1/8], \
+             "NeighborhoodContact": 1, "NeighborhoodContactFixed": 5, "HotspotContact": 2, "HotspotContactFixed": 10}
+Days=12
+#Two blocks of random streams and part of a third
+Population=2*evolution.BlockSize+5000
+Seeds=[5, 7, 11]
+
+
+@pytest.mark.parametrize('interventionPolicy', [InterventionQuarantine, InterventionLockdown])
+def test_replicates_equal_simulate(interventionPolicy):
+    CD, CarProb = syntheticCity(16, 5, randseed=0)
+    testingPolicy=partial(ContactTracing, 100, 0.1, np.ones(CD.shape[0]))
+    InitCovid=[10]*CD.shape[0]
+    with contextlib.redirect_stdout(io.StringIO()):
+        CovidCases, TestingHistories, Symptomatic, Localities = replicates.simulateReplicates(Days, Population, \
+            ModelParams, CD, CarProb, interventionPolicy, testingPolicy, Seeds, InitCovid, popseed=1)
+    assert CovidCases.shape==(CD.shape[0], Days, len(Seeds))
+    for r, Seed in enumerate(Seeds):
+        with contextlib.redirect_stdout(io.StringIO()):
+            Expected=evolution.simulate(Days, Population, ModelParams, CD, CarProb, interventionPolicy, testingPolicy, \
+                                        InitCovid, NumWorkers=1, randseed=Seed, popseed=1)
+        assert Expected[0].sum()>0 and np.abs(Expected[1].toDense()).sum()>0
+        assert np.array_equal(Expected[0], CovidCases[:, :, r]), Seed
+        assert np.array_equal(Expected[2], Symptomatic[:, :, r]), Seed
+        assert np.array_equal(Expected[1].toDense(), TestingHistories[r].toDense()), Seed
+    assert (np.asarray(Localities)==np.asarray(Expected[3])).all()
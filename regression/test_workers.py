@@ -0,0 +1,41 @@
+#A run with a given randseed must give the same results for any number of workers, in
+#  the default and in the active set mode (see randomstreams.py)
+#Run from the repository root: python -m pytest regression
+
+import os
+import sys
+import io
+import contextlib
+from functools import partial
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import evolution
+from synthcity import syntheticCity
+from interventions import InterventionQuarantine
+from tests import ContactTracing
+
+ModelParams={"CovidInfectionRate": 0.1, "CovidRateVector": [1, 1/8], "FluRateVector": [0.02, 1/8], \
+             "NeighborhoodContact": 1, "NeighborhoodContactFixed": 5, "HotspotContact": 2, "HotspotContactFixed": 10}
+#Four blocks of random streams, so that the workers get different ranges of blocks
+Population=4*evolution.BlockSize
+
+
+def run(NumWorkers, ActiveSet):
+    CD, CarProb = syntheticCity(16, 5, randseed=0)
+    testingPolicy=partial(ContactTracing, 200, 0.0, np.ones(CD.shape[0]))
+    with contextlib.redirect_stdout(io.StringIO()):
+        CovidCases, TestingHistory, Symptomatic, Localities = evolution.simulate(8, Population, ModelParams, CD, CarProb, \
+            InterventionQuarantine, testingPolicy, [20]*CD.shape[0], None, NumWorkers=NumWorkers, randseed=5, ActiveSet=ActiveSet)
+    return CovidCases, Symptomatic, TestingHistory.toDense()
+
+
+@pytest.mark.parametrize('ActiveSet', [False, True])
+def test_any_number_of_workers(ActiveSet):
+    Reference=run(1, ActiveSet)
+    assert Reference[0].sum()>0 and np.abs(Reference[2]).sum()>0
+    for NumWorkers in [4, 8]:
+        Result=run(NumWorkers, ActiveSet)
+        for Expected, Actual in zip(Reference, Result):
+            assert np.array_equal(Expected, Actual), NumWorkers
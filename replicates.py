@@ -0,0 +1,296 @@
+#Batched Monte Carlo replicates sharing one population
+#simulateReplicates advances R replicates of the same city together. The population
+#  (localities, hotspots and contacts) is built once, and the states of the agents are
+#  (agents x replicates) matrices: CovidState and FluState (int8), Flags (uint8) and
+#  QuarantineDay (int16). The daily update runs across the replicate axis: the transitions
+#  and infection rates are applied to whole matrices, and the contacts of the infected
+#  agents of all replicates are gathered in one pass per block. The Python overhead of
+#  a day and the contact graph are shared by the replicates.
+#Replicate r draws from the random streams of seed Seeds[r], so it gives the same results
+#  as simulate(..., randseed=Seeds[r], popseed=popseed) (with policies drawing from the
+#  policy streams, see randomstreams.py), for any number of replicates.
+#The policies are called once per replicate with that replicate's CityPopulation view:
+#  the fixed arrays of the shared population with the replicate's column of the state
+#  matrices, its own quarantines and RandSeed, TestingHistory and InterventionsHistory.
+#
+#Usage:
+# CovidCases, TestingHistories, Symptomatic, Localities = simulateReplicates(100, Population,
+#     ModelParams, CD, CarProb, InterventionQuarantine, testingPolicy, Seeds=range(16), popseed=0)
+# CovidCases[:, :, r] is the localities x days array of replicate r
+
+import timeit
+import numpy as np
+
+from evolution import Initialize, InitInfection, HistoryRetention, localityNeighbors, InfectRate
+from interventions import InterventionRule, quarantineIndex
+from population import CityPopulation, gatherContacts, StateS, StateE, StateI, StateR, FluStateS, FluStateI
+from randomstreams import BlockSize, agentGenerator
+from testinghistory import SparseTestingHistory
+from dailystats import DailyStats
+from sinks import DailyPrint
+
+#Per-agent arrays of CityPopulation that hold one column per replicate
+ReplicateArrays=['CovidState', 'FluState', 'Flags', 'QuarantineDay']
+
+
+#The replicates of a population CP, whose fixed arrays they share
+#The state matrices start as R copies of the states of CP
+class ReplicatePopulation:
+
+    def __init__(self, CP, Seeds):
+        self.CP=CP
+        self.Seeds=[int(Seed) for Seed in Seeds]
+        for Name in ReplicateArrays:
+            setattr(self, Name, np.repeat(getattr(CP, Name)[:, None], len(self.Seeds), axis=1))
+        self.Views=[self.view(r) for r in range(len(self.Seeds))]
+
+    def __len__(self):
+        return len(self.Seeds)
+
+    #CityPopulation of replicate r, whose state arrays are columns of the state matrices
+    def view(self, r):
+        Arrays=self.CP.arrays()
+        Arrays.update({Name: getattr(self, Name)[:, r] for Name in ReplicateArrays})
+        View=CityPopulation(self.CP.LocalityNames, self.CP.NeighborhoodNames, **Arrays)
+        View.RandSeed=self.Seeds[r]
+        return View
+
+
+#Version of simulate running the replicates Seeds on one population
+#Inputs: as simulate, except
+# Seeds: the randseed of every replicate
+# InitCovidCounts, InitFluCounts: counts per locality as for simulate, or one list of
+#   counts per replicate
+# popseed: seed of the shared population, Seeds[0] by default
+#Output: CovidCases, Symptomatic (localities x days x replicates float arrays), the list
+#  of the TestingHistory of every replicate, and the localities, in the order of simulate
+def simulateReplicates(NumSteps, Population, ModelParams, CD, CarProb, interventionPolicy, testingPolicy, Seeds, \
+                       InitCovidCounts=None, InitFluCounts=None, popseed=None, PopulationCache=None):
+    Shape=(CD.shape[0], NumSteps, len(Seeds))
+    Series={Name: np.zeros(Shape, dtype=np.int32) for Name in ['CovidCases', 'Symptomatic']}
+    Stream=simulateReplicatesStream(NumSteps, Population, ModelParams, CD, CarProb, interventionPolicy, testingPolicy, \
+                                    Seeds, InitCovidCounts, InitFluCounts, popseed, PopulationCache)
+    Printer=DailyPrint()
+    for Record in Stream:
+        for Name in Series:
+            Series[Name][:, Record['Day'], :]=Record[Name]
+        #Daily line of the first replicate, and the time of all
+        Printer(dict(Record, **{Name: Record[Name][:, 0] for Name in ['CovidCases', 'Symptomatic', 'PositiveTests', 'Tests']}, \
+                     Interventions=Record['Interventions'][0]))
+    return Series['CovidCases'].astype(float), Stream.TestingHistories, Series['Symptomatic'].astype(float), \
+           Stream.Replicates.CP['locality']
+
+
+#Generator version of simulateReplicates yielding a record per day, as simulateStream
+#  (see sinks.py), whose per-locality arrays are localities x replicates and whose
+#  Interventions are the lists of interventions of every replicate
+#The returned object also has the TestingHistories and the ReplicatePopulation of the run
+#  as attributes
+def simulateReplicatesStream(NumSteps, Population, ModelParams, CD, CarProb, interventionPolicy, testingPolicy, Seeds, \
+                             InitCovidCounts=None, InitFluCounts=None, popseed=None, PopulationCache=None, Retention=None):
+    return _ReplicatesStream(NumSteps, Population, ModelParams, CD, CarProb, interventionPolicy, testingPolicy, Seeds, \
+                             InitCovidCounts, InitFluCounts, popseed, PopulationCache, Retention)
+
+
+class _ReplicatesStream:
+
+    def __init__(self, NumSteps, Population, ModelParams, CD, CarProb, interventionPolicy, testingPolicy, Seeds, \
+                 InitCovidCounts, InitFluCounts, popseed, PopulationCache, Retention):
+        Seeds=list(Seeds)
+        if not Seeds:
+            raise ValueError('simulateReplicates needs at least one seed')
+        if popseed is None:
+            popseed=Seeds[0]
+        print('Initializing '+str(Population)+' agents for '+str(len(Seeds))+' replicates...')
+        if PopulationCache is None:
+            CP=Initialize(CD, CarProb, ModelParams, Population, popseed)
+        else:
+            CP=PopulationCache.initialize(CD, CarProb, ModelParams, Population, popseed)
+        self.Replicates=ReplicatePopulation(CP, Seeds)
+
+        NumLocalities=CD.shape[0]
+        InitialCovid=_perReplicate(InitCovidCounts, [np.mod(i,2) for i in range(NumLocalities)], len(Seeds))
+        InitialFlu=_perReplicate(InitFluCounts, [0 for i in range(NumLocalities)], len(Seeds))
+        for r, View in enumerate(self.Replicates.Views):
+            InitInfection(InitialCovid[r], InitialFlu[r], View, Seeds[r])
+
+        if NumSteps is None and Retention is None:
+            Retention=HistoryRetention
+        self.TestingHistories=[SparseTestingHistory(len(CP), NumSteps, Retention) for Seed in Seeds]
+        self.InterventionsHistories=[DailyStats(len(CP.LocalityNames)) for Seed in Seeds]
+        self.Engine=ReplicateEngine(self.Replicates, ModelParams, CD, CarProb)
+        self.Generator=self._days(NumSteps, interventionPolicy, testingPolicy)
+        print("Initialized random infection seed")
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.Generator)
+
+    def close(self):
+        self.Generator.close()
+
+    def _days(self, NumSteps, interventionPolicy, testingPolicy):
+        Views=self.Replicates.Views
+        Engine=self.Engine
+        day=0
+        while NumSteps is None or day<NumSteps:
+            Start=timeit.default_timer()
+            Interventions=[]
+            for View, TestingHistory, InterventionsHistory in zip(Views, self.TestingHistories, self.InterventionsHistories):
+                TestingHistory.advance(day)
+                quarantineIndex(View).release(day)
+                interventions=interventionPolicy(TestingHistory, InterventionsHistory, View, day)
+                InterventionsHistory.append(interventions)
+                Interventions.append(interventions)
+
+            Engine.update(Interventions, day)
+
+            for View, TestingHistory, InterventionsHistory in zip(Views, self.TestingHistories, self.InterventionsHistories):
+                testingPolicy(View, TestingHistory, day)
+                InterventionsHistory.recordTests(day, TestingHistory, View)
+
+            yield {'Day': day, 'CovidCases': Engine.CovidPerLocality.astype(np.int32), \
+                   'Symptomatic': Engine.SymptomaticPerLocality.astype(np.int32), \
+                   'PositiveTests': np.column_stack([History.localityPositives(day) for History in self.InterventionsHistories]).astype(np.int32), \
+                   'Tests': np.column_stack([History.localityTests(day) for History in self.InterventionsHistories]).astype(np.int32), \
+                   'Interventions': [list(interventions) for interventions in Interventions], \
+                   'Seconds': timeit.default_timer()-Start}
+            day+=1
+
+
+#Counts per locality of every replicate: a list of R lists, given one list or R lists
+def _perReplicate(Counts, Default, NumReplicates):
+    if not Counts:
+        Counts=Default
+    if np.ndim(Counts)==1:
+        return [list(Counts)]*NumReplicates
+    if len(Counts)!=NumReplicates:
+        raise ValueError('Expected the initial counts of '+str(NumReplicates)+' replicates, got '+str(len(Counts)))
+    return [list(Row) for Row in Counts]
+
+
+# ===================================================================================
+#The daily update of the replicates, as updateState in evolution.py for each replicate
+#Counters (localities or hotspots x replicates): CovidPerLocality, SymptomaticPerLocality, CovidPerHotspot
+class ReplicateEngine:
+
+    def __init__(self, Replicates, ModelParams, CD, CarProb):
+        self.Replicates=Replicates
+        self.ModelParams=ModelParams
+        CP=Replicates.CP
+        R=len(Replicates)
+        self.NumLocalities=CD.shape[0]
+        self.NumHotspots=len(CarProb[0])
+        self.NeighborRows, self.NeighborCols = localityNeighbors(CD)
+        PeoplePerLocality=np.bincount(CP.Locality, minlength=self.NumLocalities)
+        PeoplePerNeighborhood=np.bincount(self.NeighborRows, weights=PeoplePerLocality[self.NeighborCols], \
+                                          minlength=self.NumLocalities)
+        self.PeoplePerNeighborhood=np.broadcast_to(PeoplePerNeighborhood[:, None], (self.NumLocalities, R))
+        self.PeoplePerHotspot=np.broadcast_to(np.bincount(CP.Visits, minlength=self.NumHotspots)[:, None], (self.NumHotspots, R))
+        #Rate of the transition out of every flu state and Covid state, -1 for none
+        self.FluRates=np.empty(max(FluStateS, FluStateI)+1)
+        self.FluRates[FluStateS]=ModelParams["FluRateVector"][0]
+        self.FluRates[FluStateI]=ModelParams["FluRateVector"][1]
+        self.ProgressRates=np.full(max(StateS, StateE, StateI, StateR)+1, -1.0)
+        self.ProgressRates[StateE]=ModelParams["CovidRateVector"][0]
+        self.ProgressRates[StateI]=ModelParams["CovidRateVector"][1]
+        self.counts()
+
+    #Counts the infected and symptomatic agents per locality and the infected agents per
+    #  hotspot of every replicate, in time proportional to the infected agents
+    def counts(self):
+        R=len(self.Replicates)
+        CP=self.Replicates.CP
+        Infected=self.Replicates.CovidState==StateI
+        Agents, Replicate = np.divmod(np.flatnonzero(Infected), R)
+        self.CovidPerLocality=np.bincount(CP.Locality[Agents].astype(np.int64)*R+Replicate, \
+                                          minlength=self.NumLocalities*R).reshape(self.NumLocalities, R)
+        self.CovidPerHotspot=np.bincount(CP.Visits[Agents].astype(np.int64)*R+Replicate, \
+                                         minlength=self.NumHotspots*R).reshape(self.NumHotspots, R)
+        Agents, Replicate = np.divmod(np.flatnonzero(Infected | (self.Replicates.FluState==FluStateI)), R)
+        self.SymptomaticPerLocality=np.bincount(CP.Locality[Agents].astype(np.int64)*R+Replicate, \
+                                                minlength=self.NumLocalities*R).reshape(self.NumLocalities, R)
+
+    #Updates all agents of all replicates by one day; Interventions[r] are the
+    #  interventions of replicate r
+    #Output: number of exposures along fixed contacts of every replicate
+    def update(self, Interventions, day):
+        Replicates=self.Replicates
+        R=len(Replicates)
+        p=self.ModelParams["CovidInfectionRate"]
+
+        #Neighborhood counts and infection rates of every replicate (see updateCounts)
+        Pairs=(self.NeighborRows[:, None]*R+np.arange(R)).ravel()
+        CovidPerNeighborhood=np.bincount(Pairs, weights=self.CovidPerLocality[self.NeighborCols].ravel(), \
+                                         minlength=self.NumLocalities*R).reshape(self.NumLocalities, R)
+        self.NeighborhoodRate=InfectRate(self.PeoplePerNeighborhood, CovidPerNeighborhood, self.ModelParams["NeighborhoodContact"], p)
+        self.HotspotRate=InfectRate(self.PeoplePerHotspot, self.CovidPerHotspot, self.ModelParams["HotspotContact"], p)
+
+        self.CovidStateNext=Replicates.CovidState.copy()
+        self.FluStateNext=Replicates.FluState.copy()
+        Exposed=[(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))]
+        for lo in range(0, len(Replicates.CP), BlockSize):
+            self.updateBlock(Interventions, day, lo, min(lo+BlockSize, len(Replicates.CP)), Exposed)
+
+        #Exposures, applied once all blocks used the states at the start of the day
+        Targets, Replicate = (np.concatenate(Parts) for Parts in zip(*Exposed))
+        self.CovidStateNext[Targets, Replicate]=StateE
+        Replicates.CovidState[:]=self.CovidStateNext
+        Replicates.FluState[:]=self.FluStateNext
+        self.counts()
+        return np.bincount(Replicate, minlength=R)
+
+    #Updates agents lo..hi-1 of all replicates, as updateAgents for each replicate
+    #Replicate r draws from the stream of block lo//BlockSize of its seed, in the order of
+    #  updateAgents; the exposures are appended to Exposed as (targets, replicates) arrays
+    def updateBlock(self, Interventions, day, lo, hi, Exposed):
+        Replicates=self.Replicates
+        CP=Replicates.CP
+        ModelParams=self.ModelParams
+        R=len(Replicates)
+        n=hi-lo
+        ids=np.arange(lo, hi)
+        Covid=Replicates.CovidState[lo:hi]
+        Flu=Replicates.FluState[lo:hi]
+        Loc=CP.Locality[lo:hi]
+        Hotspot=CP.Visits[lo:hi]
+
+        Generators=[agentGenerator(Seed, day, lo//BlockSize) for Seed in Replicates.Seeds]
+        #Draws[r] are the four uniform draws per agent of replicate r, as in updateAgents
+        Draws=np.empty((R, 4, n))
+        LocalSpread=np.empty((n, R), dtype=bool)
+        GlobalSpread=np.empty((n, R), dtype=bool)
+        for r, rng in enumerate(Generators):
+            rng.random((4, n), out=Draws[r])
+            LocalSpread[:, r], GlobalSpread[:, r] = InterventionRule(Interventions[r], Replicates.Views[r], ids)
+        GlobalSpread &= (Hotspot<self.NumHotspots-1)[:, None]
+        Draws=Draws.transpose(1, 2, 0)
+
+        #The transitions of updateAgents, with the masks combined: a flu transition swaps S
+        #  and I, and every Covid transition (S to E, E to I, I to R) moves to the next code
+        FluStateOut=np.where(Draws[0]<self.FluRates[Flu], FluStateS+FluStateI-Flu, Flu).astype(np.int8)
+        Progress=Draws[1]<self.ProgressRates[Covid]
+        Infection=(LocalSpread & (Draws[2]<self.NeighborhoodRate[Loc])) | (GlobalSpread & (Draws[3]<self.HotspotRate[Hotspot]))
+        Progress |= (Covid==StateS) & Infection
+        CovidStateOut=Covid+Progress.view(np.int8)
+
+        self.CovidStateNext[lo:hi]=CovidStateOut
+        self.FluStateNext[lo:hi]=FluStateOut
+
+        #Fixed contacts of the infected agents of all replicates, gathered in one pass: the
+        #  (replicate, source) pairs are taken replicate by replicate and by increasing
+        #  source, so the contacts of replicate r come in the order of updateAgents
+        Infected=Covid==StateI
+        p=ModelParams["CovidInfectionRate"]
+        for Offsets, Indices, Spread in ((CP.LocalOffsets, CP.LocalIndices, LocalSpread), \
+                                         (CP.VisitsOffsets, CP.VisitsIndices, GlobalSpread)):
+            Replicate, Source = np.divmod(np.flatnonzero((Infected & Spread).T.ravel()), n)
+            Degree=Offsets[lo+Source+1]-Offsets[lo+Source]
+            Sources, Targets = gatherContacts(Offsets, Indices, lo+Source)
+            Replicate=np.repeat(Replicate, Degree)
+            Counts=np.bincount(Replicate, minlength=R)
+            Uniform=np.concatenate([np.zeros(0)]+[rng.random(Counts[r]) for r, rng in enumerate(Generators)])
+            Hit=(Replicates.CovidState[Targets, Replicate]==StateS) & (Uniform<p)
+            Exposed.append((Targets[Hit].astype(np.int64), Replicate[Hit]))
@@ -0,0 +1,189 @@
+#Compressed store of simulation results
+#A ResultStore is a directory holding the outputs of any number of runs of simulate:
+# runs/<run>.npz: compressed arrays of one run
+#   CovidCases, Symptomatic: int32 locality x day counts returned by simulate
+#   TestOffsets, TestIds, TestResults: the sparse test log, the tests of day j are
+#     TestIds[TestOffsets[j]:TestOffsets[j+1]] with results TestResults[...] (+1/-1)
+#   AgentLocality, LocalityNames: locality of every agent, as an index into LocalityNames,
+#     which is in the order of the rows of CovidCases (the rows of CD)
+# runs.jsonl: one line of metadata per run (run id, days, localities, agents and the
+#   metadata given to append, e.g. the parameters of the run)
+# series/: the per-run series stacked over runs by consolidate(), as .npy files that are
+#   memory-mapped by the readers
+#Each member of a run file is read on its own, so a reader selecting one series of
+#  hundreds of runs does not load the rest of the runs.
+#
+#Usage:
+# Store=ResultStore('example/SimulationResults/Store')
+# Store.append(*simulate(...), TestingBudget=50)
+# Store.series('CovidCases')  -> runs x localities x days
+
+import os
+import json
+import uuid
+import numpy as np
+
+from testinghistory import SparseTestingHistory
+
+RunsFile='runs.jsonl'
+RunsDirectory='runs'
+SeriesDirectory='series'
+
+#Series stacked by consolidate(): locality x day series, and day series of the test log
+LocalitySeries=['CovidCases', 'Symptomatic']
+DaySeries=['PositiveTests', 'Tests']
+
+
+class ResultStore:
+
+    def __init__(self, Directory):
+        self.Directory=Directory
+        os.makedirs(os.path.join(Directory, RunsDirectory), exist_ok=True)
+
+    #Adds the outputs of simulate as a new run and returns its id
+    #Metadata: json-serializable values stored with the run; Run gives the run id
+    def append(self, CovidCases, TestingHistory, Symptomatic, Localities, **Metadata):
+        Run=str(Metadata.pop('Run', None) or uuid.uuid4().hex[:12])
+        Days=TestingHistory.shape[1]
+        Tested=[TestingHistory.tested(j) for j in range(Days)]
+        TestOffsets=np.zeros(Days+1, dtype=np.int64)
+        np.cumsum([len(ids) for ids, results in Tested], out=TestOffsets[1:])
+        LocalityNames, AgentLocality = localityCodes(Localities)
+
+        Path=os.path.join(self.Directory, RunsDirectory, Run+'.npz')
+        Temporary=os.path.join(self.Directory, RunsDirectory, '.'+Run+'.tmp.npz')
+        np.savez_compressed(Temporary, CovidCases=np.asarray(CovidCases).astype(np.int32), \
+                            Symptomatic=np.asarray(Symptomatic).astype(np.int32), TestOffsets=TestOffsets, \
+                            TestIds=np.concatenate([np.zeros(0, dtype=np.int32)]+[ids for ids, results in Tested]), \
+                            TestResults=np.concatenate([np.zeros(0, dtype=np.int8)]+[results for ids, results in Tested]), \
+                            AgentLocality=AgentLocality.astype(np.int16), LocalityNames=LocalityNames)
+        os.replace(Temporary, Path)
+
+        Line=dict(Metadata, Run=Run, Days=Days, Localities=int(np.shape(CovidCases)[0]), Agents=int(TestingHistory.shape[0]))
+        fd=os.open(os.path.join(self.Directory, RunsFile), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(Line)+'\n').encode())
+        finally:
+            os.close(fd)
+        return Run
+
+    #Metadata of the runs, in the order they were added
+    #A run added again with the same id replaces the earlier one
+    #Keyword arguments select the runs whose metadata have these values
+    def runs(self, **Select):
+        Runs={}
+        Path=os.path.join(self.Directory, RunsFile)
+        if os.path.exists(Path):
+            with open(Path) as f:
+                for Line in f:
+                    try:
+                        Run=json.loads(Line)
+                    except ValueError:
+                        #Line cut short by a crash
+                        continue
+                    Runs.pop(Run['Run'], None)
+                    Runs[Run['Run']]=Run
+        return [Run for Run in Runs.values() if all(Run.get(Name)==Value for Name, Value in Select.items())]
+
+    #Array Name of run Run, read from its file
+    def array(self, Run, Name):
+        with np.load(os.path.join(self.Directory, RunsDirectory, Run+'.npz')) as Data:
+            return Data[Name]
+
+    #All arrays of run Run
+    def load(self, Run):
+        with np.load(os.path.join(self.Directory, RunsDirectory, Run+'.npz')) as Data:
+            return {Name: Data[Name] for Name in Data.files}
+
+    #TestingHistory of run Run
+    def testingHistory(self, Run):
+        Data=self.load(Run)
+        Offsets=Data['TestOffsets']
+        TestingHistory=SparseTestingHistory(len(Data['AgentLocality']), len(Offsets)-1)
+        for j in range(len(Offsets)-1):
+            TestingHistory.record(j, Data['TestIds'][Offsets[j]:Offsets[j+1]], Data['TestResults'][Offsets[j]:Offsets[j+1]])
+        return TestingHistory
+
+    #Positive tests (or all tests if Positive is False) of run Run per locality and day
+    #Output: (LocalityNames, array of localities x days), the localities in the order of
+    #  the rows of CovidCases
+    def localityTests(self, Run, Positive=True):
+        Data=self.load(Run)
+        Offsets=Data['TestOffsets']
+        Keep=Data['TestResults']>0 if Positive else np.ones(len(Data['TestResults']), dtype=bool)
+        Day=np.repeat(np.arange(len(Offsets)-1), np.diff(Offsets))[Keep]
+        Locality=Data['AgentLocality'][Data['TestIds'][Keep]]
+        Counts=np.zeros((len(Data['LocalityNames']), len(Offsets)-1), dtype=np.int64)
+        np.add.at(Counts, (Locality, Day), 1)
+        return Data['LocalityNames'], Counts
+
+    #Series Name stacked over the runs Runs (all runs by default)
+    #Name is one of LocalitySeries (runs x localities x days) or DaySeries (runs x days)
+    #The consolidated file is memory-mapped when it holds exactly these runs
+    def series(self, Name, Runs=None):
+        if Runs is None:
+            Runs=[Run['Run'] for Run in self.runs()]
+        Consolidated=self._consolidated()
+        if Consolidated==Runs:
+            return np.load(os.path.join(self.Directory, SeriesDirectory, Name+'.npy'), mmap_mode='r')
+        if Consolidated is not None and set(Runs)<=set(Consolidated):
+            Position={Run: k for k, Run in enumerate(Consolidated)}
+            Stacked=np.load(os.path.join(self.Directory, SeriesDirectory, Name+'.npy'), mmap_mode='r')
+            return Stacked[[Position[Run] for Run in Runs]]
+        return np.stack([self._runSeries(Run, Name) for Run in Runs])
+
+    #Writes the series of all runs to series/, for memory-mapped reading
+    def consolidate(self):
+        Runs=[Run['Run'] for Run in self.runs()]
+        Directory=os.path.join(self.Directory, SeriesDirectory)
+        os.makedirs(Directory, exist_ok=True)
+        #Remove the index first, so that a partial consolidation is never used
+        if os.path.exists(os.path.join(Directory, 'runs.json')):
+            os.remove(os.path.join(Directory, 'runs.json'))
+        for Name in LocalitySeries+DaySeries:
+            if not Runs:
+                continue
+            First=self._runSeries(Runs[0], Name)
+            Stacked=np.lib.format.open_memmap(os.path.join(Directory, Name+'.npy'), mode='w+', \
+                                              dtype=First.dtype, shape=(len(Runs),)+First.shape)
+            for k, Run in enumerate(Runs):
+                Stacked[k]=self._runSeries(Run, Name)
+            Stacked.flush()
+            del Stacked
+        with open(os.path.join(Directory, 'runs.json'), 'w') as f:
+            json.dump(Runs, f)
+        return Runs
+
+    def _runSeries(self, Run, Name):
+        if Name in LocalitySeries:
+            return self.array(Run, Name)
+        Offsets=self.array(Run, 'TestOffsets')
+        if Name=='Tests':
+            return np.diff(Offsets).astype(np.int32)
+        Cumulative=np.concatenate(([0], np.cumsum(self.array(Run, 'TestResults')>0)))
+        return (Cumulative[Offsets[1:]]-Cumulative[Offsets[:-1]]).astype(np.int32)
+
+    #Runs of the consolidated series, None if there are none
+    def _consolidated(self):
+        Path=os.path.join(self.Directory, SeriesDirectory, 'runs.json')
+        if not os.path.exists(Path):
+            return None
+        with open(Path) as f:
+            return json.load(f)
+
+
+#Names of the localities in the order of the rows of CovidCases, and the index of the
+#  locality of every agent in them
+#Localities: the locality of every agent returned by simulate, a categorical Series whose
+#  categories are in the order of CD; for other sequences of names, the localities are
+#  taken in the order of their first agent, which is the order of CD since the agents
+#  are stored locality by locality
+def localityCodes(Localities):
+    Categorical=getattr(Localities, 'cat', Localities)
+    if hasattr(Categorical, 'categories'):
+        return np.asarray(Categorical.categories, dtype=str), np.asarray(Categorical.codes)
+    Names, First, Codes = np.unique(np.asarray(Localities, dtype=str), return_index=True, return_inverse=True)
+    Order=np.argsort(First)
+    Rank=np.empty(len(Order), dtype=np.int64)
+    Rank[Order]=np.arange(len(Order))
+    return Names[Order], Rank[Codes]
@@ -0,0 +1,157 @@
+#Scenarios forked from a shared simulation prefix
+#forkScenarios runs a simulation up to BranchDay once, with the prefix policies, and
+#  then continues it under each scenario's intervention and testing policies in a
+#  forked child process. The children inherit the population copy-on-write: the contact
+#  graph and localities stay shared, and only the mutable state columns are copied by the
+#  pages they write. Each child continues from a snapshot of the prefix (see checkpoint.py),
+#  so a scenario gives the same results as a run from day 0 whose policies switch to the
+#  scenario's policies on BranchDay.
+#Forking needs a POSIX system. The prefix uses a pool of NumWorkers workers, which is
+#  closed before forking; the scenarios run their days in their own process.
+#
+#Usage:
+# Results=forkScenarios(30, {'LockAll': (InterventionLockdown, testingPolicy),
+#                            'Quarantine': (InterventionQuarantine, testingPolicy)},
+#                       120, Population, ModelParams, CD, CarProb, Processes=2)
+# CovidCases, TestingHistory, Symptomatic, Localities = Results['LockAll']
+
+import os
+import sys
+import pickle
+import shutil
+import tempfile
+import traceback
+
+import evolution
+from checkpoint import snapshot
+from interventions import InterventionNone
+from sinks import drain, DailyPrint, SeriesCollector
+
+
+#Keeps a snapshot of the state at the end of day Day; used as the Checkpoint of the prefix
+class _Capture:
+
+    def __init__(self, Day):
+        self.Day=Day
+        self.State=None
+
+    def day(self, day, CP, TestingHistory, InterventionsHistory, Engine):
+        if day==self.Day:
+            self.State=snapshot(day, CP, TestingHistory, InterventionsHistory, Engine)
+
+    def close(self):
+        pass
+
+
+#Population source of the children: the population inherited from the prefix
+class _Inherited:
+
+    def __init__(self, CP):
+        self.CP=CP
+
+    def initialize(self, CD, CarProb, ModelParams, Population, randseed=0):
+        return self.CP
+
+
+#Runs the simulation up to BranchDay with the prefix policies, then every scenario up to
+#  NumSteps in a forked process
+#Inputs
+# BranchDay: first day on which the scenario policies apply
+# Scenarios: dict name -> (interventionPolicy, testingPolicy)
+# NumSteps ... PopulationCache: as for simulate, with the prefix policies given by
+#   PrefixIntervention and PrefixTesting (no interventions and no tests by default)
+# Processes: number of scenarios run at the same time (all by default)
+# LogDirectory: directory of the daily output of each scenario (<name>.log), None for stdout
+#Output: dict name -> (CovidCases, TestingHistory, Symptomatic, Localities) as returned by simulate
+def forkScenarios(BranchDay, Scenarios, NumSteps, Population, ModelParams, CD, CarProb, \
+                  PrefixIntervention=InterventionNone, PrefixTesting=None, InitCovidCounts=None, InitFluCounts=None, \
+                  NumWorkers=8, randseed=0, popseed=None, PopulationCache=None, Processes=None, LogDirectory=None):
+    if not 0<BranchDay<NumSteps:
+        raise ValueError('BranchDay must be between 1 and NumSteps-1, got '+str(BranchDay))
+    if PrefixTesting is None:
+        PrefixTesting=_noTesting
+
+    #Shared prefix
+    Prefix=SeriesCollector(CD.shape[0], NumSteps)
+    Capture=_Capture(BranchDay-1)
+    Stream=evolution.simulateStream(NumSteps, Population, ModelParams, CD, CarProb, PrefixIntervention, PrefixTesting, \
+                                    InitCovidCounts, InitFluCounts, NumWorkers, randseed, popseed, PopulationCache, \
+                                    Checkpoint=Capture)
+    Printer=DailyPrint()
+    for Record in Stream:
+        Prefix(Record)
+        Printer(Record)
+        if Record['Day']==BranchDay-1:
+            break
+    #Releases the worker pool and moves the population back to private memory
+    Stream.close()
+    CP=evolution.CP
+    Localities=CP['locality']
+
+    if LogDirectory is not None:
+        os.makedirs(LogDirectory, exist_ok=True)
+    Directory=tempfile.mkdtemp(prefix='scenarios')
+    Results={}
+    try:
+        Pending=list(enumerate(Scenarios))
+        Running={}
+        Failed=[]
+        while Pending or Running:
+            while Pending and len(Running)<(Processes or len(Scenarios)):
+                k, Name = Pending.pop(0)
+                Path=os.path.join(Directory, str(k))
+                sys.stdout.flush()
+                Pid=os.fork()
+                if Pid==0:
+                    _child(Name, Scenarios[Name], Capture.State, CP, Path, LogDirectory, NumSteps, Population, \
+                           ModelParams, CD, CarProb, InitCovidCounts, InitFluCounts, randseed, popseed)
+                Running[Pid]=(Name, Path)
+            Pid, Status = os.wait()
+            if Pid not in Running:
+                continue
+            Name, Path = Running.pop(Pid)
+            if Status!=0 or not os.path.exists(Path):
+                Failed.append(Name)
+                Results[Name]=None
+                continue
+            with open(Path, 'rb') as f:
+                Series, TestingHistory = pickle.load(f)
+            for Key in Series:
+                Series[Key][:, :BranchDay]=Prefix[Key]
+            Results[Name]=(Series['CovidCases'].astype(float), TestingHistory, Series['Symptomatic'].astype(float), Localities)
+    finally:
+        shutil.rmtree(Directory, ignore_errors=True)
+    if Failed:
+        raise RuntimeError('Scenarios '+', '.join(Failed)+' failed')
+    return {Name: Results[Name] for Name in Scenarios}
+
+
+#Body of the child process of scenario Name: continues the prefix and pickles
+#  (series, TestingHistory) to Path
+def _child(Name, Policies, State, CP, Path, LogDirectory, NumSteps, Population, ModelParams, CD, CarProb, \
+           InitCovidCounts, InitFluCounts, randseed, popseed):
+    Code=1
+    try:
+        Log=open(os.path.join(LogDirectory, Name+'.log'), 'w') if LogDirectory is not None else sys.stdout
+        sys.stdout=Log
+        interventionPolicy, testingPolicy = Policies
+        Series=SeriesCollector(CD.shape[0], NumSteps)
+        drain(evolution.simulateStream(NumSteps, Population, ModelParams, CD, CarProb, interventionPolicy, testingPolicy, \
+                                       InitCovidCounts, InitFluCounts, 1, randseed, popseed, _Inherited(CP), Resume=State), \
+              Series, DailyPrint())
+        with open(Path+'.tmp', 'wb') as f:
+            pickle.dump(({Key: Series.Series[Key] for Key in Series.Names}, evolution.TestingHistory), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(Path+'.tmp', Path)
+        Log.flush()
+        Code=0
+    except BaseException:
+        traceback.print_exc()
+        sys.stderr.flush()
+    finally:
+        #Skip the cleanup of the parent's state inherited by the child
+        os._exit(Code)
+
+
+#Testing policy of the prefix when none is given
+def _noTesting(CP, TestingHistory, day):
+    pass
@@ -0,0 +1,168 @@
+#Consumers of the daily records of simulateStream
+#simulateStream (see evolution.py) yields one DailyRecord per simulated day instead of
+#  returning the whole run at the end. A sink is any callable taking a record; sinks with
+#  a close() method are closed by drain() when the run ends, including on errors.
+#A DailyRecord is a dict:
+# Day: day of the record
+# CovidCases, Symptomatic: int32 arrays, per locality, of the agents in Covid state I
+#   and of the symptomatic agents at the end of the day
+# PositiveTests, Tests: int32 arrays of the positive tests and of the tests of the day per locality
+# Interventions: list of the interventions applied on the day
+# Seconds: wall time taken by the day, the setup of the run excluded
+# Phases, Setup, Counters: profile of the day and setup phases of the run (see profiling.py)
+#
+#Usage:
+# drain(simulateStream(None, ...), DailyPrint(), JsonLinesWriter('run.jsonl'), Progress(Every=10))
+
+import sys
+import json
+import timeit
+import numpy as np
+
+
+#Feeds every record of Stream to the sinks, closes them at the end, and returns the
+#  number of days consumed
+def drain(Stream, *Sinks):
+    Days=0
+    try:
+        for Record in Stream:
+            for sink in Sinks:
+                sink(Record)
+            Days+=1
+    finally:
+        if hasattr(Stream, 'close'):
+            Stream.close()
+        for sink in Sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+    return Days
+
+
+#The daily summary line printed by simulate
+class DailyPrint:
+
+    def __init__(self, File=None):
+        self.File=File
+
+    def __call__(self, Record):
+        print("Day:"+str(Record['Day'])+" Cases:"+str(int(np.sum(Record['CovidCases'])))+ \
+              " PositiveTests:"+str(int(np.sum(Record['PositiveTests'])))+ \
+              " TestsConducted:"+str(int(np.sum(Record['Tests'])))+ \
+              " Symptomatic:"+str(int(np.sum(Record['Symptomatic']))) + \
+              " Interventions:"+str(Record['Interventions'])+ \
+              " TimeTaken:{dt:.3f}s".format(dt=Record['Seconds']), file=self.File or sys.stdout)
+
+
+#Appends every record as one line of json to Path
+#Each line is flushed when written, so a run that crashes keeps all the days it finished
+class JsonLinesWriter:
+
+    def __init__(self, Path, Append=False, **Metadata):
+        self.File=open(Path, 'a' if Append else 'w')
+        #Values added to every line, e.g. the run id
+        self.Metadata=Metadata
+
+    def __call__(self, Record):
+        Line=dict(self.Metadata)
+        for Name, Value in Record.items():
+            Line[Name]=Value.tolist() if isinstance(Value, np.ndarray) else Value
+        self.File.write(json.dumps(Line)+'\n')
+        self.File.flush()
+
+    def close(self):
+        self.File.close()
+
+
+#Reads the records written by JsonLinesWriter, with the arrays restored
+#A last line cut short by a crash is skipped
+def readJsonLines(Path):
+    with open(Path) as f:
+        for Line in f:
+            try:
+                Record=json.loads(Line)
+            except ValueError:
+                continue
+            for Name in SeriesNames:
+                Record[Name]=np.asarray(Record[Name], dtype=np.int32)
+            yield Record
+
+
+#Per-locality series of a record
+SeriesNames=['CovidCases', 'Symptomatic', 'PositiveTests', 'Tests']
+
+
+#Keeps the series in (localities x days) arrays, as returned by simulate
+#With NumSteps None the arrays grow as the days come in
+class SeriesCollector:
+
+    def __init__(self, NumLocalities, NumSteps=None, Names=SeriesNames):
+        self.Names=Names
+        self.Days=0
+        self.Series={Name: np.zeros((NumLocalities, NumSteps or 16), dtype=np.int32) for Name in Names}
+
+    def __call__(self, Record):
+        j=Record['Day']
+        for Name in self.Names:
+            Series=self.Series[Name]
+            if j>=Series.shape[1]:
+                Series=np.concatenate((Series, np.zeros((Series.shape[0], max(j+1, 2*Series.shape[1])-Series.shape[1]), \
+                                                        dtype=Series.dtype)), axis=1)
+                self.Series[Name]=Series
+            Series[:, j]=Record[Name]
+        self.Days=max(self.Days, j+1)
+
+    #Series Name of the days collected
+    def __getitem__(self, Name):
+        return self.Series[Name][:, :self.Days]
+
+
+#Totals kept in constant memory: cumulative tests, peak of the cases and day of the peak,
+#  days under each intervention
+class RunningTotals:
+
+    def __init__(self):
+        self.Days=0
+        self.PositiveTests=0
+        self.Tests=0
+        self.PeakCases=0
+        self.PeakDay=None
+        self.InterventionDays={}
+        self.Seconds=0.0
+
+    def __call__(self, Record):
+        self.Days+=1
+        self.PositiveTests+=int(np.sum(Record['PositiveTests']))
+        self.Tests+=int(np.sum(Record['Tests']))
+        Cases=int(np.sum(Record['CovidCases']))
+        if self.PeakDay is None or Cases>self.PeakCases:
+            self.PeakCases=Cases
+            self.PeakDay=Record['Day']
+        for Intervention in Record['Interventions']:
+            self.InterventionDays[Intervention]=self.InterventionDays.get(Intervention, 0)+1
+        self.Seconds+=Record['Seconds']
+
+    def summary(self):
+        return {'Days': self.Days, 'PositiveTests': self.PositiveTests, 'Tests': self.Tests, \
+                'PeakCases': self.PeakCases, 'PeakDay': self.PeakDay, \
+                'InterventionDays': dict(self.InterventionDays), 'Seconds': self.Seconds}
+
+
+#Prints the progress of the run every Every days, with the expected time left when
+#  NumSteps is known
+class Progress:
+
+    def __init__(self, NumSteps=None, Every=10, File=None):
+        self.NumSteps=NumSteps
+        self.Every=Every
+        self.File=File
+        self.Start=timeit.default_timer()
+
+    def __call__(self, Record):
+        Done=Record['Day']+1
+        if Done%self.Every and Done!=self.NumSteps:
+            return
+        Elapsed=timeit.default_timer()-self.Start
+        Line='Progress: {d} days in {t:.1f}s ({r:.2f}s/day)'.format(d=Done, t=Elapsed, r=Elapsed/Done)
+        if self.NumSteps:
+            Line+=', {p:.0f}% done, {left:.0f}s left'.format(p=100*Done/self.NumSteps, left=Elapsed/Done*(self.NumSteps-Done))
+        print(Line, file=self.File or sys.stdout)
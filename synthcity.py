@@ -0,0 +1,83 @@
+#Synthetic cities in the format of setupcitydata (see inoutfuncs.py)
+#A synthetic city has NumLocalities localities laid out in the unit square, with
+# - an adjacency that is either a grid (each locality touches the ones above, below, left
+#   and right of it) or a random planar graph (a jittered grid whose cells are split into
+#   triangles by a random diagonal, so that inner localities have 4 to 8 neighbors)
+# - Zipf populations: the k-th largest locality has a density proportional to 1/k**ZipfExponent,
+#   the ranks being shuffled over the localities
+# - a random origin-destination matrix CarProb: NumHotspots hotspots placed at random
+#   points, with Zipf attractiveness; a locality visits a hotspot with a probability
+#   decreasing with its distance (gravity model) times a lognormal noise, and visits no
+#   hotspot (last column) with probability 1-VisitFraction on average
+#The output can be given to simulate in place of the Bangalore data, e.g.
+# CD, CarProb = syntheticCity(400, Adjacency='planar', randseed=1)
+# simulate(30, 1000000, ModelParams, CD, CarProb, InterventionNone, testingPolicy)
+
+import numpy as np
+
+from inoutfuncs import cityframe
+
+
+#Output: CD and CarProb of the synthetic city, as returned by setupcitydata
+#Adjacency: 'grid' or 'planar'
+#DistanceScale: distance over which the attraction of a hotspot decreases by a factor e
+def syntheticCity(NumLocalities, NumHotspots=20, Adjacency='grid', ZipfExponent=1.0, VisitFraction=0.5, \
+                  DistanceScale=0.25, randseed=0):
+    if NumLocalities<1:
+        raise ValueError('NumLocalities must be at least 1')
+    rng=np.random.default_rng(randseed)
+    Cols=int(np.ceil(np.sqrt(NumLocalities)))
+    Rows=int(np.ceil(NumLocalities/Cols))
+    Row, Col = np.divmod(np.arange(NumLocalities), Cols)
+
+    if Adjacency=='grid':
+        Edges=_gridEdges(Row, Col, Rows, Cols)
+        Points=np.column_stack(((Col+0.5)/Cols, (Row+0.5)/Rows))
+    elif Adjacency=='planar':
+        Edges=_gridEdges(Row, Col, Rows, Cols)
+        #One diagonal per cell of four localities, which keeps the graph planar
+        Cell=np.flatnonzero((Row<Rows-1) & (Col<Cols-1))
+        Flip=rng.random(len(Cell))<0.5
+        Diagonals=np.where(Flip[:, None], np.column_stack((Cell+1, Cell+Cols)), np.column_stack((Cell, Cell+Cols+1)))
+        Edges=np.concatenate((Edges, Diagonals[Diagonals.max(axis=1)<NumLocalities]))
+        Points=np.column_stack(((Col+rng.uniform(0.2, 0.8, NumLocalities))/Cols, (Row+rng.uniform(0.2, 0.8, NumLocalities))/Rows))
+    else:
+        raise ValueError("Adjacency must be 'grid' or 'planar', got "+repr(Adjacency))
+
+    #Symmetric adjacency in CSR form, neighbors in increasing row order
+    Pairs=np.concatenate((Edges, Edges[:, ::-1]))
+    Pairs=Pairs[np.lexsort((Pairs[:, 1], Pairs[:, 0]))]
+    NeighborOffsets=np.zeros(NumLocalities+1, dtype=np.int64)
+    np.cumsum(np.bincount(Pairs[:, 0], minlength=NumLocalities), out=NeighborOffsets[1:])
+
+    Density=zipfWeights(NumLocalities, ZipfExponent, rng)
+
+    #Gravity model with Zipf hotspot attractiveness
+    Hotspots=rng.random((NumHotspots, 2))
+    Distance=np.sqrt(((Points[:, None, :]-Hotspots[None, :, :])**2).sum(axis=2))
+    Attraction=zipfWeights(NumHotspots, ZipfExponent, rng)[None, :]*np.exp(-Distance/DistanceScale)* \
+               rng.lognormal(0.0, 0.5, (NumLocalities, NumHotspots))
+    Visiting=np.clip(VisitFraction*rng.uniform(0.5, 1.5, NumLocalities), 0.0, 1.0)
+    CarProb=np.zeros((NumLocalities, NumHotspots+1))
+    CarProb[:, :NumHotspots]=Attraction/Attraction.sum(axis=1, keepdims=True)*Visiting[:, None]
+    CarProb[:, NumHotspots]=1-Visiting
+
+    return cityframe({'Ids': np.arange(1, NumLocalities+1), \
+                      'Names': np.array(['Ward '+str(k+1) for k in range(NumLocalities)]), \
+                      'Density': Density, 'NeighborOffsets': NeighborOffsets, 'NeighborIndices': Pairs[:, 1], \
+                      'CarProb': CarProb})
+
+
+#Zipf weights of Count items in shuffled order, summing to 1
+def zipfWeights(Count, Exponent, rng):
+    Weights=1.0/np.arange(1, Count+1)**Exponent
+    return rng.permutation(Weights/Weights.sum())
+
+
+#Edges between the horizontal and vertical neighbors of a grid of Rows x Cols cells,
+#  of which the first len(Row) are localities
+def _gridEdges(Row, Col, Rows, Cols):
+    ids=np.arange(len(Row))
+    Right=ids[(Col<Cols-1) & (ids+1<len(Row))]
+    Down=ids[ids+Cols<len(Row)]
+    return np.concatenate((np.column_stack((Right, Right+1)), np.column_stack((Down, Down+Cols))))
@@ -0,0 +1,176 @@
+#Sparse history of the tests of all people on all days
+#SparseTestingHistory stores, for every day, the ids of the agents tested that day
+#  (sorted int32) and their results (int8: +1 positive, -1 negative), instead of a dense
+#  (PopulationEffective x NumSteps) matrix. It supports the indexing used by the policies on
+#  the dense TestingHistory of earlier versions:
+# TestingHistory[:, day]: dense column of results on day (0 for not tested)
+# TestingHistory[rows, day]: results of the agents rows on day
+# TestingHistory[i, day]=value: records a test result
+# TestingHistory[i]: results of agent i on all days
+#Negative days count from the end as with numpy arrays
+#With NumSteps None the history grows by one day each time advance() is called, for runs
+#  of unbounded length; with Retention R only the last R days are kept. Reading a day that
+#  was dropped raises IndexError, except in the row view TestingHistory[i], where such
+#  days read as not tested
+
+import numpy as np
+
+
+class SparseTestingHistory:
+
+    def __init__(self, PopulationEffective, NumSteps=None, Retention=None):
+        self.PopulationEffective=PopulationEffective
+        self.Retention=Retention
+        #Days of the history, and first day still kept
+        self.NumSteps=0
+        self.First=0
+        #Lists indexed by day-First
+        self.Ids=[]
+        self.Results=[]
+        #Single results written with TestingHistory[i, day]=value, merged on the next read
+        self.Pending=[]
+        if NumSteps is not None:
+            self.extend(NumSteps)
+
+    @property
+    def shape(self):
+        return (self.PopulationEffective, self.NumSteps)
+
+    #Grows the history to NumSteps days
+    def extend(self, NumSteps):
+        for j in range(self.NumSteps, NumSteps):
+            self.Ids.append(np.zeros(0, dtype=np.int32))
+            self.Results.append(np.zeros(0, dtype=np.int8))
+            self.Pending.append(None)
+        self.NumSteps=max(self.NumSteps, NumSteps)
+        self._drop()
+
+    #Called by simulate at the start of day: makes day part of the history and drops the
+    #  days older than Retention
+    def advance(self, day):
+        self.extend(day+1)
+
+    #Days still kept
+    def days(self):
+        return range(self.First, self.NumSteps)
+
+    #Records the results of the agents ids on day
+    #A later result for the same agent and day replaces the earlier one; result 0 removes it
+    def record(self, day, ids, results):
+        k=self._flush(self._dayIndex(day))
+        ids=np.asarray(ids, dtype=np.int32).ravel()
+        results=np.broadcast_to(np.asarray(results, dtype=np.int8), ids.shape)
+        ids=np.concatenate((self.Ids[k], ids))
+        results=np.concatenate((self.Results[k], results))
+        #Keep the last result of every agent
+        Unique, Last = np.unique(ids[::-1], return_index=True)
+        Last=len(ids)-1-Last
+        Keep=results[Last]!=0
+        self.Ids[k]=Unique[Keep]
+        self.Results[k]=results[Last][Keep]
+
+    #Sorted ids and results of the agents tested on day
+    def tested(self, day):
+        k=self._flush(self._dayIndex(day))
+        return self.Ids[k], self.Results[k]
+
+    #Sorted ids of the agents that tested positive on day
+    def positives(self, day):
+        ids, results = self.tested(day)
+        return ids[results>0]
+
+    def numTests(self, day):
+        return len(self.tested(day)[0])
+
+    def numPositives(self, day):
+        return int(np.sum(self.tested(day)[1]>0))
+
+    #Number of positive tests on each day kept
+    def positivesPerDay(self):
+        return np.array([self.numPositives(j) for j in self.days()])
+
+    #Dense (PopulationEffective x NumSteps) int8 matrix of the history
+    def toDense(self):
+        Dense=np.zeros(self.shape, dtype=np.int8)
+        for j in self.days():
+            ids, results = self.tested(j)
+            Dense[ids, j]=results
+        return Dense
+
+    #Dense column of the results on day
+    def column(self, day):
+        Column=np.zeros(self.PopulationEffective, dtype=np.int8)
+        ids, results = self.tested(day)
+        Column[ids]=results
+        return Column
+
+    def __getitem__(self, Key):
+        if not isinstance(Key, tuple):
+            #Row of agent Key on all days
+            return np.array([self._lookup(int(Key), j) if j>=self.First else 0 for j in range(self.NumSteps)], dtype=np.int8)
+        Rows, Days = Key
+        if isinstance(Days, slice) or np.ndim(Days)>0:
+            Days=np.arange(self.NumSteps)[Days]
+            return np.stack([self[Rows, int(j)] for j in Days], axis=-1)
+        if np.ndim(Rows)==0 and not isinstance(Rows, slice):
+            return self._lookup(int(Rows), Days)
+        return self.column(Days)[Rows]
+
+    def __setitem__(self, Key, Value):
+        Rows, Day = Key
+        k=self._dayIndex(Day)
+        if np.ndim(Rows)==0 and not isinstance(Rows, slice):
+            if self.Pending[k] is None:
+                self.Pending[k]={}
+            self.Pending[k][int(Rows)]=int(Value)
+        else:
+            self.record(Day, np.arange(self.PopulationEffective)[Rows], Value)
+
+    #Compact representation for pickling
+    def __getstate__(self):
+        for k in range(len(self.Pending)):
+            self._flush(k)
+        return self.__dict__
+
+    #Older pickles have no retention
+    def __setstate__(self, State):
+        State.setdefault('Retention', None)
+        State.setdefault('First', 0)
+        self.__dict__.update(State)
+
+    def _lookup(self, i, day):
+        k=self._dayIndex(day)
+        if self.Pending[k] is not None and i in self.Pending[k]:
+            return self.Pending[k][i]
+        ids=self.Ids[k]
+        m=np.searchsorted(ids, i)
+        if m<len(ids) and ids[m]==i:
+            return int(self.Results[k][m])
+        return 0
+
+    #Merges the pending results of list index k, and returns k
+    def _flush(self, k):
+        if self.Pending[k] is not None:
+            Pending=self.Pending[k]
+            self.Pending[k]=None
+            self.record(self.First+k, np.fromiter(Pending.keys(), dtype=np.int32, count=len(Pending)), \
+                        np.fromiter(Pending.values(), dtype=np.int8, count=len(Pending)))
+        return k
+
+    #List index of day
+    def _dayIndex(self, day):
+        day=int(day)
+        if day<0:
+            day+=self.NumSteps
+        if day<0 or day>=self.NumSteps:
+            raise IndexError('day '+str(day)+' is out of range for '+str(self.NumSteps)+' days')
+        if day<self.First:
+            raise IndexError('day '+str(day)+' is older than the last '+str(self.Retention)+' days kept')
+        return day-self.First
+
+    def _drop(self):
+        if self.Retention is None or self.NumSteps-self.First<=self.Retention:
+            return
+        Drop=self.NumSteps-self.Retention-self.First
+        del self.Ids[:Drop], self.Results[:Drop], self.Pending[:Drop]
+        self.First+=Drop
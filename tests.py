@@ -1,6 +1,11 @@
-import pandas
 import random
 import numpy as np
+from interventions import quarantine
+from population import StateI, FluStateI, PositiveBit
+from randomstreams import policyGenerator
+
+#Policy random stream used by the testing policies (see randomstreams.py)
+TestingStream=0
 
 # ===================================================================================
 #The test function denoting individual tests
@@ -12,72 +17,86 @@ def test(CovidState, i,  FalseNegativeProb):
         return 0
 
 # ===================================================================================    
+# Boolean mask of the people with symptoms (Covid or flu) who have not tested positive yet
+def symptomaticMask(CP):
+    return ((CP.CovidState==StateI) | (CP.FluState==FluStateI)) & ~CP.positive()
+
+
+# ids of all symptomatic people, each one reported with the probability LocationRepProb
+# of the person's locality (LocationRepProb[k] for localityIndex k+1)
+def reportedSymptomatic(CP, LocationRepProb, rng, Mask=None):
+    if Mask is None:
+        Mask=symptomaticMask(CP)
+    ids=np.flatnonzero(Mask)
+    return ids[rng.random(len(ids))<np.asarray(LocationRepProb, dtype=float)[CP.Locality[ids]]]
+
+
 # return a list of all symptomatic individuals in locality index locidx, thinned down by reportProb
 def getSymptomatic(CP, locidx, reportProb=1.0):
-    Symptomatic = CP.loc[ (CP["localityIndex"]==locidx) & \
-    ((CP["CovidState"]=="I") | (CP["FluState"]=="I")) & (CP['CovidPositive']==0) ]
-    return [i for i in Symptomatic["id"] if random.random() < reportProb]
+    Symptomatic = np.flatnonzero(symptomaticMask(CP) & (CP.Locality==locidx-1))
+    return [i for i in Symptomatic.tolist() if random.random() < reportProb]
+
+
+# Tests the people ids on day and records the results in bulk
+# People testing positive are marked CovidPositive and quarantined
+def testAll(CP, TestingHistory, ids, FalseNegativeProb, day, rng):
+    ids=np.unique(np.asarray(ids, dtype=np.int64))
+    Positive=(CP.CovidState[ids]==StateI) & (rng.random(len(ids))<(1-FalseNegativeProb))
+    TestingHistory.record(day, ids, np.where(Positive, 1, -1))
+    CP.setFlag(PositiveBit, ids[Positive], 1)
+    quarantine(CP, ids[Positive], day)
+    return ids[Positive]
+
 
 # ===================================================================================
 #Tests a constant fraction of people with symptoms chosen randomly
 def RandomSymptomaticTesting(TestingBudget, FalseNegative, LocationRepProb, CP, TestingHistory, day):
-    toTest=[]
-    for i in range(len(LocationRepProb)):
-        toTest+=getSymptomatic(CP, i+1, LocationRepProb[i])
+    rng=policyGenerator(CP.RandSeed, day, TestingStream)
+    toTest=reportedSymptomatic(CP, LocationRepProb, rng)
     
     if TestingBudget<=len(toTest):
-        finalList=random.sample(toTest, TestingBudget)
+        finalList=rng.choice(toTest, TestingBudget, replace=False)
     else:
         finalList=toTest
 
-    for i in finalList:        
-        if test(CP.loc[i, "CovidState"], i, FalseNegative)==1:
-            TestingHistory[i,day]=1
-            CP.loc[i,'CovidPositive']=1
-            CP.loc[i,'quarantine']=1
-            CP.loc[i,'quarantineDay']=day
-        else:
-            TestingHistory[i,day]=-1
+    testAll(CP, TestingHistory, finalList, FalseNegative, day, rng)
 
 
 # ===================================================================================
 #Contact tracing: Uses a part of testing budget for contact tracing
-def ContactTracing( TestingBudget, FalseNegative, LocationRepProb, CP, TestingHistory, day):
-    
-    ContactList = []
-
-    
-    for i in range(TestingHistory.shape[0]):
-        if TestingHistory[i, day-1]==1 or TestingHistory[i,day-2]==1:
-            ContactList+= CP.loc[i, 'LocalContacts'] + CP.loc[i, 'VisitsContacts']
-            #ContactList+= [CP.loc[j,'id'] for j in range(CP.shape[0]) if i in CP.loc[j, 'LocalContacts'] or i in CP.loc[j, 'VisitsContacts']]
-
-    ContactsToTest= CP.loc[(CP.index.isin(ContactList)) & \
-                          (((CP["CovidState"]=="I") | (CP["FluState"]=="I"))&(CP['CovidPositive']==0))]
-
-    symptomatic=[]
-    for i in range(len(LocationRepProb)):
-        symptomatic+=getSymptomatic(CP, i+1, LocationRepProb[i])
-
-    
-
-    
-    if ContactsToTest.shape[0]<TestingBudget: 
-        if (TestingBudget- ContactsToTest.shape[0])< len(symptomatic):
-            toTest = list(ContactsToTest['id'])+random.sample(symptomatic, TestingBudget-ContactsToTest.shape[0])                        
+#The symptomatic contacts of the people who tested positive on the previous two days are
+#  tested first, the rest of the budget goes to randomly chosen symptomatic people
+#Depth: contacts of contacts are traced up to Depth steps, nearer contacts first
+#Backward: also traces the people who have the positives among their contacts (see
+#  CityPopulation.inContacts), e.g. ContactTracing with partial(ContactTracing, Budget,
+#  FalseNegative, LocationRepProb, Backward=True, Depth=2)
+def ContactTracing( TestingBudget, FalseNegative, LocationRepProb, CP, TestingHistory, day, Backward=False, Depth=1):
+    rng=policyGenerator(CP.RandSeed, day, TestingStream)
+    Mask=symptomaticMask(CP)
+
+    Positives=np.concatenate([TestingHistory.positives(d) for d in [day-1, day-2] if d>=0]+[np.zeros(0, dtype=np.int64)])
+    Traced=[]
+    Remaining=TestingBudget
+    for Hop in CP.contactHops(Positives, Depth, Backward):
+        ContactsToTest=Hop[Mask[Hop]]
+        if len(ContactsToTest)>=Remaining:
+            Traced.append(rng.choice(ContactsToTest, Remaining, replace=False))
+            Remaining=0
+            break
+        Traced.append(ContactsToTest)
+        Remaining-=len(ContactsToTest)
+    toTest=np.concatenate(Traced+[np.zeros(0, dtype=np.int64)])
+
+    if Remaining>0:
+        #Symptomatic people not already traced
+        Mask[toTest]=False
+        symptomatic=reportedSymptomatic(CP, LocationRepProb, rng, Mask)
+        if Remaining<len(symptomatic):
+            toTest=np.concatenate((toTest, rng.choice(symptomatic, Remaining, replace=False)))
         else:
-            toTest = list(ContactsToTest['id'])+symptomatic
-    else:
-        toTest = list(ContactsToTest.sample(n=TestingBudget)['id'])
+            toTest=np.concatenate((toTest, symptomatic))
 
-    for i in toTest:
-        if test(CP.loc[i, "CovidState"], i, FalseNegative)==1:
-            TestingHistory[i,day]=1
-            CP.loc[i,'CovidPositive']=1
-            CP.loc[i,'quarantine']=1
-            CP.loc[i,'quarantineDay']=day
-        else:
-            TestingHistory[i,day]=-1
+    testAll(CP, TestingHistory, toTest, FalseNegative, day, rng)
 
 
 # ===================================================================================
@@ -128,8 +147,8 @@ def getTestTargets(TestingBudgetSymptomatic, TestingBudgetContact, ReportingProb
 def getPlacesInfectedness(VisitingPlaceInfectiousnessPerPerson, \
         WardInfectiousnessPerPerson, Epsilon, CP, TestingHistory, Day):
 
-    NumPlacesVisit = len(pandas.unique(CP["Visits"].values))
-    NumLocations = len(pandas.unique(CP["localityIndex"].values))
+    NumPlacesVisit = len(np.unique(CP.Visits))
+    NumLocations = len(np.unique(CP.Locality))
 
     VisitingPlacesInfectedness = np.zeros(NumPlacesVisit)
     WardsInfectedness = np.zeros(NumLocations)
@@ -170,8 +189,7 @@ def LocBasedTesting(TestingBudgetSymptomatic, TestingBudgetContact, ReportingPro
             WhoPositive.append(i)
             TestingHistory[i,day]=1
             CP.loc[i,'CovidPositive']=1
-            CP.loc[i,'quarantine']=1
-            CP.loc[i,'quarantineDay']=day
+            quarantine(CP, [i], day)
         else:
             TestingHistory[i,day]=-1
     # debug:
@@ -0,0 +1,90 @@
+#Shared memory utilities for the worker pool used by simulate
+#The population arrays are placed in multiprocessing.shared_memory blocks so that
+#  the workers of a long-lived pool read and write the state in place, instead of
+#  inheriting a copy of it and pickling results back
+#Read-only arrays memory-mapped from .npy files (e.g. a population from popcache.py) are
+#  not copied: the other processes map the same files
+
+import numpy as np
+from multiprocessing import shared_memory
+
+
+#A set of named numpy arrays living in shared memory
+class SharedArrays:
+
+    def __init__(self):
+        self.Blocks={}
+        self.Files={}
+        self.Arrays={}
+
+    #Copies Values into a new shared memory block and returns the shared array
+    #A read-only array mapping a whole .npy file is returned as is
+    def share(self, Name, Values):
+        if mappedFile(Values) is not None:
+            self.Files[Name]=mappedFile(Values)
+            self.Arrays[Name]=Values
+            return Values
+        Values=np.ascontiguousarray(Values)
+        shm=shared_memory.SharedMemory(create=True, size=max(Values.nbytes, 1))
+        Array=np.ndarray(Values.shape, dtype=Values.dtype, buffer=shm.buf)
+        Array[...]=Values
+        self.Blocks[Name]=shm
+        self.Arrays[Name]=Array
+        return Array
+
+    #Picklable description of the arrays, used by other processes to attach
+    def spec(self):
+        return {'Blocks': {Name: (shm.name, self.Arrays[Name].dtype.str, self.Arrays[Name].shape) \
+                           for Name, shm in self.Blocks.items()}, \
+                'Files': dict(self.Files)}
+
+    #Attaches to the arrays described by Spec, created by another process
+    @classmethod
+    def attach(cls, Spec):
+        Shared=cls()
+        for Name, (BlockName, DType, Shape) in Spec['Blocks'].items():
+            shm=shared_memory.SharedMemory(name=BlockName)
+            Shared.Blocks[Name]=shm
+            Shared.Arrays[Name]=np.ndarray(Shape, dtype=DType, buffer=shm.buf)
+        for Name, Path in Spec['Files'].items():
+            Shared.Files[Name]=Path
+            Shared.Arrays[Name]=np.load(Path, mmap_mode='r')
+        return Shared
+
+    #Releases the blocks; the process that created them should also unlink
+    #The arrays must not be used after this
+    def close(self, unlink=False):
+        self.Arrays={}
+        for shm in self.Blocks.values():
+            try:
+                shm.close()
+            except BufferError:
+                #Arrays handed out by share() are still referenced; the mapping
+                #  is released when they are garbage collected
+                pass
+            if unlink:
+                shm.unlink()
+        self.Blocks={}
+        self.Files={}
+
+
+#Path of the .npy file mapped by Values if it is a read-only memory map of the whole
+#  file (as returned by np.load with mmap_mode='r'), None otherwise
+def mappedFile(Values):
+    if not isinstance(Values, np.memmap) or Values.filename is None or Values.flags.writeable:
+        return None
+    if not str(Values.filename).endswith('.npy') or not Values.flags.c_contiguous:
+        return None
+    Whole=np.load(Values.filename, mmap_mode='r')
+    if Whole.shape!=Values.shape or Whole.dtype!=Values.dtype or Whole.offset!=Values.offset:
+        return None
+    return str(Values.filename)
+
+
+#Splits agents 0..PopulationEffective-1 into NumParts contiguous ranges
+#Range boundaries are multiples of Align, except for the last one
+#Output: list of (lo, hi) pairs
+def agentRanges(PopulationEffective, NumParts, Align=1):
+    NumBlocks=-(-PopulationEffective//Align)
+    Bounds=np.minimum(np.linspace(0, NumBlocks, NumParts+1).astype(np.int64)*Align, PopulationEffective)
+    return [(int(Bounds[k]), int(Bounds[k+1])) for k in range(NumParts) if Bounds[k]<Bounds[k+1]]